@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs
+
+from starlette.routing import Match
+
+import metrics
+from dependencies import bearer_token
+from responses import JSONResponse
+from sql_app.cache import SERVER_ERRORS, RespClient
+
+# query parameters the endpoints still accept tokens in, see dependencies.bearer_token
+TOKEN_PARAMS = ("token", "premium_user_token", "admin_token")
+# never rate limited nor queued, monitoring must keep working while requests are shed
+EXEMPT_PATHS = ("/metrics",)
+# buckets kept by the memory backend, an evicted bucket is refilled which only errs on the lenient side
+MAX_BUCKETS = 100000
+
+
+class MemoryRateLimiter:
+    """[Token buckets kept in process, each worker limits the requests it serves on its own]"""
+
+    def __init__(self, max_buckets: int = MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: int):
+        """[Takes a token from the bucket, which holds up to burst tokens and gains rate tokens per second]
+
+        Args:
+            key (str): [bucket]
+            rate (float): [tokens per second]
+            burst (int): [bucket size]
+
+        Returns:
+            [float]: [0 if a token was taken, else seconds until the next one]
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisRateLimiter:
+    """[Request counts kept in any server speaking the redis protocol (RESP), shared by every worker]
+
+    A bucket is approximated by counting requests in fixed windows of burst / rate seconds, which allows the same
+    average rate and up to twice the burst across a window boundary, but only needs INCR and PEXPIRE.
+    Errors talking to the server let the request through so an unavailable server does not take the api down.
+
+    Args:
+        url (str): [redis://host:port/db]
+    """
+
+    def __init__(self, url: str):
+        self.client = RespClient(url)
+
+    async def take(self, key: str, rate: float, burst: int):
+        window = burst / rate
+        now = time.time()
+        index = math.floor(now / window)
+        # the window is part of the key, so a key left without expiry by a failure is never counted again
+        window_key = "ratelimit:%s:%d" % (key, index)
+        try:
+            count, _ = await self.client.pipeline(("INCR", window_key), ("PEXPIRE", window_key, str(math.ceil(window * 1000))))
+        except SERVER_ERRORS:
+            return 0.0
+        if count <= burst:
+            return 0.0
+        return (index + 1) * window - now
+
+
+def create_rate_limiter(url: str):
+    """[Builds the rate limit backend named by url, memory for per process buckets or redis://host:port/db]
+
+    Args:
+        url (str): [rate limit url]
+
+    Returns:
+        [Union[MemoryRateLimiter, RedisRateLimiter]]: [rate limit backend]
+    """
+    if url.startswith("redis://"):
+        return RedisRateLimiter(url)
+    return MemoryRateLimiter()
+
+
+class ConcurrencyLimiter:
+    """[Bounds the requests handled at once, with a bounded first come first served queue for the rest]
+
+    Rejecting a request that cannot be started soon is cheaper for both sides than serving it late, so a request finding
+    the queue full is rejected at once and a queued one is rejected after timeout seconds.
+
+    Args:
+        limit (int): [requests handled at once]
+        max_queued (int): [requests waiting at most]
+        timeout (float): [seconds a request waits at most]
+    """
+
+    def __init__(self, limit: int, max_queued: int, timeout: float):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        """[Takes a slot, waiting for one in the queue if all are taken]
+
+        Returns:
+            [Optional[str]]: [None once a slot is taken, else why not: queue_full or queue_timeout]
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= self.max_queued:
+            return "queue_full"
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            # the client went away just as a slot was handed over, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return None
+
+    def release(self):
+        # a released slot goes straight to the longest waiting request, so active only drops without waiters
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+
+def client_key(scope):
+    """[Identifies the client of a request by its token, hashed so tokens are not kept, or by its address without one]
+
+    Tokens are not verified here, a client inventing tokens gets a bucket per token and is only held back by the
+    concurrency limit.
+
+    Args:
+        scope (dict): [ASGI scope]
+
+    Returns:
+        [str]: [client key]
+    """
+    authorization = dict(scope["headers"]).get(b"authorization")
+    token = bearer_token(authorization.decode("latin-1") if authorization else None, None)
+    if token is None:
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        token = next((query[name][0] for name in TOKEN_PARAMS if query.get(name)), None)
+    if token:
+        return "token:" + hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+    client = scope.get("client")
+    return "address:%s" % (client[0] if client else "unknown")
+
+
+class AdmissionMiddleware:
+    """[Rejects requests over the client's rate limits with 429 and sheds load beyond the concurrency limit with 503]
+
+    Every client has a bucket of rate_limit (rate, burst) shared by all routes and one per route listed in route_limits,
+    a request is admitted while all of them have a token. Admitted requests then take a concurrency slot.
+    Rejections carry a Retry-After header and are counted in the metrics.
+
+    Args:
+        app (ASGIApp): [wrapped application]
+        routes (List[BaseRoute]): [application routes, to find the route a request is for]
+        rate_limiter (Union[MemoryRateLimiter, RedisRateLimiter]): [rate limit backend]
+        rate_limit (Tuple[float, int]): [rate and burst per client, a rate of 0 disables]
+        route_limits (Dict[str, Tuple[float, int]]): [rate and burst per client for routes keyed "METHOD /path/template",
+                                                      a rate of 0 disables the route's limit]
+        concurrency_limiter (Optional[ConcurrencyLimiter]): [None disables the concurrency limit]
+    """
+
+    def __init__(self, app, routes, rate_limiter, rate_limit, route_limits, concurrency_limiter=None):
+        self.app = app
+        self.routes = routes
+        self.rate_limiter = rate_limiter
+        self.rate_limit = rate_limit
+        # as for rate_limit, a rate of 0 is no limit rather than a bucket that never refills
+        self.route_limits = {route: tuple(limit) for route, limit in route_limits.items() if limit[0] > 0}
+        self.concurrency_limiter = concurrency_limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        route = self.route_for(scope) if self.route_limits else None
+        limits = []
+        # the route bucket first, requests it rejects then do not use up the client's budget for other routes
+        if route is not None and route[0] in self.route_limits:
+            limits.append(("route", route[0]) + self.route_limits[route[0]])
+        if self.rate_limit[0] > 0:
+            limits.append(("client", "") + tuple(self.rate_limit))
+        if limits:
+            client = client_key(scope)
+            for limit, key, rate, burst in limits:
+                retry_after = await self.rate_limiter.take("%s:%s" % (client, key), rate, burst)
+                if retry_after > 0:
+                    metrics.rate_limited_total.inc(self.labels(scope, route) + (limit,))
+                    await self.reject(scope, receive, send, 429, "Too many requests, please slow down", retry_after)
+                    return
+        if self.concurrency_limiter is None:
+            await self.app(scope, receive, send)
+            return
+        rejected = await self.concurrency_limiter.acquire()
+        if rejected is not None:
+            self.observe()
+            metrics.shed_total.inc(self.labels(scope, route) + (rejected,))
+            await self.reject(scope, receive, send, 503, "Server is busy, please retry", 1)
+            return
+        self.observe()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.concurrency_limiter.release()
+            self.observe()
+
+    def route_for(self, scope):
+        # the router only runs after admission, match the path template the same way it will
+        for route in self.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return "%s %s" % (scope["method"], route.path), child_scope.get("endpoint")
+        return None
+
+    def labels(self, scope, route):
+        if route is None:
+            route = self.route_for(scope)
+        if route is not None:
+            # lets the metrics middleware label the rejection with the route it was meant for
+            scope["endpoint"] = route[1]
+        return scope["method"], (route[0].partition(" ")[2] if route is not None else metrics.UNMATCHED_ROUTE)
+
+    def observe(self):
+        metrics.requests_in_flight.set((), self.concurrency_limiter.active)
+        metrics.requests_queued.set((), self.concurrency_limiter.queued)
+
+    @staticmethod
+    async def reject(scope, receive, send, status_code: int, detail: str, retry_after: float):
+        response = JSONResponse(status_code=status_code, content={"detail": detail},
+                                headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+        await response(scope, receive, send)
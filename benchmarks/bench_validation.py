@@ -0,0 +1,56 @@
+"""[Microbenchmark of validation.py against the validators it replaced]
+
+Run from the repository root with python -m benchmarks.bench_validation
+"""
+import re
+import timeit
+
+from validation import classify, validate_email, validate_many, validate_phonenumber
+
+PARAMS = ["someone.else@example.com", "9876543210", "+91 98765-43210", "not-an-email@", "12345"] * 200
+REPEAT = 5
+NUMBER = 20
+
+
+def legacy_validate_email(email: str):
+    Pattern = '^(\w|\.|\_|\-)+[@](\w|\_|\-|\.)+[.]\w{2,3}$'
+    return re.search(Pattern, email)
+
+
+def legacy_validate_phonenumber(phonenumber: str):
+    Pattern = re.compile("(0/91)?[7-9][0-9]{9}")
+    return Pattern.match(phonenumber)
+
+
+def legacy_classify_all():
+    # how main.py used to tell emails from phone numbers, one pattern after the other
+    return [legacy_validate_email(param) or legacy_validate_phonenumber(param) for param in PARAMS]
+
+
+def validators_all():
+    return [validate_email(param) or validate_phonenumber(param) for param in PARAMS]
+
+
+def classify_all():
+    return [classify(param) for param in PARAMS]
+
+
+def validate_many_all():
+    return validate_many(PARAMS)
+
+
+def best_per_param(function):
+    return min(timeit.repeat(function, repeat=REPEAT, number=NUMBER)) / (NUMBER * len(PARAMS))
+
+
+def main():
+    timings = [(name, best_per_param(function)) for name, function in
+               [("legacy validators", legacy_classify_all), ("validators", validators_all),
+                ("classify", classify_all), ("validate_many", validate_many_all)]]
+    baseline = timings[0][1]
+    for name, seconds in timings:
+        print("%-20s %8.0f ns/param  %5.2fx" % (name, seconds * 1e9, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""[Clients the load generator drives the API with, in process over ASGI or over HTTP against a running server]"""
+import asyncio
+import http.client
+import json
+import threading
+from typing import NamedTuple, Optional
+from urllib.parse import urlencode
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    params: dict = {}
+    body: Optional[bytes] = None
+    content_type: str = "application/json"
+    headers: dict = {}
+
+    @classmethod
+    def json(cls, method: str, path: str, params: dict = {}, payload=None, headers: dict = {}):
+        return cls(method, path, params, None if payload is None else json.dumps(payload).encode(), headers=headers)
+
+    @property
+    def target(self):
+        return self.path + ("?" + urlencode(self.params) if self.params else "")
+
+
+class Response(NamedTuple):
+    status: int
+    headers: dict
+    body: bytes
+
+
+class ASGIClient:
+    """[Calls an ASGI application directly, no sockets or server in between, so timings are the application's own]
+
+    Args:
+        app (ASGIApp): [application, e.g. main.phonebook]
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, request: Request):
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request.method,
+            "scheme": "http",
+            "path": request.path,
+            "raw_path": request.path.encode(),
+            "query_string": urlencode(request.params).encode(),
+            "root_path": "",
+            "headers": [(b"host", b"benchmark"), (b"content-type", request.content_type.encode())]
+                       + [(key.lower().encode(), value.encode()) for key, value in request.headers.items()],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        completed = asyncio.Event()
+        sent_body = False
+        status = None
+        headers = {}
+        chunks = []
+
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {"type": "http.request", "body": request.body or b"", "more_body": False}
+            await completed.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers.update((key.decode().lower(), value.decode()) for key, value in message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    completed.set()
+
+        await self.app(scope, receive, send)
+        completed.set()
+        return Response(status, headers, b"".join(chunks))
+
+
+class HTTPClient:
+    """[Blocking HTTP/1.1 client keeping one keep-alive connection per thread, for driving a server from a thread pool]
+
+    Args:
+        host (str): [server host]
+        port (int): [server port]
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, request: Request):
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(self.host, self.port)
+            try:
+                connection.request(request.method, request.target, body=request.body,
+                                   headers=dict(request.headers, **{"Content-Type": request.content_type}))
+                reply = connection.getresponse()
+                return Response(reply.status, {key.lower(): value for key, value in reply.getheaders()}, reply.read())
+            except (ConnectionError, http.client.HTTPException):
+                # the server closed an idle keep-alive connection, reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
@@ -0,0 +1,93 @@
+"""[Summaries of a benchmark run, and their comparison against a saved JSON baseline]"""
+import json
+import math
+from typing import List, Optional
+
+PERCENTILES = (50, 95, 99)
+QUERY_SLACK = 0.1
+
+
+def percentile(sorted_values: List[float], percent: int):
+    # nearest rank, no interpolation, so it is always one of the measured latencies
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float, queries: Optional[int]):
+    """[Summarizes the requests of one scenario]
+
+    Args:
+        latencies (List[float]): [seconds per request]
+        errors (int): [requests answered with an unexpected status]
+        elapsed (float): [wall clock seconds for the scenario]
+        queries (Optional[int]): [SQL statements executed, None when they could not be counted]
+
+    Returns:
+        [dict]: [requests, errors, throughput (requests per second), latencies in milliseconds and queries per request]
+    """
+    latencies = sorted(latencies)
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+    }
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary["p%d_ms" % percent] = None if value is None else 1000 * value
+    summary["queries_per_request"] = None if queries is None or not latencies else queries / len(latencies)
+    return summary
+
+
+def format_table(results: dict):
+    lines = ["%-28s %8s %6s %10s %9s %9s %9s %8s" % ("scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries")]
+    for name, summary in results.items():
+        queries = summary["queries_per_request"]
+        lines.append("%-28s %8d %6d %10.1f %9.2f %9.2f %9.2f %8s" % (
+            name, summary["requests"], summary["errors"], summary["throughput"] or 0,
+            summary["p50_ms"] or 0, summary["p95_ms"] or 0, summary["p99_ms"] or 0,
+            "-" if queries is None else "%.1f" % queries))
+    return "\n".join(lines)
+
+
+def save(path: str, report: dict):
+    with open(path, "w") as baseline_file:
+        json.dump(report, baseline_file, indent=2, sort_keys=True)
+
+
+def load(path: str):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """[Finds scenarios that got slower than the baseline by more than tolerance]
+
+    A scenario regresses when its p95 latency grows, its throughput drops, or it runs more queries per request.
+
+    Args:
+        results (dict): [scenario summaries of this run]
+        baseline (dict): [saved report, as written by save]
+        tolerance (float): [allowed relative change, e.g. 0.2 for 20%]
+
+    Returns:
+        [List[str]]: [one line per regression, empty when there is none]
+    """
+    regressions = []
+    for name, summary in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        if before["p95_ms"] and summary["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append("%s: p95 %.2fms -> %.2fms" % (name, before["p95_ms"], summary["p95_ms"]))
+        if before["throughput"] and summary["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append("%s: throughput %.1f/s -> %.1f/s" % (name, before["throughput"], summary["throughput"]))
+        # query counts only vary with which requests miss the user cache, anything more is a change in the access pattern
+        if before["queries_per_request"] is not None and summary["queries_per_request"] is not None \
+                and summary["queries_per_request"] > before["queries_per_request"] + QUERY_SLACK:
+            regressions.append("%s: queries per request %.1f -> %.1f" % (name, before["queries_per_request"], summary["queries_per_request"]))
+        if summary["errors"] > before["errors"]:
+            regressions.append("%s: errors %d -> %d" % (name, before["errors"], summary["errors"]))
+    return regressions
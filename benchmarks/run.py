@@ -0,0 +1,244 @@
+"""[Load test of every endpoint in main.py against a freshly seeded database]
+
+Reports throughput, p50 / p95 / p99 latency and SQL statements per request for each scenario, and can save the report
+as a JSON baseline or compare against one. Run from the repository root:
+
+    python -m benchmarks.run --users 1000 --contacts 1000 --save baseline.json
+    python -m benchmarks.run --users 1000 --contacts 1000 --baseline baseline.json
+    python -m benchmarks.run --server uvicorn --workers 4 --concurrency 64
+
+By default requests go straight into the ASGI app in this process. With --server uvicorn the app is started in
+uvicorn worker processes by cli.py serve and driven over HTTP, which includes the server in the numbers. Queries are then
+taken from the Server-Timing header, which misses the statements of streamed bodies.
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import platform
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import report
+from .clients import ASGIClient, HTTPClient, Request
+from .scenarios import SCENARIOS, Workload
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_START_TIMEOUT = 30
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class QueryCounter:
+    """[Counts SQL statements sent through the engines, an executemany counts once]"""
+
+    def __init__(self, *engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, connection, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+async def run_asgi(app, scenarios, workload: Workload, requests: int, concurrency: int, counter: QueryCounter):
+    client = ASGIClient(app)
+    results = {}
+    await app.router.startup()
+    try:
+        for scenario in scenarios:
+            indexes = iter(range(requests))
+            latencies = []
+            errors = []
+
+            async def worker():
+                for index in indexes:
+                    request = scenario.build(workload, index)
+                    started = time.perf_counter()
+                    response = await client.request(request)
+                    latencies.append(time.perf_counter() - started)
+                    if response.status != 200:
+                        errors.append(response)
+
+            queries = counter.count
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+            results[scenario.name] = report.summarize(latencies, len(errors), elapsed, counter.count - queries)
+            report_errors(scenario.name, errors)
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+def run_http(client: HTTPClient, scenarios, workload: Workload, requests: int, concurrency: int):
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for scenario in scenarios:
+            indexes = itertools.count()
+
+            def worker():
+                latencies = []
+                errors = []
+                queries = 0
+                for index in indexes:
+                    if index >= requests:
+                        break
+                    request = scenario.build(workload, index)
+                    started = time.perf_counter()
+                    response = client.request(request)
+                    latencies.append(time.perf_counter() - started)
+                    queries += server_timing_queries(response)
+                    if response.status != 200:
+                        errors.append(response)
+                return latencies, errors, queries
+
+            started = time.perf_counter()
+            outcomes = list(executor.map(lambda _: worker(), range(concurrency)))
+            elapsed = time.perf_counter() - started
+            latencies = [latency for outcome in outcomes for latency in outcome[0]]
+            errors = [error for outcome in outcomes for error in outcome[1]]
+            queries = sum(outcome[2] for outcome in outcomes)
+            results[scenario.name] = report.summarize(latencies, len(errors), elapsed, queries)
+            report_errors(scenario.name, errors)
+    return results
+
+
+def server_timing_queries(response):
+    # statements counted by metrics.MetricsMiddleware until the response headers, streamed bodies may run more
+    match = SERVER_TIMING_QUERIES.search(response.headers.get("server-timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+def report_errors(name: str, errors):
+    if errors:
+        print("%s: %d unexpected responses, first: %d %s" % (name, len(errors), errors[0].status, errors[0].body[:200]),
+              file=sys.stderr)
+
+
+def start_server(port: int, workers: int):
+    with socket.socket() as probe:
+        # a server left on the port would answer the readiness check and get benchmarked in place of ours
+        if probe.connect_ex(("127.0.0.1", port)) == 0:
+            raise RuntimeError("Port %d is already in use, pick another with --port" % port)
+    server = subprocess.Popen([sys.executable, "cli.py", "serve", "--no-migrate", "--host", "127.0.0.1", "--port", str(port),
+                               "--workers", str(workers), "--log-level", "warning"], cwd=REPO_ROOT, env=dict(os.environ))
+    client = HTTPClient("127.0.0.1", port)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited with status %d" % server.returncode)
+        try:
+            if client.request(Request("GET", "/openapi.json")).status == 200:
+                return server, client
+        except OSError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("uvicorn did not start within %d seconds" % SERVER_START_TIMEOUT)
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def check_seed_size(scenarios, users: int, contacts_per_user: int, requests: int):
+    # contacts are taken round robin over the users, so each user gives at most one more batch than the average
+    needed = sum((math.ceil(requests / users) + 1) * scenario.contacts_per_request for scenario in scenarios)
+    if needed > contacts_per_user:
+        raise SystemExit("%d contacts per user needed for %d requests per scenario, seed more or send fewer" % (needed, requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every phonebook endpoint against a freshly seeded database")
+    parser.add_argument("--users", type=int, default=100, help="seeded users")
+    parser.add_argument("--contacts", type=int, default=1000, help="seeded contacts per user")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight")
+    parser.add_argument("--scenarios", help="comma separated scenario names, all by default")
+    parser.add_argument("--database-url", help="empty database to seed, a temporary sqlite file by default")
+    parser.add_argument("--server", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--port", type=int, default=8765, help="uvicorn port")
+    parser.add_argument("--save", help="write the report as a JSON baseline")
+    parser.add_argument("--baseline", help="compare against a JSON baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown tolerated against the baseline")
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        names = args.scenarios.split(",")
+        unknown = set(names) - {scenario.name for scenario in SCENARIOS}
+        if unknown:
+            raise SystemExit("Unknown scenarios: %s" % ", ".join(sorted(unknown)))
+        scenarios = [scenario for scenario in SCENARIOS if scenario.name in names]
+    check_seed_size(scenarios, args.users, args.contacts, args.requests)
+    spare_users = args.requests * sum(scenario.spare_users_per_request for scenario in scenarios)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # set before anything imports sql_app, its settings are read once at import
+        os.environ["DATABASE_URL"] = args.database_url or "sqlite:///%s" % os.path.join(directory, "bench.db")
+        # admin endpoints are disabled without a token, the uvicorn workers inherit it with the environment
+        os.environ.setdefault("ADMIN_TOKEN", secrets.token_urlsafe())
+        # the seeded token hashes and the workers must share the key
+        os.environ.setdefault("TOKEN_SECRET", secrets.token_urlsafe())
+        from sql_app import migrations
+        from sql_app.config import settings
+        from sql_app.database import engine, shards
+
+        from .seed import seed
+
+        for shard_engine in shards.engines:
+            migrations.migrate(shard_engine)
+        started = time.perf_counter()
+        seeded = seed(engine, args.users, args.contacts, spare_users)
+        print("seeded %d users and %d contacts in %.1fs" % (args.users + spare_users, seeded, time.perf_counter() - started))
+
+        import main as app_module
+
+        workload = Workload(args.users, args.contacts, spare_users, admin_token=settings.admin_token)
+        if args.server == "uvicorn":
+            for shard_engine in shards.engines:
+                shard_engine.dispose()
+            server, client = start_server(args.port, args.workers)
+            try:
+                results = run_http(client, scenarios, workload, args.requests, args.concurrency)
+            finally:
+                stop_server(server)
+        else:
+            counter = QueryCounter(*(shard_engine.sync_engine for shard_engine in shards.async_engines))
+            results = asyncio.run(run_asgi(app_module.phonebook, scenarios, workload, args.requests, args.concurrency, counter))
+
+    print(report.format_table(results))
+    run_report = {
+        "meta": {
+            "server": args.server, "workers": args.workers, "users": args.users, "contacts_per_user": args.contacts,
+            "requests": args.requests, "concurrency": args.concurrency, "dialect": engine.dialect.name,
+            "python": platform.python_version(), "platform": platform.platform(), "timestamp": time.time(),
+        },
+        "results": results,
+    }
+    if args.save:
+        report.save(args.save, run_report)
+    if args.baseline:
+        regressions = report.compare(results, report.load(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
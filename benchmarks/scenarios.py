@@ -0,0 +1,252 @@
+"""[One scenario per endpoint of main.py, each building the next request against a database laid out by benchmarks.seed]
+
+Scenarios that modify contacts take contacts nobody has touched yet, and scenarios that rename or delete a user or
+replace their token take a spare user, so every request of a run succeeds. Each run needs a freshly seeded database.
+"""
+import itertools
+import threading
+from typing import Callable, NamedTuple
+
+from .clients import Request
+from .seed import contact_email, contact_phonenumber, user_email, user_phonenumber, user_token
+
+BATCH_SIZE = 50
+BULK_SIZE = 100
+
+
+class Workload:
+    """[Hands out seeded users and unused contacts to scenarios, safe to share between threads]
+
+    Args:
+        users (int): [regular seeded users]
+        contacts_per_user (int): [contacts of every regular user]
+        spare_users (int): [seeded spare users, they follow the regular ones]
+        admin_token (str): [token for the admin endpoints]
+    """
+
+    def __init__(self, users: int, contacts_per_user: int, spare_users: int, admin_token: str):
+        self.users = users
+        self.contacts_per_user = contacts_per_user
+        self.spare_users = spare_users
+        self.admin_token = admin_token
+        self._lock = threading.Lock()
+        self._used_contacts = [0] * users
+        self._next_user = 0
+        # next() on itertools.count is atomic, no lock needed for plain counters
+        self._spares = itertools.count()
+        self._new = itertools.count()
+
+    def user(self, index: int):
+        return index % self.users
+
+    def contacts(self, count: int):
+        """[Takes count contacts of one user that no earlier request has used, moving round robin over the users]
+
+        Raises:
+            RuntimeError: [the seeded contacts are used up]
+
+        Returns:
+            [Tuple[int, List[int]]]: [user index and contact indexes]
+        """
+        with self._lock:
+            user_index = self._next_user
+            self._next_user = (user_index + 1) % self.users
+            first = self._used_contacts[user_index]
+            if first + count > self.contacts_per_user:
+                raise RuntimeError("Seeded contacts used up, seed more contacts per user or send fewer requests")
+            self._used_contacts[user_index] = first + count
+        return user_index, list(range(first, first + count))
+
+    def spare_user(self):
+        slot = next(self._spares)
+        if slot >= self.spare_users:
+            raise RuntimeError("Spare users used up, seed more spare users or send fewer requests")
+        return self.users + slot
+
+    def new_id(self):
+        return next(self._new)
+
+
+def auth(user_index: int):
+    return {"Authorization": "Bearer " + user_token(user_index)}
+
+
+def users_path(user_index: int, suffix: str):
+    return "/users/%s/%s" % (user_email(user_index), suffix)
+
+
+def create_user(workload: Workload, index: int):
+    new_id = workload.new_id()
+    return Request.json("POST", "/users/addUser/", payload={
+        "name": "New %d" % new_id, "email": "new%d@bench.example.com" % new_id, "phonenumber": str(9000000000 + new_id)})
+
+
+def get_user(workload: Workload, index: int):
+    user_index = workload.user(index)
+    return Request("GET", users_path(user_index, ""), headers=auth(user_index))
+
+
+def premium_get_user(workload: Workload, index: int):
+    return Request("GET", "/premiumUser/getUser/%s" % user_phonenumber(workload.user(index)),
+                   {"premium_user_param": user_email(0)}, headers=auth(0))
+
+
+def lookup_users(workload: Workload, index: int):
+    # a contact sync, registered users by phone number mixed with contacts nobody registered
+    user_indexes = [workload.user(index + offset) for offset in range(BATCH_SIZE // 2)]
+    params = [user_phonenumber(user_index) for user_index in user_indexes]
+    params += [contact_phonenumber(contact_index) for contact_index in range(BATCH_SIZE - len(params))]
+    return Request.json("POST", "/premiumUser/lookup", {"premium_user_param": user_email(0)}, {"params": params},
+                        headers=auth(0))
+
+
+def add_contact(workload: Workload, index: int):
+    user_index = workload.user(index)
+    new_id = workload.new_id()
+    return Request.json("POST", users_path(user_index, "addContact/"), {}, {
+        "name": "Added %d" % new_id, "email": "a%d.u%d@bench.example.com" % (new_id, user_index),
+        "phonenumber": str(9000000000 + new_id)}, headers=auth(user_index))
+
+
+def bulk_contacts(workload: Workload, index: int):
+    user_index = workload.user(index)
+    new_id = workload.new_id()
+    return Request.json("POST", users_path(user_index, "contacts/bulk"), {}, [
+        {"name": "Bulk %d" % position, "email": "b%d.%d.u%d@bench.example.com" % (new_id, position, user_index),
+         "phonenumber": str(9000000000 + position)}
+        for position in range(BULK_SIZE)], headers=auth(user_index))
+
+
+def list_contacts(workload: Workload, index: int):
+    user_index = workload.user(index)
+    return Request("GET", users_path(user_index, "contacts"), {"limit": 100}, headers=auth(user_index))
+
+
+def export_contacts(workload: Workload, index: int):
+    user_index = workload.user(index)
+    return Request("GET", users_path(user_index, "contacts/export"), {"format": "ndjson"}, headers=auth(user_index))
+
+
+def search_contacts(workload: Workload, index: int):
+    user_index = workload.user(index)
+    return Request("GET", users_path(user_index, "contacts/search"), {"q": "c%d" % (index % 100)},
+                   headers=auth(user_index))
+
+
+def contact_changes(workload: Workload, index: int):
+    # a client that synced after seeding, every seeded contact has version 0 and is older than its cursor
+    user_index = workload.user(index)
+    return Request("GET", users_path(user_index, "contacts/changes"), {"since": "1-0"}, headers=auth(user_index))
+
+
+def update_user_email(workload: Workload, index: int):
+    user_index = workload.spare_user()
+    return Request("PUT", "/users/%s/updateUserEmail/" % user_phonenumber(user_index),
+                   {"update_param": "renamed%d@bench.example.com" % user_index}, headers=auth(user_index))
+
+
+def update_user_phonenumber(workload: Workload, index: int):
+    user_index = workload.spare_user()
+    return Request("PUT", users_path(user_index, "updateUserPhonenumber/"),
+                   {"update_param": str(7500000000 + user_index)}, headers=auth(user_index))
+
+
+def update_contact_email(workload: Workload, index: int):
+    user_index, (contact_index,) = workload.contacts(1)
+    email = contact_email(user_index, contact_index)
+    return Request("PUT", users_path(user_index, "updateContactEmail"),
+                   {"email": email, "newmail": "x" + email}, headers=auth(user_index))
+
+
+def update_contact_phonenumber(workload: Workload, index: int):
+    user_index, (contact_index,) = workload.contacts(1)
+    phonenumber = contact_phonenumber(contact_index)
+    return Request("PUT", users_path(user_index, "updateContactPhonenumber"),
+                   {"phonenumber": phonenumber, "newphonenumber": "9" + phonenumber[1:]}, headers=auth(user_index))
+
+
+def update_contact_emails(workload: Workload, index: int):
+    user_index, contact_indexes = workload.contacts(BATCH_SIZE)
+    emails = [contact_email(user_index, contact_index) for contact_index in contact_indexes]
+    return Request.json("PUT", users_path(user_index, "updateContactEmails"), {},
+                        {"changes": [{"old": email, "new": "x" + email} for email in emails]}, headers=auth(user_index))
+
+
+def update_contact_phonenumbers(workload: Workload, index: int):
+    user_index, contact_indexes = workload.contacts(BATCH_SIZE)
+    phonenumbers = [contact_phonenumber(contact_index) for contact_index in contact_indexes]
+    return Request.json("PUT", users_path(user_index, "updateContactPhonenumbers"), {},
+                        {"changes": [{"old": phonenumber, "new": "9" + phonenumber[1:]} for phonenumber in phonenumbers]},
+                        headers=auth(user_index))
+
+
+def delete_contact(workload: Workload, index: int):
+    user_index, (contact_index,) = workload.contacts(1)
+    return Request("DELETE", users_path(user_index, "deleteUserContact"),
+                   {"contact_param": contact_email(user_index, contact_index)}, headers=auth(user_index))
+
+
+def delete_contacts(workload: Workload, index: int):
+    user_index, contact_indexes = workload.contacts(BATCH_SIZE)
+    return Request.json("DELETE", users_path(user_index, "deleteUserContacts"), {},
+                        {"contact_params": [contact_email(user_index, contact_index) for contact_index in contact_indexes]},
+                        headers=auth(user_index))
+
+
+def make_premium_user(workload: Workload, index: int):
+    return Request("POST", "/admin/%s/premiumUser" % user_email(workload.user(index)), headers={"Authorization": "Bearer " + workload.admin_token})
+
+
+def rotate_token(workload: Workload, index: int):
+    user_index = workload.spare_user()
+    return Request("POST", users_path(user_index, "rotateToken"), headers=auth(user_index))
+
+
+def revoke_token(workload: Workload, index: int):
+    user_index = workload.spare_user()
+    return Request("DELETE", users_path(user_index, "revokeToken"), headers=auth(user_index))
+
+
+def issue_token(workload: Workload, index: int):
+    return Request("POST", "/admin/%s/rotateToken" % user_email(workload.spare_user()),
+                   headers={"Authorization": "Bearer " + workload.admin_token})
+
+
+def delete_user(workload: Workload, index: int):
+    user_index = workload.spare_user()
+    return Request("DELETE", users_path(user_index, "deleteUser/"), headers=auth(user_index))
+
+
+class Scenario(NamedTuple):
+    name: str
+    build: Callable[[Workload, int], Request]
+    contacts_per_request: int = 0
+    spare_users_per_request: int = 0
+
+
+# run in this order, reads before the writes that would change what they read
+SCENARIOS = [
+    Scenario("get_user", get_user),
+    Scenario("premium_get_user", premium_get_user),
+    Scenario("lookup_users", lookup_users),
+    Scenario("list_contacts", list_contacts),
+    Scenario("search_contacts", search_contacts),
+    Scenario("export_contacts", export_contacts),
+    Scenario("contact_changes", contact_changes),
+    Scenario("create_user", create_user),
+    Scenario("add_contact", add_contact),
+    Scenario("bulk_contacts", bulk_contacts),
+    Scenario("update_contact_email", update_contact_email, contacts_per_request=1),
+    Scenario("update_contact_phonenumber", update_contact_phonenumber, contacts_per_request=1),
+    Scenario("update_contact_emails", update_contact_emails, contacts_per_request=BATCH_SIZE),
+    Scenario("update_contact_phonenumbers", update_contact_phonenumbers, contacts_per_request=BATCH_SIZE),
+    Scenario("delete_contact", delete_contact, contacts_per_request=1),
+    Scenario("delete_contacts", delete_contacts, contacts_per_request=BATCH_SIZE),
+    Scenario("make_premium_user", make_premium_user),
+    Scenario("update_user_email", update_user_email, spare_users_per_request=1),
+    Scenario("update_user_phonenumber", update_user_phonenumber, spare_users_per_request=1),
+    Scenario("rotate_token", rotate_token, spare_users_per_request=1),
+    Scenario("revoke_token", revoke_token, spare_users_per_request=1),
+    Scenario("issue_token", issue_token, spare_users_per_request=1),
+    Scenario("delete_user", delete_user, spare_users_per_request=1),
+]
@@ -0,0 +1,121 @@
+"""[Seeds a phonebook database with deterministic users and contacts for benchmarking]
+
+Run from the repository root, e.g. to seed one million contacts:
+    python -m benchmarks.seed --database-url sqlite:///./bench.db --users 1000 --contacts 1000
+"""
+import argparse
+import os
+import time
+
+BENCH_DOMAIN = "bench.example.com"
+SPARE_CONTACTS = 10
+
+
+# every seeded row is derived from its index, so the load generator can address any user or contact without a lookup
+
+def user_email(user_index: int):
+    return "user%d@%s" % (user_index, BENCH_DOMAIN)
+
+
+def user_phonenumber(user_index: int):
+    return str(7000000000 + user_index)
+
+
+def user_token(user_index: int):
+    return "bench%d" % user_index
+
+
+def contact_email(user_index: int, contact_index: int):
+    return "c%d.u%d@%s" % (contact_index, user_index, BENCH_DOMAIN)
+
+
+def contact_phonenumber(contact_index: int):
+    return str(8000000000 + contact_index)
+
+
+def user_rows(first: int, count: int):
+    return [{"name": "User %d" % index, "email": user_email(index), "phonenumber": user_phonenumber(index),
+             "premium": index == 0, "token": user_token(index)}
+            for index in range(first, first + count)]
+
+
+def contact_rows(user_index: int, owner_id: int, count: int):
+    return [{"name": "Contact %d" % contact_index, "email": contact_email(user_index, contact_index),
+             "phonenumber": contact_phonenumber(contact_index), "owner_id": owner_id}
+            for contact_index in range(count)]
+
+
+def seed(engine, users: int, contacts_per_user: int, spare_users: int = 0, chunk_size: int = 10000):
+    """[Inserts users 0..users-1 with contacts_per_user contacts each, then spare_users users with SPARE_CONTACTS each]
+
+    Spare users follow the regular ones and are meant to be consumed once, by scenarios that rename or delete a user.
+    User 0 is premium. The database must be migrated and empty.
+
+    Args:
+        engine (Engine): [sync engine]
+        users (int): [regular users]
+        contacts_per_user (int): [contacts of every regular user]
+        spare_users (int, optional): [users consumed by destructive scenarios]. Defaults to 0.
+        chunk_size (int, optional): [rows per executemany]. Defaults to 10000.
+
+    Raises:
+        RuntimeError: [the database already has users]
+
+    Returns:
+        [int]: [contacts inserted]
+    """
+    # imported here so callers can point DATABASE_URL at the benchmark database before sql_app reads its settings
+    from sqlalchemy import func, insert, select
+
+    from sql_app import migrations, models
+    from sql_app.tokens import hash_token
+
+    inserted = 0
+    with engine.begin() as connection:
+        if connection.execute(select(func.count()).select_from(models.User.__table__)).scalar():
+            raise RuntimeError("Refusing to seed a database that already has users")
+        for first in range(0, users + spare_users, chunk_size):
+            rows = user_rows(first, min(chunk_size, users + spare_users - first))
+            connection.execute(insert(models.User.__table__), [dict(row, token=hash_token(row["token"])) for row in rows])
+        # ids are read back rather than assumed, sequences need not start at 1
+        owner_ids = dict(connection.execute(select(models.User.email, models.User.id)).fetchall())
+        # every seeded user lives on shard 0, `python cli.py reshard` spreads them over further shards
+        connection.execute(insert(models.UserShard.__table__),
+                           [{"user_id": owner_ids[user_email(index)], "email": user_email(index),
+                             "phonenumber": user_phonenumber(index), "shard": 0, "moving": False}
+                            for index in range(users + spare_users)])
+        migrations.sync_user_id_sequence(connection)
+        pending = []
+        for user_index in range(users + spare_users):
+            count = contacts_per_user if user_index < users else SPARE_CONTACTS
+            pending.extend(contact_rows(user_index, owner_ids[user_email(user_index)], count))
+            if len(pending) >= chunk_size:
+                connection.execute(insert(models.Contact.__table__), pending)
+                inserted += len(pending)
+                pending = []
+        if pending:
+            connection.execute(insert(models.Contact.__table__), pending)
+            inserted += len(pending)
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a phonebook database for benchmarking")
+    parser.add_argument("--database-url", required=True, help="database to seed, must be empty")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--contacts", type=int, default=1000, help="contacts per user")
+    parser.add_argument("--spare-users", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url
+    from sql_app import migrations
+    from sql_app.database import engine
+
+    migrations.migrate(engine)
+    started = time.perf_counter()
+    inserted = seed(engine, args.users, args.contacts, args.spare_users)
+    print("seeded %d users and %d contacts in %.1fs" % (args.users + args.spare_users, inserted, time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
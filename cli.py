@@ -0,0 +1,172 @@
+import asyncio
+import os
+
+import click
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+APP = "main:phonebook"
+
+
+class GracefulServer(uvicorn.Server):
+    """[uvicorn server that drains in flight requests on shutdown for at most graceful_timeout seconds]
+
+    uvicorn stops accepting connections on SIGTERM / SIGINT and then waits for open ones without a limit,
+    so a single stuck client would hold up a rolling deploy.
+
+    Args:
+        config (uvicorn.Config): [server config]
+        graceful_timeout (float): [seconds to wait for in flight requests before closing them]
+    """
+
+    def __init__(self, config: uvicorn.Config, graceful_timeout: float):
+        super().__init__(config)
+        self.graceful_timeout = graceful_timeout
+
+    def handle_exit(self, sig, frame):
+        # a signal sent to the whole process group reaches workers twice, once more from Supervisor, neither forces exit
+        self.should_exit = True
+
+    async def shutdown(self, sockets=None):
+        timer = asyncio.get_event_loop().call_later(self.graceful_timeout, setattr, self, "force_exit", True)
+        try:
+            await super().shutdown(sockets=sockets)
+        finally:
+            timer.cancel()
+
+
+class Supervisor(Multiprocess):
+    """[uvicorn's worker supervisor, also stopping the workers when only the parent process is signalled]
+
+    uvicorn relies on SIGTERM / SIGINT reaching the whole process group and otherwise waits for its workers forever.
+    """
+
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+        super().shutdown()
+
+
+@click.group()
+def cli():
+    """Phonebook management commands, run from the repository root."""
+
+
+@cli.command()
+def migrate():
+    """Apply pending database migrations once to every shard, e.g. before starting or rolling out workers."""
+    from sql_app import migrations
+    from sql_app.database import shards
+
+    for shard, shard_engine in enumerate(shards.engines):
+        applied = migrations.migrate(shard_engine)
+        click.echo("shard %d: %s" % (shard, "applied migrations %s" % applied if applied else "database schema is up to date"))
+
+
+@cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    """Delete Idempotency-Key records older than IDEMPOTENCY_KEY_TTL, e.g. from a daily cron job."""
+    from sql_app import idempotency
+    from sql_app.config import settings
+    from sql_app.database import shards
+
+    purged = 0
+    for shard_engine in shards.engines:
+        with shard_engine.begin() as connection:
+            purged += idempotency.purge(connection, settings.idempotency_key_ttl)
+    click.echo("purged %d idempotency keys" % purged)
+
+
+@cli.command("purge-tombstones")
+def purge_tombstones():
+    """Delete deleted contacts' tombstones older than TOMBSTONE_RETENTION, e.g. from a daily cron job."""
+    from sql_app import tombstones
+    from sql_app.config import settings
+    from sql_app.database import shards
+
+    purged = 0
+    for shard_engine in shards.engines:
+        with shard_engine.begin() as connection:
+            purged += tombstones.purge(connection, settings.tombstone_retention)
+    click.echo("purged %d tombstones" % purged)
+
+
+@cli.command()
+@click.option("--user", "params", multiple=True, help="email or phone number of a user to move, repeatable, "
+                                                       "every user not on the shard their id is placed on by default")
+@click.option("--to", "target", type=int, default=None,
+              help="shard to move --user users to, their placement by default, a later run without --user moves them back")
+@click.option("--batch-size", default=500, show_default=True, help="users moved together")
+@click.option("--wait", type=float, default=None, help="seconds for workers to notice a move, CACHE_TTL by default")
+@click.option("--dry-run", is_flag=True, help="only list the moves")
+def reshard(params, target, batch_size, wait, dry_run):
+    """Move users between shards while the api keeps serving, e.g. after adding a database to SHARD_URLS."""
+    import logging
+
+    from sqlalchemy import or_, select
+
+    from sql_app import migrations, models, resharding
+    from sql_app.config import settings
+    from sql_app.database import shards
+    from validation import ParamType, canonical_param
+
+    for shard, shard_engine in enumerate(shards.engines):
+        if migrations.pending(shard_engine):
+            raise click.ClickException("shard %d is missing migrations, run `python cli.py migrate` first" % shard)
+    if target is not None and not 0 <= target < len(shards):
+        raise click.ClickException("there are %d shards, --to must be below that" % len(shards))
+    with shards.engines[0].connect() as directory:
+        if not params:
+            moves = resharding.misplaced_users(directory)
+        else:
+            moves = []
+            for param in params:
+                param_type, value = canonical_param(param)
+                location = directory.execute(select(models.UserShard.user_id, models.UserShard.shard)
+                                             .where(or_(models.UserShard.email == value,
+                                                        models.UserShard.phonenumber == value))).first()
+                if param_type is ParamType.INVALID or location is None:
+                    raise click.ClickException("no user registered %s" % param)
+                new_shard = shards.placement(location.user_id) if target is None else target
+                moves.append(resharding.Move(location.user_id, location.shard, new_shard))
+    for move in moves:
+        click.echo("user %d: shard %d -> %d" % move)
+    if dry_run:
+        return
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    moved = resharding.move_users(moves, settings.cache_ttl if wait is None else wait, batch_size)
+    removed = resharding.remove_strays()
+    click.echo("moved %d users, removed %d stray copies" % (moved, removed))
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True, help="worker processes")
+@click.option("--limit-concurrency", type=int, default=None, help="requests in flight per worker before answering 503")
+@click.option("--limit-max-requests", type=int, default=None, help="requests after which a worker restarts")
+@click.option("--backlog", default=2048, show_default=True, help="connections queued by the kernel while workers are busy")
+@click.option("--timeout-keep-alive", default=5, show_default=True, help="seconds an idle keep-alive connection stays open")
+@click.option("--graceful-timeout", default=30.0, show_default=True, help="seconds to drain in flight requests on shutdown")
+@click.option("--log-level", default="info", show_default=True)
+@click.option("--migrate/--no-migrate", "run_migrations", default=True, show_default=True,
+              help="apply pending migrations once before the workers start")
+def serve(host, port, workers, limit_concurrency, limit_max_requests, backlog, timeout_keep_alive, graceful_timeout, log_level,
+          run_migrations):
+    """Serve the API with several uvicorn worker processes sharing one socket."""
+    if run_migrations:
+        migrate.callback()
+    # workers only check the schema, so they neither repeat nor race the migration
+    os.environ["AUTO_MIGRATE"] = "false"
+    config = uvicorn.Config(APP, host=host, port=port, workers=workers, limit_concurrency=limit_concurrency,
+                            limit_max_requests=limit_max_requests, backlog=backlog, timeout_keep_alive=timeout_keep_alive,
+                            log_level=log_level)
+    server = GracefulServer(config, graceful_timeout)
+    if config.workers > 1:
+        Supervisor(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    cli()
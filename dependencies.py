@@ -0,0 +1,228 @@
+import json
+import math
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from sql_app import crud, tokens
+from sql_app.config import settings
+from sql_app.cache import CachedUser, create_cache
+from sql_app.database import AsyncSessionLocal, shard_session, shards
+from validation import ParamType, canonical_param
+
+MAX_BULK_CONTACTS = 10000
+# users who wrote within the replica lag bound, the replicas may not have their writes yet
+recent_writers = create_cache(settings.cache_url, ttl=max(1, math.ceil(settings.replica_max_lag_ms / 1000)))
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db(db: AsyncSession = Depends(get_db)):
+    """[Session on a healthy replica of shard 0 for handlers that only read, the request's own session without one]
+
+    Args:
+        db (AsyncSession, optional): [shard 0 session]. Defaults to Depends(get_db).
+
+    Yields:
+        [AsyncSession]: [session reads of shard 0 go to]
+    """
+    async with shard_session(db, 0, readonly=True) as read_db:
+        yield read_db
+
+
+async def resolve_user(db: AsyncSession, param: str, invalid_detail: str = "Invalid Parameter, Please use a valid email or phone number",
+                       not_found_detail: str = "User not found"):
+    """[Classifies param as an email or a phone number once and fetches the user from the cache, or with a single indexed query]
+
+    Args:
+        db (AsyncSession): [database session]
+        param (str): [email or phone number]
+        invalid_detail (str, optional): [400 detail when param is neither an email nor a phone number]
+        not_found_detail (str, optional): [404 detail when no user matches param]
+
+    Raises:
+        HTTPException: [400, Invalid Parameter, Please use a valid email or phone number]
+        HTTPException: [404, User not found]
+
+    Returns:
+        [cache.CachedUser]: [user matching param]
+    """
+    param_type, value = canonical_param(param)
+    if param_type is ParamType.INVALID:
+        raise HTTPException(status_code=400, detail=invalid_detail)
+    db_user = await crud.get_cached_user_by_param(db=db, param=value, is_email=param_type is ParamType.EMAIL)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    return db_user
+
+
+def bearer_token(authorization: Optional[str], fallback: Optional[str]):
+    """[Token from an Authorization: Bearer header, or from the deprecated query parameter]
+
+    Args:
+        authorization (Optional[str]): [Authorization header]
+        fallback (Optional[str]): [token query parameter, tokens in urls end up in access logs]
+
+    Returns:
+        [Optional[str]]: [token, None when neither carries one]
+    """
+    if authorization:
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            return token.strip()
+    return fallback
+
+
+async def get_current_user(param: str, token: Optional[str] = None, authorization: Optional[str] = Header(None),
+                           db: AsyncSession = Depends(get_db)):
+    """[Resolves the user identified by param and verifies the token against it]
+
+    Args:
+        param (str): [email or phone number]
+        token (Optional[str], optional): [authorization token, deprecated in favour of the header]. Defaults to None.
+        authorization (Optional[str], optional): [Bearer token]. Defaults to Header(None).
+        db (AsyncSession, optional): [database dependency]. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: [400, Invalid Parameter, Please use a valid email or phone number]
+        HTTPException: [404, User not found]
+        HTTPException: [401, Unauthorized action]
+
+    Returns:
+        [cache.CachedUser]: [authorized user]
+    """
+    db_user = await resolve_user(db, param)
+    if not await tokens.verify_token(db_user, bearer_token(authorization, token)):
+        raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
+    return db_user
+
+
+async def get_premium_user(premium_user_param: str, premium_user_token: Optional[str] = None,
+                           authorization: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """[Resolves the premium user identified by premium_user_param and verifies the premium token]
+
+    Args:
+        premium_user_param (str): [email or phone number of premium user]
+        premium_user_token (Optional[str], optional): [premium user token, deprecated in favour of the header]. Defaults to None.
+        authorization (Optional[str], optional): [Bearer token of the premium user]. Defaults to Header(None).
+        db (AsyncSession, optional): [database dependency]. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: [400, Invalid Parameter, Please use a valid email or phone number for premium user]
+        HTTPException: [404, Premium user not found]
+        HTTPException: [401, Unauthorized action, only premium users allowed]
+        HTTPException: [401, Invalid token for the premium user]
+
+    Returns:
+        [cache.CachedUser]: [authorized premium user]
+    """
+    db_user = await resolve_user(db, premium_user_param,
+                                 invalid_detail="Invalid Parameter, Please use a valid premium user email or premium user phone number",
+                                 not_found_detail="No premium user not found by given parameter")
+    if db_user.premium == False:
+        raise HTTPException(status_code=401, detail="Unauthorized access, only premium users allowed")
+    if not await tokens.verify_token(db_user, bearer_token(authorization, premium_user_token)):
+        raise HTTPException(status_code=401, detail="Invalid token for the premium user")
+    return db_user
+
+
+async def get_owner_db(request: Request, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """[Session on the shard of the user resolved from param, the request's own session when that is shard 0.
+    GET requests read from a replica of the shard if it has a healthy one, unless the user wrote within the replica lag bound]
+
+    Args:
+        request (Request): [incoming request]
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [shard 0 session]. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: [503, the user is being moved to another shard, only reads are served]
+
+    Yields:
+        [AsyncSession]: [session on the user's shard]
+    """
+    writes = request.method != "GET"
+    replicated = bool(shards.replicas[db_user.shard])
+    writer_key = "writer:%d" % db_user.id
+    if writes:
+        check_writable(db_user)
+        if replicated:
+            await recent_writers.set(writer_key, 1)
+    # a user being moved may not be on the target shard's replicas yet
+    readonly = not writes and replicated and not db_user.moving and await recent_writers.get(writer_key) is None
+    async with shard_session(db, db_user.shard, readonly=readonly) as owner_db:
+        yield owner_db
+    if writes and replicated:
+        # counted from the commit, the request may have taken a while
+        await recent_writers.set(writer_key, 1)
+
+
+def check_writable(db_user: CachedUser):
+    if db_user.moving:
+        # the move takes about twice the cache ttl, see sql_app/resharding.py
+        raise HTTPException(status_code=503, detail="User is being moved, please retry later",
+                            headers={"Retry-After": str(settings.cache_ttl)})
+
+
+def verify_admin(admin_token: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """[Verifies the admin token against settings.admin_token, admin endpoints are disabled while it is empty]
+
+    Args:
+        admin_token (Optional[str], optional): [admin token, deprecated in favour of the header]. Defaults to None.
+        authorization (Optional[str], optional): [Bearer admin token]. Defaults to Header(None).
+
+    Raises:
+        HTTPException: [401, Unauthorized access, please provide valid admin token]
+    """
+    token = bearer_token(authorization, admin_token)
+    if not settings.admin_token or not token or not tokens.matches(token, settings.admin_token):
+        raise HTTPException(status_code=401, detail="Unauthorized access, please provide valid admin token")
+
+
+async def get_bulk_contacts_payload(request: Request):
+    """[Reads a bulk contact upload, either a JSON array or an NDJSON stream (Content-Type: application/x-ndjson)]
+
+    Args:
+        request (Request): [incoming request]
+
+    Raises:
+        HTTPException: [400, body is not a JSON array or valid NDJSON]
+        HTTPException: [413, more than MAX_BULK_CONTACTS contacts]
+
+    Returns:
+        [list]: [raw contact items, validated later one by one]
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = []
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    items.append(_parse_ndjson_line(line))
+            if len(items) > MAX_BULK_CONTACTS:
+                break
+        if buffer.strip():
+            items.append(_parse_ndjson_line(buffer))
+    else:
+        try:
+            items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid body, please provide a JSON array of contacts")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Invalid body, please provide a JSON array of contacts")
+    if len(items) > MAX_BULK_CONTACTS:
+        raise HTTPException(status_code=413, detail="Too many contacts, at most %d per request" % MAX_BULK_CONTACTS)
+    return items
+
+
+def _parse_ndjson_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid NDJSON line, please provide one JSON contact per line")
@@ -1,32 +1,215 @@
+import asyncio
+import csv
+import io
 from typing import List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import metrics
+from admission import AdmissionMiddleware, ConcurrencyLimiter, create_rate_limiter
+from dependencies import (MAX_BULK_CONTACTS, check_writable, get_bulk_contacts_payload, get_current_user, get_db, get_owner_db,
+                          get_premium_user, get_read_db, resolve_user, verify_admin)
+from responses import JSONResponse, dumps
+from sql_app import crud, idempotency, migrations, models, schemas, search
+from sql_app.bloom import registered_users
+from sql_app.cache import CachedUser
+from sql_app.config import settings
+from sql_app.database import AsyncSessionLocal, async_engine, engine, prewarm_pool, shard_session, shards
+from sql_app.group_commit import GroupCommitter
+from sql_app.unit_of_work import commit, commit_all, rollback
+from validation import ParamType, canonical_param, normalize_phonenumber, validate_email, validate_many
+
+phonebook = FastAPI(default_response_class=JSONResponse)
+# added first so it runs inside the metrics middleware, which then records rejected requests too
+phonebook.add_middleware(AdmissionMiddleware, routes=phonebook.routes, rate_limiter=create_rate_limiter(settings.rate_limit_url),
+                         rate_limit=(settings.rate_limit_rate, settings.rate_limit_burst), route_limits=settings.rate_limit_routes,
+                         concurrency_limiter=(ConcurrencyLimiter(settings.max_concurrent_requests, settings.max_queued_requests,
+                                                                 settings.queue_timeout_ms / 1000)
+                                              if settings.max_concurrent_requests else None))
+phonebook.add_middleware(metrics.MetricsMiddleware, routes=phonebook.routes)
+MAX_PAGE_SIZE = 1000
+MAX_SEARCH_RESULTS = 100
+MAX_INCLUDED_CONTACTS = MAX_PAGE_SIZE
+# responses are per user, clients may keep them but must revalidate them with their ETag before reuse
+CACHE_CONTROL = "private, no-cache"
+# single contact inserts of concurrent requests share transactions when GROUP_COMMIT_MS is set, one batch per shard
+group_committers = ([GroupCommitter(session_factory, settings.group_commit_ms / 1000, settings.group_commit_max_batch)
+                     for session_factory in shards.session_factories]
+                    if settings.group_commit_ms else None)
+
+
+async def user_response(db: AsyncSession, db_user: models.User, include: Optional[str]):
+    """[Serializes a user row, with its first MAX_INCLUDED_CONTACTS contacts when include is contacts]
 
-from sql_app import crud, models, schemas
-from sql_app.database import SessionLocal, engine
-from validation import validate_email, validate_phonenumber
+    Args:
+        db (AsyncSession): [database session]
+        db_user (models.User): [user row]
+        include (Optional[str]): [contacts to embed the user's contacts, None for the user alone]
 
-models.Base.metadata.create_all(bind=engine)
+    Returns:
+        [JSONResponse]: [user, X-Next-Cursor is set when more contacts follow, for /users/{param}/contacts?after=]
+    """
+    if include != "contacts":
+        return JSONResponse(status_code=200, content=schemas.User.from_row(db_user).dict())
+    content = schemas.User.from_row(db_user).dict()
+    content["contacts"] = await crud.get_contacts(db=db, user_id=db_user.id, limit=MAX_INCLUDED_CONTACTS)
+    return contacts_response(content, content["contacts"], MAX_INCLUDED_CONTACTS)
 
-phonebook = FastAPI()
-ADMIN_TOKEN = "123456"
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-        
-@phonebook.post("/users/addUser/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+def entity_tag(version: int):
+    return '"v%d"' % version
+
+
+def not_modified(if_none_match: Optional[str], etag: str):
+    """[Answers a conditional GET with 304 when If-None-Match names the current entity tag, so the client reuses its copy]
+
+    Args:
+        if_none_match (Optional[str]): [If-None-Match header, entity tags the client has copies for]
+        etag (str): [entity tag of the current representation]
+
+    Returns:
+        [Optional[Response]]: [304 response, None when the client has no current copy]
+    """
+    if if_none_match is None:
+        return None
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    # If-None-Match compares weakly, a tag a proxy marked weak still matches
+    if "*" in tags or etag in tags or "W/" + etag in tags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+    return None
+
+
+def contacts_response(content, contacts: List[dict], limit: int):
+    """[Renders contact dicts as they came from the database, skipping the response_model validation and encoding]
+
+    Args:
+        content (Any): [response body, contacts or a document embedding them]
+        contacts (List[dict]): [contacts in the body, ordered by id]
+        limit (int): [contacts asked for, a full page sets X-Next-Cursor]
+
+    Returns:
+        [JSONResponse]: [content, X-Next-Cursor is the id of the last contact when more may follow]
+    """
+    response = JSONResponse(status_code=200, content=content)
+    if len(contacts) == limit:
+        response.headers["X-Next-Cursor"] = str(contacts[-1]["id"])
+    return response
+
+
+def parse_cursor(since: Optional[str]):
+    """[Reads a contact changes cursor, "version-id" as returned by /users/{param}/contacts/changes]
+
+    Args:
+        since (Optional[str]): [cursor, None to start from the beginning]
+
+    Raises:
+        HTTPException: [400, Invalid cursor]
+
+    Returns:
+        [Tuple[int, int]]: [(version, contact id) of the last change the client has]
+    """
+    if since is None:
+        return (0, 0)
+    version, _, contact_id = since.partition("-")
+    if not version.isdigit() or not contact_id.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid cursor, please pass the cursor of the previous sync")
+    return (int(version), int(contact_id))
+
+
+async def idempotent_replay(db: AsyncSession, user_id: int, idempotency_key: Optional[str], request_fingerprint: str):
+    """[Response recorded for an earlier request with the same Idempotency-Key, so a retried write is not applied twice]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [user making the request]
+        idempotency_key (Optional[str]): [Idempotency-Key header, None when the client sent none]
+        request_fingerprint (str): [idempotency.fingerprint of the request]
+
+    Raises:
+        HTTPException: [422, Idempotency-Key already used for a different request]
+
+    Returns:
+        [Optional[Response]]: [recorded response, marked with Idempotent-Replayed, None for a new request]
+    """
+    if idempotency_key is None:
+        return None
+    recorded = await idempotency.find(db, user_id, idempotency_key)
+    if recorded is None:
+        return None
+    if recorded.fingerprint != request_fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    return Response(content=recorded.response, status_code=recorded.status_code, media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+
+@phonebook.on_event("startup")
+async def prepare():
+    """[Brings the schema up to date (or checks it is), then builds the registered users filter, checks the replicas and warms the connection pool and the user cache]
+
+    Raises:
+        RuntimeError: [migrations are pending and AUTO_MIGRATE is off]
+    """
+    for shard, shard_engine in enumerate(shards.engines):
+        if settings.auto_migrate:
+            migrations.migrate(shard_engine)
+        else:
+            pending = migrations.pending(shard_engine)
+            if pending:
+                raise RuntimeError("Database schema of shard %d is missing migrations %s, run `python cli.py migrate`" % (shard, pending))
+    search.detect_search_indexes(engine)
+    if settings.existence_filter:
+        restored = bool(settings.existence_filter_snapshot) and registered_users.restore(settings.existence_filter_snapshot)
+        if not restored:
+            with engine.connect() as connection:
+                registered_users.rebuild(connection)
+        # a restored snapshot lacks whatever changed since it was saved, it is only served until the first rebuild
+        phonebook.state.filter_refresher = asyncio.ensure_future(
+            registered_users.keep_fresh(async_engine, settings.existence_filter_refresh, stale=restored))
+    # the sync engines are only needed for the steps above, leave their connections to the requests
+    for shard_engine in shards.engines:
+        shard_engine.dispose()
+    if shards.all_replicas():
+        # checked once before serving, so reads are not sent to a replica that is down from the start
+        await shards.check_replicas(settings.replica_check_interval, settings.replica_max_lag_ms / 1000)
+        phonebook.state.replica_checker = asyncio.ensure_future(
+            shards.keep_replicas_checked(settings.replica_check_interval, settings.replica_max_lag_ms / 1000))
+    await prewarm_pool(settings.db_pool_size)
+    async with AsyncSessionLocal() as db:
+        await crud.prewarm_user_cache(db, settings.prewarm_users)
+
+@phonebook.on_event("shutdown")
+async def dispose_engine():
+    for task_name in ("filter_refresher", "replica_checker"):
+        task = getattr(phonebook.state, task_name, None)
+        if task is not None:
+            task.cancel()
+    for group_committer in group_committers or ():
+        await group_committer.close()
+    if settings.existence_filter_snapshot:
+        registered_users.save(settings.existence_filter_snapshot)
+    for shard_engine in shards.async_engines + [replica.async_engine for replica in shards.all_replicas()]:
+        await shard_engine.dispose()
+
+@phonebook.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """[Prometheus metrics of this worker process, request latency, database time and statements per route]
+
+    Returns:
+        [Response]: [metrics in the Prometheus text format]
+    """
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@phonebook.post("/users/addUser/", response_model=schemas.UserCreated)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     """[creates an user with requested parameters if valid]
 
     Args:
         user (schemas.UserCreate): [user]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        db (AsyncSession, optional): [database dependency]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [400 Bad Request, Invalid email] 
@@ -35,30 +218,37 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         HTTPException: [400 Bad Request, Phone number already registered]
 
     Returns:
-        [user]: [if user creation is successfull]
+        [user]: [if user creation is successfull, with the token, which is not stored and cannot be shown again]
     """
     
     if not validate_email(user.email):
         raise HTTPException(status_code=400, detail="Invalid email")
-    if not validate_phonenumber(user.phonenumber):
+    phonenumber = normalize_phonenumber(user.phonenumber)
+    if phonenumber is None:
         raise HTTPException(status_code=400, detail="Invalid Phone number")
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+    user.phonenumber = phonenumber
+    # most registrations are new, the filter rules them out without a query, the unique constraints back it up
+    if registered_users.might_exist(user.email) and await crud.locate_user(db, param=user.email, is_email=True):
         raise HTTPException(status_code=409, detail="Email already registered")
-    db_user = crud.get_user_by_phonenumber(db, phonenumber=user.phonenumber)
-    if db_user:
+    if registered_users.might_exist(user.phonenumber) and await crud.locate_user(db, param=user.phonenumber, is_email=False):
         raise HTTPException(status_code=409, detail="Phone Number already registered")
-    return crud.create_user(db=db, user=user)
+    created = await crud.create_user(db=db, user=user)
+    if created is None:
+        raise HTTPException(status_code=409, detail="Email or Phone Number already registered")
+    await commit(db)
+    db_user, token = created
+    return JSONResponse(status_code=200, content=schemas.UserCreated.from_row(db_user, token).dict())
+
+
 
 
 @phonebook.get("/users/{param}/")
-def get_user_by_param(param: str, token: str, db: Session = Depends(get_db)):
+async def get_user_by_param(if_none_match: Optional[str] = Header(None), db_user: CachedUser = Depends(get_current_user)):
     """[Returns a user if exists with parameter as email or Phone number]
 
     Args:
-        param (str): [email or phone number]
-        token (Str): [token for authorization]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        if_none_match (Optional[str], optional): [ETag of the client's copy]. Defaults to Header(None).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
 
     Raises:
         HTTPException: [404, User not found]
@@ -66,35 +256,24 @@ def get_user_by_param(param: str, token: str, db: Session = Depends(get_db)):
         HTTPException: [401, Unauthorized action]
 
     Returns:
-        [user]: [returns name, email, phonenumber if user with requested parameter existed]
+        [user]: [returns name, email, phonenumber if user with requested parameter existed, 304 when the client's copy is current]
     """
-    
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return JSONResponse(status_code=200, content={"mail": db_user.email,"phonenumber": db_user.phonenumber}) 
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return JSONResponse(status_code=200, content={"mail": db_user.email,"phonenumber": db_user.phonenumber}) 
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    etag = entity_tag(db_user.version)
+    response = not_modified(if_none_match, etag)
+    if response is not None:
+        return response
+    return JSONResponse(status_code=200, content={"mail": db_user.email,"phonenumber": db_user.phonenumber},
+                        headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
 
 
 @phonebook.get('/premiumUser/getUser/{param}')
-def get_user(param: str, premium_user_param: str, premium_user_token, db: Session = Depends(get_db)):
+async def get_user(param: str, premium_user: CachedUser = Depends(get_premium_user), db: AsyncSession = Depends(get_db)):
     """[get user for premium user]
 
     Args:
         param (str): [email or phone number of requested user]
-        premium_user_param (str): [email or phone number of premium user]
-        premium_user_token ([type]): [premium user token]
-        db (Session, optional): [description]. Defaults to Depends(get_db).
+        premium_user (CachedUser, optional): [premium user resolved from premium_user_param and verified against premium_user_token]. Defaults to Depends(get_premium_user).
+        db (AsyncSession, optional): [shard 0 session holding the directory]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [404, User not found]
@@ -106,102 +285,199 @@ def get_user(param: str, premium_user_param: str, premium_user_token, db: Sessio
     Returns:
         [user]: [returns user name, user email, user phone number]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    if (not validate_email(premium_user_param)) and (not validate_phonenumber(premium_user_param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid premium user email or premium user phone number")
-    db_user = crud.get_user_by_email(db=db, email=premium_user_param)
-    if db_user is not None:
-        if db_user.premium == False:
-            raise HTTPException(status_code=401, detail="Unauthorized access, only premium users allowed")
-        if db_user.token == premium_user_token:
-            requested_user = crud.get_user_by_email(db=db, email=param)
-            if requested_user is not None:
-                return JSONResponse(status_code=200, 
-                                    content={"name": requested_user.name, 
-                                             "mail": requested_user.email, 
-                                             "phonenumber": requested_user.phonenumber})
-            requested_user = crud.get_user_by_phonenumber(db=db, email=param)
-            if requested_user is not None:
-                return JSONResponse(status_code=200, 
-                                    content={"name": requested_user.name, 
-                                             "mail": requested_user.email, 
-                                             "phonenumber": requested_user.phonenumber})
-            raise HTTPException(status_code=404, detail="No user not found by given parameter")
+    requested_user = await resolve_user(db, param, not_found_detail="No user not found by given parameter")
+    return JSONResponse(status_code=200, 
+                        content={"name": requested_user.name, 
+                                 "mail": requested_user.email, 
+                                 "phonenumber": requested_user.phonenumber})
+
+@phonebook.post("/premiumUser/lookup", response_model=schemas.UserLookupResult)
+async def lookup_users(lookup: schemas.UserLookup, premium_user: CachedUser = Depends(get_premium_user), db: AsyncSession = Depends(get_read_db)):
+    """[resolve many emails or phone numbers to users at once, e.g. to find which contacts are registered]
+
+    Args:
+        lookup (schemas.UserLookup): [emails or phone numbers of requested users]
+        premium_user (CachedUser, optional): [premium user resolved from premium_user_param and verified against premium_user_token]. Defaults to Depends(get_premium_user).
+        db (AsyncSession, optional): [session on a replica when there is a healthy one]. Defaults to Depends(get_read_db).
+
+    Raises:
+        HTTPException: [404, Premium user not found]
+        HTTPException: [400, Invalid Parameter, Please use a valid email or phone number for premium user]
+        HTTPException: [401, Unauthorized action, only premium users allowed]
+        HTTPException: [413, too many params]
+
+    Returns:
+        [UserLookupResult]: [user name, email and phone number per found param as submitted, and the params not found or invalid]
+    """
+    if len(lookup.params) > MAX_BULK_CONTACTS:
+        raise HTTPException(status_code=413, detail="Too many params, at most %d per request" % MAX_BULK_CONTACTS)
+    canonical = {}
+    invalid = []
+    for param in lookup.params:
+        param_type, value = canonical_param(param)
+        if param_type is ParamType.INVALID:
+            invalid.append(param)
         else:
-            raise HTTPException(status_code=401, detail="Invalid token for the premium user")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=premium_user_param)
-    if db_user is not None:
-        if db_user.premium == False:
-            raise HTTPException(status_code=401, detail="Unauthorized access, only premium users allowed")
-        if db_user.token == premium_user_token:
-            requested_user = crud.get_user_by_email(db=db, email=param)
-            if requested_user is not None:
-                return JSONResponse(status_code=200, 
-                                    content={"name": requested_user.name, 
-                                             "mail": requested_user.email, 
-                                             "phonenumber": requested_user.phonenumber})
-            requested_user = crud.get_user_by_phonenumber(db=db, email=param)
-            if requested_user is not None:
-                return JSONResponse(status_code=200, 
-                                    content={"name": requested_user.name, 
-                                             "mail": requested_user.email, 
-                                             "phonenumber": requested_user.phonenumber})
-            raise HTTPException(status_code=404, detail="No user not found by given parameter")
+            canonical[param] = (param_type, value)
+    # the registered users filter is not consulted, a worker's filter misses users registered through other workers
+    # until its next rebuild, the indexed query is authoritative
+    keys = set(canonical.values())
+    emails = [value for param_type, value in keys if param_type is ParamType.EMAIL]
+    phonenumbers = [value for param_type, value in keys if param_type is ParamType.PHONE]
+    users = {}
+    for row in await crud.get_users_by_params(db=db, emails=emails, phonenumbers=phonenumbers):
+        user = {"name": row.name, "mail": row.email, "phonenumber": row.phonenumber}
+        users[(ParamType.EMAIL, row.email)] = users[(ParamType.PHONE, row.phonenumber)] = user
+    found = {}
+    not_found = []
+    for param, key in canonical.items():
+        if key in users:
+            found[param] = users[key]
         else:
-            raise HTTPException(status_code=401, detail="Invalid token for the premium user")
-    raise HTTPException(status_code=404, detail="No premium user not found by given parameter")
+            not_found.append(param)
+    return JSONResponse(status_code=200, content={"found": found, "not_found": not_found, "invalid": invalid})
 
 @phonebook.post("/users/{param}/addContact/", response_model=schemas.Contact)
-def create_contact_for_user(param: str, token: str, contact: schemas.ContactCreate, db: Session = Depends(get_db)):
+async def create_contact_for_user(contact: schemas.ContactCreate, idempotency_key: Optional[str] = Header(None),
+                                  db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
     """[creates a contact for the user if token validates with the user]
 
     Args:
-        param (str): [email or phone number]
-        token (str): [authorization token]
         contact (schemas.ContactCreate): [contact (name, email, phonenumber)]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        idempotency_key (Optional[str], optional): [Idempotency-Key, a retry with the same key gets the first response]. Defaults to Header(None).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
 
     Raises:
         HTTPException: [400, not a valid email or phone number]
         HTTPException: [401, token provided doesn't give access to add the contact to the user]
         HTTPException: [404, user not found]
+        HTTPException: [409, contact already exists]
+        HTTPException: [422, Idempotency-Key already used for a different request]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
         [contact]: [returns the contact details]
     """
-    
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    
-    if db_user is not None:
-        if db_user.token == token:
-            if(crud.contact_check(db=db, user_id=db_user.id, contact_mail=contact.email, contact_phonenumber=contact.phonenumber)):
-                raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number") 
-            return crud.create_user_contact(db=db, contact=contact, user_id=db_user.id)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-        
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            if(crud.contact_check(db=db, user_id=db_user.id, contact_mail=contact.email, contact_phonenumber=contact.phonenumber)):
-                raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
-            return crud.create_user_contact(db=db, contact=contact, user_id=db_user.id)
+    if not validate_email(contact.email):
+        raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a valid contact email")
+    phonenumber = normalize_phonenumber(contact.phonenumber)
+    if phonenumber is None:
+        raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a valid contact phone number")
+    # stored in the canonical form user phone numbers have, so lookups and duplicate checks see one spelling
+    contact.phonenumber = phonenumber
+    request_fingerprint = idempotency.fingerprint("/users/{param}/addContact/", contact.dict())
+    replay = await idempotent_replay(db, db_user.id, idempotency_key, request_fingerprint)
+    if replay is not None:
+        return replay
+    if(await crud.contact_check(db=db, user_id=db_user.id, contact_mail=contact.email, contact_phonenumber=contact.phonenumber)):
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number") 
+
+    async def write(db: AsyncSession):
+        db_contact = await crud.create_user_contact(db=db, contact=contact, user_id=db_user.id)
+        if db_contact is not None and idempotency_key is not None:
+            await idempotency.record(db, db_user.id, idempotency_key, request_fingerprint, 200, db_contact)
+        return db_contact
+
+    try:
+        if group_committers is not None:
+            # hand the connection back first, requests waiting for their batch must not hold the pool the batch needs
+            await rollback(db)
+            db_contact = await group_committers[db_user.shard].run(write)
         else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+            db_contact = await write(db)
+            await commit(db)
+    except IntegrityError:
+        db_contact = None
+    if db_contact is None:
+        # lost a race with a concurrent insert of the same contact, possibly a retry of this very request
+        replay = await idempotent_replay(db, db_user.id, idempotency_key, request_fingerprint)
+        if replay is not None:
+            return replay
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
+    return JSONResponse(status_code=200, content=db_contact)
     
 
+@phonebook.post("/users/{param}/contacts/bulk", response_model=schemas.BulkContactResult)
+async def create_contacts_for_user(items: list = Depends(get_bulk_contacts_payload), idempotency_key: Optional[str] = Header(None),
+                                   db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[creates many contacts for the user in one request and one transaction, skipping invalid and duplicate ones]
+
+    Args:
+        items (list, optional): [contacts (name, email, phonenumber) as a JSON array or NDJSON]. Defaults to Depends(get_bulk_contacts_payload).
+        idempotency_key (Optional[str], optional): [Idempotency-Key, a retry with the same key gets the first response]. Defaults to Header(None).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, not a valid email or phone number, or malformed body]
+        HTTPException: [401, token provided doesn't give access to add the contact to the user]
+        HTTPException: [404, user not found]
+        HTTPException: [409, Idempotency-Key used by a concurrent request]
+        HTTPException: [413, too many contacts]
+        HTTPException: [422, Idempotency-Key already used for a different request]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [BulkContactResult]: [counts and a created / duplicate / invalid status per submitted contact]
+    """
+    request_fingerprint = idempotency.fingerprint("/users/{param}/contacts/bulk", items)
+    replay = await idempotent_replay(db, db_user.id, idempotency_key, request_fingerprint)
+    if replay is not None:
+        return replay
+    results = [None] * len(items)
+    parsed = []
+    for index, item in enumerate(items):
+        try:
+            parsed.append((index, schemas.ContactCreate.parse_obj(item)))
+        except ValidationError as e:
+            results[index] = schemas.BulkContactStatus(index=index, status="invalid", detail=str(e))
+    # emails are classified in one pass with the patterns bound once, phone numbers are validated by normalizing them
+    email_types = validate_many([contact.email for index, contact in parsed])
+    contacts = []
+    indexes = []
+    for (index, contact), email_type in zip(parsed, email_types):
+        phonenumber = normalize_phonenumber(contact.phonenumber)
+        if email_type is not ParamType.EMAIL:
+            results[index] = schemas.BulkContactStatus(index=index, status="invalid", detail="Invalid email")
+        elif phonenumber is None:
+            results[index] = schemas.BulkContactStatus(index=index, status="invalid", detail="Invalid phone number")
+        else:
+            contact.phonenumber = phonenumber
+            contacts.append(contact)
+            indexes.append(index)
+    created = await crud.bulk_create_user_contacts(db=db, contacts=contacts, user_id=db_user.id)
+    for index, is_created in zip(indexes, created):
+        results[index] = schemas.BulkContactStatus(index=index, status="created" if is_created else "duplicate")
+    content = schemas.BulkContactResult(created=sum(created),
+                                        duplicates=len(created) - sum(created),
+                                        invalid=len(items) - len(created),
+                                        results=results).dict()
+    if idempotency_key is not None:
+        await idempotency.record(db, db_user.id, idempotency_key, request_fingerprint, 200, content)
+    try:
+        await commit(db)
+    except IntegrityError:
+        # a concurrent request with the same key committed first, nothing of this one was
+        replay = await idempotent_replay(db, db_user.id, idempotency_key, request_fingerprint)
+        if replay is not None:
+            return replay
+        raise HTTPException(status_code=409, detail="Idempotency-Key is used by a concurrent request")
+    return JSONResponse(status_code=200, content=content)
+
+
 @phonebook.get("/users/{param}/contacts", response_model=List[schemas.Contact])
-def get_contacts_of_user(param: str, token: str, db: Session = Depends(get_db)):
-    """[get the contacts of the user with given mail or phone number]
+async def get_contacts_of_user(after: Optional[int] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+                               if_none_match: Optional[str] = Header(None),
+                               db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[get the contacts of the user with given mail or phone number, one page at a time ordered by contact id]
 
     Args:
-        param (str): [mail or phone number]
-        token (str): [authorization token]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        after (Optional[int], optional): [cursor, the X-Next-Cursor of the previous page]. Defaults to None.
+        limit (int, optional): [page size]. Defaults to 100.
+        if_none_match (Optional[str], optional): [ETag of the client's copy of the page]. Defaults to Header(None).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
 
     Raises:
         HTTPException: [400, not a valid email or phone number]
@@ -209,41 +485,134 @@ def get_contacts_of_user(param: str, token: str, db: Session = Depends(get_db)):
         HTTPException: [404, user not found]
 
     Returns:
-        [List[contact]]: [returns list of contacts of the given user]
+        [List[contact]]: [returns list of contacts of the given user, 304 without reading them when the client's copy is current]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.get_contacts(db=db, user_id=db_user.id)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.get_contacts(db=db, user_id=db_user.id)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    # read before the contacts, a write in between then leaves the page with an older tag, never a newer one
+    version = await crud.get_user_version(db=db, user_id=db_user.id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    etag = entity_tag(version)
+    response = not_modified(if_none_match, etag)
+    if response is not None:
+        return response
+    contacts = await crud.get_contacts(db=db, user_id=db_user.id, after=after, limit=limit)
+    response = contacts_response(contacts, contacts, limit)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+@phonebook.get("/users/{param}/contacts/export")
+async def export_contacts_of_user(export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+                                  db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[streams every contact of the user as NDJSON or CSV without loading the address book into memory]
+
+    Args:
+        export_format (str, optional): [ndjson or csv, passed as format]. Defaults to "ndjson".
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, not a valid email or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+
+    Returns:
+        [StreamingResponse]: [contacts (id, name, email, phonenumber) ordered by id]
+    """
+    async def ndjson_lines():
+        async for rows in crud.stream_contacts(db=db, user_id=db_user.id):
+            yield b"".join(dumps(dict(row._mapping)) + b"\n" for row in rows)
+
+    async def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "name", "email", "phonenumber"])
+        async for rows in crud.stream_contacts(db=db, user_id=db_user.id):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == "csv":
+        return StreamingResponse(csv_lines(), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="contacts.csv"'})
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@phonebook.get("/users/{param}/contacts/search", response_model=List[schemas.Contact])
+async def search_contacts_of_user(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS),
+                                  db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[search the contacts of the user by name, email or phone number prefix, or by part of the phone number]
+
+    Args:
+        q (str): [search text]
+        limit (int, optional): [maximum contacts returned]. Defaults to 20.
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, not a valid email or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+
+    Returns:
+        [List[contact]]: [matching contacts ordered by name]
+    """
+    return JSONResponse(status_code=200, content=await crud.search_contacts(db=db, user_id=db_user.id, q=q, limit=limit))
+
+
+@phonebook.get("/users/{param}/contacts/changes", response_model=schemas.ContactChanges)
+async def get_contact_changes_of_user(since: Optional[str] = None, limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                      db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[get the contacts of the user inserted, changed or deleted since the previous sync, so syncing costs as much as
+    what changed rather than the whole address book]
+
+    Args:
+        since (Optional[str], optional): [cursor of the previous page, None for the whole address book]. Defaults to None.
+        limit (int, optional): [changes per page]. Defaults to MAX_PAGE_SIZE.
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, not a valid email or phone number]
+        HTTPException: [400, invalid cursor]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [410, changes since the cursor are no longer known, sync again without since]
+
+    Returns:
+        [ContactChanges]: [contacts inserted or changed and ids of contacts deleted in the order they were made, the cursor
+                           to pass as since next and whether more changes follow at once]
+    """
+    changes = await crud.get_contact_changes(db=db, user_id=db_user.id, since=parse_cursor(since), limit=limit)
+    if changes is None:
+        raise HTTPException(status_code=410, detail="Changes since the cursor are no longer known, please sync again without since")
+    changes["cursor"] = "%d-%d" % changes["cursor"]
+    return JSONResponse(status_code=200, content=changes)
 
 
 @phonebook.put("/users/{param}/updateUserEmail/", response_model=schemas.User)
-def update_user_email(param: str, token: str, update_param: str, db: Session = Depends(get_db)):
+async def update_user_email(update_param: str, include: Optional[str] = Query(None, regex="^contacts$"),
+                            db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db),
+                            directory: AsyncSession = Depends(get_db)):
     """[update user email]
 
     Args:
-        param (str): [email or phonenumber]
-        token (str): [authorization token]
         update_param (str): [new to be update email]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        include (Optional[str], optional): [contacts to embed the user's first contacts]. Defaults to None.
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+        directory (AsyncSession, optional): [shard 0 session holding the directory]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [400, invalid to be updated email]
-        HTTPException: [400, invlaid email or phonenumber]
+        HTTPException: [400, invalid email or phonenumber]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found with given param]
-        HTTPException: [description]
+        HTTPException: [409, email already registered to another user]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
         [user]: [updated user details]
@@ -252,282 +621,381 @@ def update_user_email(param: str, token: str, update_param: str, db: Session = D
         raise HTTPException(status_code=204, detail="update param has no content")
     if not validate_email(update_param):
         raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a valid new email")
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.update_user_email(db=db, user_id=db_user.id, mail=update_param)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.update_user_email(db=db, user_id=db_user.id, mail=update_param)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    try:
+        db_user = await crud.update_user_email(db=db, directory=directory, user_id=db_user.id, mail=update_param)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        await commit_all(directory, db)
+    except IntegrityError:
+        # the email is unique in the directory and another user has it
+        await rollback(directory)
+        await rollback(db)
+        raise HTTPException(status_code=409, detail="Email already registered")
+    return await user_response(db, db_user, include)
 
 
 @phonebook.put("/users/{param}/updateUserPhonenumber/", response_model=schemas.User)
-def update_user_phonenumber(param: str, token: str, update_param: str, db: Session = Depends(get_db)):
+async def update_user_phonenumber(update_param: str, include: Optional[str] = Query(None, regex="^contacts$"),
+                                  db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db),
+                                  directory: AsyncSession = Depends(get_db)):
     """[update user phone number]
 
     Args:
-        param (str): [email or phonenumber]
-        token (str): [authorization token]
         update_param (str): [new to be update phone number]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        include (Optional[str], optional): [contacts to embed the user's first contacts]. Defaults to None.
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+        directory (AsyncSession, optional): [shard 0 session holding the directory]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [400, invalid to be updated phone number]
-        HTTPException: [400, invlaid email or phonenumber]
+        HTTPException: [400, invalid email or phonenumber]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found with given param]
-        HTTPException: [description]
+        HTTPException: [409, phone number already registered to another user]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
         [user]: [updated user details]
     """
     if (update_param is None) or update_param == "":
         raise HTTPException(status_code=204, detail="update param has no content") 
-    if not validate_phonenumber(update_param):
+    phonenumber = normalize_phonenumber(update_param)
+    if phonenumber is None:
         raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a valid new phone number")
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.update_user_phonenumber(db=db, user_id=db_user.id, phone_number=update_param)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            return crud.update_user_phonenumber(db=db, user_id=db_user.id, phone_number=update_param)
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    try:
+        db_user = await crud.update_user_phonenumber(db=db, directory=directory, user_id=db_user.id, phone_number=phonenumber)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        await commit_all(directory, db)
+    except IntegrityError:
+        # the phone number is unique in the directory and another user has it
+        await rollback(directory)
+        await rollback(db)
+        raise HTTPException(status_code=409, detail="Phone Number already registered")
+    return await user_response(db, db_user, include)
     
 @phonebook.delete("/users/{param}/deleteUser/")
-def delete_user(param: str, token: str, db: Session = Depends(get_db)):
+async def delete_user(db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db),
+                      directory: AsyncSession = Depends(get_db)):
     """[delete user]
 
     Args:
-        param (str): [email or phone number]
-        token (str): [authorization token]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+        directory (AsyncSession, optional): [shard 0 session holding the directory]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [400, invalid mail or phone number]
         HTTPException: [405, method not allowed]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
-        [response]: [json message]
+        [response]: [json message with the number of contacts deleted along with the user]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            if crud.delete_user(db=db, user_id=db_user.id):
-                return JSONResponse(status_code=200, content={"message" : "User successfully deleted"})
-            else:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            if crud.delete_user(db=db, user_id=db_user.id):
-                return JSONResponse(status_code=200, content={"message" : "User successfully deleted"})
-            else:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    try:
+        deleted = await crud.delete_user(db=db, directory=directory, user_id=db_user.id)
+        await commit_all(directory, db)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=405, detail="Method not allowed")
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return JSONResponse(status_code=200, content={"message" : "User successfully deleted", "deleted_contacts": deleted})
 
 
 @phonebook.put("/users/{param}/updateContactEmail")
-def update_user_contact_email(param: str, email: str, newmail: str, token: str, db: Session = Depends(get_db)):
+async def update_user_contact_email(email: str, newmail: str, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
     """[Update email of a contact for a user]
 
     Args:
-        param (str): [email or phonenumber to identify user]
         email (str): [email of the contact that need to be updated]
         newmail (str): [new email]
-        token (str): [authorization token]
-        db (Session, optional): [database dependancy]. Defaults to Depends(get_db).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
 
     Raises:
         HTTPException: [400, invalid mail or phone number]
-        HTTPException: [405, method not allowed]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found]
+        HTTPException: [405, No such contact exists]
+        HTTPException: [409, a contact already exists with the new mail]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
-        [contact]: [updated contact]
+        [JSONResponse]: [200, number of contacts updated]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
     if (not validate_email(email)) or (not validate_email(newmail)):
         raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a valid email")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                return crud.update_contact_email(db=db, user_id=db_user.id, email=email, mail=newmail)
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                return crud.update_contact_email(db=db, user_id=db_user.id, email=email, mail=newmail)
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    try:
+        updated = await crud.update_contact_email(db=db, user_id=db_user.id, email=email, mail=newmail)
+        await commit(db)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
+    if not updated:
+        raise HTTPException(status_code=405, detail="No such contact exists")
+    return JSONResponse(status_code=200, content={"message" : "Contact successfully updated", "updated": updated})
 
 
 @phonebook.put("/users/{param}/updateContactPhonenumber")
-def update_user_contact_phonenumber(param: str, phonenumber: str, newphonenumber: str, token: str, db: Session = Depends(get_db)):
+async def update_user_contact_phonenumber(phonenumber: str, newphonenumber: str, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
     """[Update phonenumber of a contact for a user]
 
     Args:
-        param (str): [email or phonenumber to identify user]
         phonenumber (str): [phonenumber of the contact that need to be updated]
         newphonenumber (str): [new phonenumber]
-        token (str): [authorization token]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
 
     Raises:
         HTTPException: [400, invalid mail or phone number]
-        HTTPException: [405, method not allowed]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found]
+        HTTPException: [405, No such contact exists]
+        HTTPException: [409, a contact already exists with the new phone number]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
-        [contact]: [updated contact]
+        [JSONResponse]: [200, number of contacts updated]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="Invalid Parameter, Please use a valid email or phone number")
-    if (not validate_phonenumber(phonenumber)) or (not validate_phonenumber(newphonenumber)):
+    # contacts are stored with canonical phone numbers, see create_contact_for_user
+    phonenumber, newphonenumber = normalize_phonenumber(phonenumber), normalize_phonenumber(newphonenumber)
+    if phonenumber is None or newphonenumber is None:
         raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide a phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                return crud.update_contact_phonenumber(db=db, user_id=db_user.id, phonenumber=phonebook, newphonenumber=newphonenumber)
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                return crud.update_contact_phonenumber(db=db, user_id=db_user.id, phonenumber=phonebook, newphonenumber=newphonenumber)
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    try:
+        updated = await crud.update_contact_phonenumber(db=db, user_id=db_user.id, phonenumber=phonenumber, newphonenumber=newphonenumber)
+        await commit(db)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
+    if not updated:
+        raise HTTPException(status_code=405, detail="No such contact exists")
+    return JSONResponse(status_code=200, content={"message" : "Contact successfully updated", "updated": updated})
+
+
+@phonebook.put("/users/{param}/updateContactEmails")
+async def update_user_contact_emails(changes: schemas.ContactValueChanges, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[Update emails of many contacts of a user in one statement]
+
+    Args:
+        changes (schemas.ContactValueChanges): [old email -> new email pairs]
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, invalid mail]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [409, a new mail collides with an existing contact, nothing is updated]
+        HTTPException: [413, too many changes]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [200, number of contacts updated]
+    """
+    if len(changes.changes) > MAX_BULK_CONTACTS:
+        raise HTTPException(status_code=413, detail="Too many contacts, at most %d per request" % MAX_BULK_CONTACTS)
+    values = [value for change in changes.changes for value in (change.old, change.new)]
+    if any(param_type is not ParamType.EMAIL for param_type in validate_many(values)):
+        raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide valid emails")
+    try:
+        updated = await crud.update_contacts_email(db=db, user_id=db_user.id, changes={change.old: change.new for change in changes.changes})
+        await commit(db)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
+    return JSONResponse(status_code=200, content={"message" : "Contacts successfully updated", "updated": updated})
+
+
+@phonebook.put("/users/{param}/updateContactPhonenumbers")
+async def update_user_contact_phonenumbers(changes: schemas.ContactValueChanges, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[Update phone numbers of many contacts of a user in one statement]
+
+    Args:
+        changes (schemas.ContactValueChanges): [old phone number -> new phone number pairs]
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, invalid phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [409, a new phone number collides with an existing contact, nothing is updated]
+        HTTPException: [413, too many changes]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [200, number of contacts updated]
+    """
+    if len(changes.changes) > MAX_BULK_CONTACTS:
+        raise HTTPException(status_code=413, detail="Too many contacts, at most %d per request" % MAX_BULK_CONTACTS)
+    normalized = [(normalize_phonenumber(change.old), normalize_phonenumber(change.new)) for change in changes.changes]
+    if any(old is None or new is None for old, new in normalized):
+        raise HTTPException(status_code=400, detail="Invalid Parameter, Please provide valid phone numbers")
+    try:
+        updated = await crud.update_contacts_phonenumber(db=db, user_id=db_user.id, changes=dict(normalized))
+        await commit(db)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="a contact already exists with provided mail and phone number")
+    return JSONResponse(status_code=200, content={"message" : "Contacts successfully updated", "updated": updated})
 
 
 @phonebook.delete("/users/{param}/deleteUserContact")
-def delete_user_contact(param: str, token: str, contact_param: str, db: Session = Depends(get_db)):
+async def delete_user_contact(contact_param: str, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
     """[delete contact of a user]
 
     Args:
-        param (str): [email or phone number of user]
-        token (str): [authorization token]
         contact_param (str): [email or phone number of contact]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
 
     Raises:
         HTTPException: [400, invalid mail or phone number]
-        HTTPException: [405, method not allowed]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found]
         HTTPException: [405, No such contact exists]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
         [JSONResponse]: [200, Contact successfully deleted]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="param: Invalid Parameter, Please use a valid email or phone number")
-    if (not validate_email(contact_param)) and (not validate_phonenumber(contact_param)):
+    param_type, contact_param = canonical_param(contact_param)
+    if param_type is ParamType.INVALID:
         raise HTTPException(status_code=400, detail="contact_param: Invalid Parameter, Please use a valid email or phone number")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                if crud.delete_contact(db=db, user_id=db_user.id, contact_param=contact_param):
-                    return JSONResponse(status_code=200, content={"message" : "Contact successfully deleted"})
-                else:
-                    raise HTTPException(status_code=405, detail="No such contact exists")
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        if db_user.token == token:
-            try:
-                if crud.delete_contact(db=db, user_id=db_user.id, contact_param=contact_param):
-                    return JSONResponse(status_code=200, content={"message" : "Contact successfully deleted"})
-                else:
-                    raise HTTPException(status_code=405, detail="No such contact exists")
-            except:
-                raise HTTPException(status_code=405, detail="Method not allowed")
-        else:
-            raise HTTPException(status_code=401, detail="Unauthorized action, please provide valid token")
-    raise HTTPException(status_code=404, detail="User not found")
+    if await crud.delete_contact(db=db, user_id=db_user.id, contact_param=contact_param):
+        await commit(db)
+        return JSONResponse(status_code=200, content={"message" : "Contact successfully deleted"})
+    raise HTTPException(status_code=405, detail="No such contact exists")
+
+
+@phonebook.delete("/users/{param}/deleteUserContacts")
+async def delete_user_contacts(contact_params: schemas.ContactParams, db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[delete many contacts of a user in one statement]
+
+    Args:
+        contact_params (schemas.ContactParams): [emails or phone numbers of contacts]
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, invalid mail or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [413, too many contacts]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [200, number of contacts deleted]
+    """
+    if len(contact_params.contact_params) > MAX_BULK_CONTACTS:
+        raise HTTPException(status_code=413, detail="Too many contacts, at most %d per request" % MAX_BULK_CONTACTS)
+    canonical = [canonical_param(contact_param) for contact_param in contact_params.contact_params]
+    if any(param_type is ParamType.INVALID for param_type, value in canonical):
+        raise HTTPException(status_code=400, detail="contact_params: Invalid Parameter, Please use valid emails or phone numbers")
+    deleted = await crud.delete_contacts(db=db, user_id=db_user.id, contact_params=[value for param_type, value in canonical])
+    await commit(db)
+    return JSONResponse(status_code=200, content={"message" : "Contacts successfully deleted", "deleted": deleted})
+
 
+@phonebook.post("/users/{param}/rotateToken", response_model=schemas.Token)
+async def rotate_user_token(db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[replaces the user's token with a new one, the current token stops working]
 
-@phonebook.post("/admin/{param}/premiumUser")
-def make_premium_user(param: str, admin_token: str, db: Session = Depends(get_db)):
+    Args:
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, invalid mail or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [the new token]
+    """
+    token = await crud.rotate_user_token(db=db, user_id=db_user.id)
+    if token is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await commit(db)
+    return JSONResponse(status_code=200, content={"token": token})
+
+
+@phonebook.delete("/users/{param}/revokeToken")
+async def revoke_user_token(db_user: CachedUser = Depends(get_current_user), db: AsyncSession = Depends(get_owner_db)):
+    """[revokes the user's token, the user cannot make changes until an admin issues a new one]
+
+    Args:
+        db_user (CachedUser, optional): [user resolved from param and verified against token]. Defaults to Depends(get_current_user).
+        db (AsyncSession, optional): [session on the user's shard]. Defaults to Depends(get_owner_db).
+
+    Raises:
+        HTTPException: [400, invalid mail or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [200, Token successfully revoked]
+    """
+    if not await crud.revoke_user_token(db=db, user_id=db_user.id):
+        raise HTTPException(status_code=404, detail="User not found")
+    await commit(db)
+    return JSONResponse(status_code=200, content={"message": "Token successfully revoked"})
+
+
+@phonebook.post("/admin/{param}/premiumUser", dependencies=[Depends(verify_admin)])
+async def make_premium_user(param: str, db: AsyncSession = Depends(get_db)):
     """[activate a user's premium access]
 
     Args:
         param (str): [email or phone number of the user]
-        admin_token (str): [admin token]
-        db (Session, optional): [database dependency]. Defaults to Depends(get_db).
+        db (AsyncSession, optional): [database dependency]. Defaults to Depends(get_db).
 
     Raises:
         HTTPException: [400, invalid mail or phone number]
         HTTPException: [405, method not allowed]
         HTTPException: [401, unauthorized action]
         HTTPException: [404, user not found]
+        HTTPException: [503, the user is being moved to another shard]
 
     Returns:
         [JSONResponse]: [200, Successfully activated user's premium access]
     """
-    if (not validate_email(param)) and (not validate_phonenumber(param)):
-        raise HTTPException(status_code=400, detail="param: Invalid Parameter, Please use a valid email or phone number")
-    if admin_token != ADMIN_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized access, please provide valid admin token")
-    db_user = crud.get_user_by_email(db=db, email=param)
-    if db_user is not None:
-        try:
-            crud.update_user_premium_status(db=db, user_id=db_user.id)
-            return JSONResponse(status_code=200, content={"message" : "successfully updated the user premium status"})
-        except:
-            raise HTTPException(status_code=405, detail="Method not allowed")
-    db_user = crud.get_user_by_phonenumber(db=db, phonenumber=param)
-    if db_user is not None:
-        try:
-            crud.update_user_premium_status(db=db, user_id=db_user.id)
-            return JSONResponse(status_code=200, content={"message" : "successfully updated the user premium status"})
-        except:
-            raise HTTPException(status_code=405, detail="Method not allowed")
-    if db_user is not None:
-        return JSONResponse(status_code=200, content={"successfully updated the user premium status"})
-    raise HTTPException(status_code=404, detail="User not found")
-    
\ No newline at end of file
+    db_user = await resolve_user(db, param, invalid_detail="param: Invalid Parameter, Please use a valid email or phone number")
+    check_writable(db_user)
+    try:
+        async with shard_session(db, db_user.shard) as owner_db:
+            updated = await crud.update_user_premium_status(db=owner_db, user_id=db_user.id)
+            await commit(owner_db)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=405, detail="Method not allowed")
+    if not updated:
+        raise HTTPException(status_code=404, detail="User not found")
+    return JSONResponse(status_code=200, content={"message" : "successfully updated the user premium status"})
+
+
+@phonebook.post("/admin/{param}/rotateToken", response_model=schemas.Token, dependencies=[Depends(verify_admin)])
+async def issue_user_token(param: str, db: AsyncSession = Depends(get_db)):
+    """[issues a new token for a user, e.g. after the user revoked theirs or lost it]
+
+    Args:
+        param (str): [email or phone number of the user]
+        db (AsyncSession, optional): [database dependency]. Defaults to Depends(get_db).
+
+    Raises:
+        HTTPException: [400, invalid mail or phone number]
+        HTTPException: [401, unauthorized action]
+        HTTPException: [404, user not found]
+        HTTPException: [503, the user is being moved to another shard]
+
+    Returns:
+        [JSONResponse]: [the new token]
+    """
+    db_user = await resolve_user(db, param, invalid_detail="param: Invalid Parameter, Please use a valid email or phone number")
+    check_writable(db_user)
+    async with shard_session(db, db_user.shard) as owner_db:
+        token = await crud.rotate_user_token(db=owner_db, user_id=db_user.id)
+        if token is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        await commit(owner_db)
+    return JSONResponse(status_code=200, content={"token": token})
@@ -0,0 +1,177 @@
+import time
+from bisect import bisect_left
+
+from sql_app.database import QueryStats, query_stats
+
+# seconds, for request and database time
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# statements per request
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+    """[Prometheus histogram with one series per label combination]
+
+    Args:
+        name (str): [metric name]
+        description (str): [HELP text]
+        buckets (Tuple[float]): [upper bounds, ascending, +Inf is implied]
+    """
+
+    def __init__(self, name: str, description: str, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            # a count per bucket and one for +Inf, then the sum and the total count
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        for labels, series in sorted(self._series.items()):
+            label_text = format_labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label_text, bound, cumulative))
+            lines.append("%s_sum{%s} %s" % (self.name, label_text, repr(float(series[-2]))))
+            lines.append("%s_count{%s} %d" % (self.name, label_text, series[-1]))
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def inc(self, labels: tuple):
+        self._values[labels] = self._values.get(labels, 0) + 1
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        for labels, value in sorted(self._values.items()):
+            lines.append("%s{%s} %d" % (self.name, format_labels(label_names, labels), value))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def set(self, labels: tuple, value: float):
+        self._values[labels] = value
+
+    def render(self, label_names: tuple):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s gauge" % self.name]
+        for labels, value in sorted(self._values.items()):
+            label_text = "{%s}" % format_labels(label_names, labels) if labels else ""
+            lines.append("%s%s %s" % (self.name, label_text, repr(float(value))))
+        return lines
+
+
+def format_labels(label_names: tuple, labels: tuple):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in zip(label_names, labels))
+
+
+ROUTE_LABELS = ("method", "route")
+
+requests_total = Counter("phonebook_requests_total", "Requests handled, by route and response status")
+request_duration = Histogram("phonebook_request_duration_seconds", "Time from receiving a request to sending its last byte", DURATION_BUCKETS)
+request_db_duration = Histogram("phonebook_request_db_seconds", "Time spent executing SQL statements per request", DURATION_BUCKETS)
+request_queries = Histogram("phonebook_request_queries", "SQL statements executed per request", QUERY_BUCKETS)
+rate_limited_total = Counter("phonebook_rate_limited_total", "Requests rejected with 429, by route and exceeded limit")
+shed_total = Counter("phonebook_shed_total", "Requests rejected with 503 by the concurrency limit, by route and reason")
+requests_in_flight = Gauge("phonebook_requests_in_flight", "Requests holding a concurrency slot")
+requests_queued = Gauge("phonebook_requests_queued", "Requests waiting for a concurrency slot")
+
+
+def observe_request(method: str, route: str, status: int, duration: float, stats: QueryStats):
+    requests_total.inc((method, route, status))
+    request_duration.observe((method, route), duration)
+    request_db_duration.observe((method, route), stats.duration)
+    request_queries.observe((method, route), stats.count)
+
+
+def render():
+    """[Renders every metric of this process in the Prometheus text exposition format]
+
+    Returns:
+        [str]: [metrics text, served with content type text/plain; version=0.0.4]
+    """
+    lines = requests_total.render(ROUTE_LABELS + ("status",))
+    for histogram in (request_duration, request_db_duration, request_queries):
+        lines.extend(histogram.render(ROUTE_LABELS))
+    lines.extend(rate_limited_total.render(ROUTE_LABELS + ("limit",)))
+    lines.extend(shed_total.render(ROUTE_LABELS + ("reason",)))
+    lines.extend(requests_in_flight.render(()))
+    lines.extend(requests_queued.render(()))
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(stats: QueryStats, handler_duration: float):
+    return 'db;dur=%.3f;desc="%d queries", db-slowest;dur=%.3f, handler;dur=%.3f' % (
+        stats.duration * 1000, stats.count, stats.slowest * 1000, handler_duration * 1000)
+
+
+class MetricsMiddleware:
+    """[Times every request and counts its SQL statements, adding a Server-Timing header and recording the metrics]
+
+    The header carries the database time and statement count, the slowest statement and the handler time up to the
+    response headers. Statements run while a streaming body is sent are only in the recorded metrics.
+    Metrics are per process, every worker serves its own.
+
+    Args:
+        app (ASGIApp): [wrapped application]
+        routes (List[BaseRoute]): [application routes, used to label requests by path template rather than by path]
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+        self._route_paths = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stats, time.perf_counter() - started).encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            query_stats.reset(token)
+            observe_request(scope["method"], self.route_path(scope), status, time.perf_counter() - started, stats)
+
+    def route_path(self, scope):
+        # the router leaves the matched endpoint in the scope, paths themselves would give a series per user
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        if endpoint not in self._route_paths:
+            self._route_paths = {getattr(route, "endpoint", None): route.path for route in self.routes}
+        return self._route_paths.get(endpoint, UNMATCHED_ROUTE)
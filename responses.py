@@ -0,0 +1,29 @@
+import json
+
+from fastapi.responses import JSONResponse as StdlibJSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson
+    orjson = None
+
+
+def dumps(content):
+    """[Serializes plain dicts, lists, strings and numbers to compact UTF-8 JSON, with orjson when it is installed]
+
+    Args:
+        content (Any): [JSON compatible content]
+
+    Returns:
+        [bytes]: [JSON document]
+    """
+    if orjson is None:
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    return orjson.dumps(content)
+
+
+class JSONResponse(StdlibJSONResponse):
+    """[JSON response rendered by dumps, several times faster on long contact lists when orjson is installed]"""
+
+    def render(self, content):
+        return dumps(content)
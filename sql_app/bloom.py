@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import struct
+
+from sqlalchemy import select
+
+from . import models
+from .config import settings
+
+logger = logging.getLogger("phonebook.bloom")
+
+SNAPSHOT_MAGIC = b"PBBF1"
+SNAPSHOT_HEADER = struct.Struct(">5sQB")
+# the directory has the emails and phone numbers of the users of every shard
+DIRECTORY_QUERY = select(models.UserShard.email, models.UserShard.phonenumber)
+# directory rows fetched per round trip while rebuilding, the event loop serves requests between them
+REBUILD_FETCH_SIZE = 10000
+
+
+class BloomFilter:
+    """[Set membership test without false negatives, a few bits per value instead of the values themselves]
+
+    A value that was added is always reported as possibly present, one that was not is reported absent except for about
+    false_positive_rate of them. Values cannot be removed, removed values stay possibly present until a rebuild.
+
+    Args:
+        capacity (int): [values expected, beyond it the false positive rate grows]
+        false_positive_rate (float): [chance that an absent value is reported present at capacity]
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        self.num_bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        # two 64 bit hashes combined as h1 + i * h2 give num_hashes independent enough positions from one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = struct.unpack(">QQ", digest)
+        return [(first + index * second) % self.num_bits for index in range(self.num_hashes)]
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value: str):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def dump(self):
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def load(cls, data: bytes):
+        magic, num_bits, num_hashes = SNAPSHOT_HEADER.unpack_from(data)
+        bits = data[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or len(bits) != (num_bits + 7) // 8:
+            raise ValueError("Not a bloom filter snapshot")
+        bloom = cls.__new__(cls)
+        bloom.num_bits, bloom.num_hashes, bloom.bits, bloom.count = num_bits, num_hashes, bytearray(bits), 0
+        return bloom
+
+
+class RegisteredUsers:
+    """[Bloom filter over the emails and phone numbers of registered users, to skip duplicate checks for new ones]
+
+    Only definite negatives are used. Every worker process keeps its own filter, updated by the writes it serves and
+    rebuilt from the user_shards directory every settings.existence_filter_refresh seconds, so users registered through
+    another worker can be missed until the next rebuild. It is therefore only consulted where a unique index backs it up,
+    the duplicate checks of registration, never to answer a lookup.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self._added_while_rebuilding = None
+
+    def might_exist(self, value: str):
+        # no filter yet (disabled, or not built), every value may exist
+        return self.bloom is None or value in self.bloom
+
+    def add(self, *values: str):
+        if self.bloom is not None:
+            for value in values:
+                self.bloom.add(value)
+        if self._added_while_rebuilding is not None:
+            self._added_while_rebuilding.extend(values)
+
+    def rebuild(self, connection):
+        """[Builds a new filter from every user_shards row and swaps it in, blocking while it is built, e.g. on startup]
+
+        Args:
+            connection (Connection): [shard 0 database connection, sync]
+
+        Returns:
+            [int]: [values added]
+        """
+        # requests keep being served while the users are read, their writes may be missing from the rows
+        self._added_while_rebuilding = []
+        try:
+            bloom = self._build(connection.execute(DIRECTORY_QUERY).all())
+            bloom.update(self._added_while_rebuilding)
+        finally:
+            self._added_while_rebuilding = None
+        self.bloom = bloom
+        return bloom.count
+
+    async def rebuild_async(self, async_engine):
+        """[Builds a new filter from every user_shards row in a worker thread and swaps it in, requests are served meanwhile]
+
+        Args:
+            async_engine (AsyncEngine): [shard 0 engine]
+
+        Returns:
+            [int]: [values added]
+        """
+        self._added_while_rebuilding = []
+        try:
+            rows = []
+            async with async_engine.connect() as connection:
+                result = await connection.stream(DIRECTORY_QUERY)
+                async for partition in result.partitions(REBUILD_FETCH_SIZE):
+                    rows.extend(partition)
+            # hashing every value takes seconds for a million users, the event loop would stall as long
+            bloom = await asyncio.get_event_loop().run_in_executor(None, self._build, rows)
+            # the worker thread only touched the new filter, values added since go in here on the event loop
+            bloom.update(self._added_while_rebuilding)
+        finally:
+            self._added_while_rebuilding = None
+        self.bloom = bloom
+        return bloom.count
+
+    @staticmethod
+    def _build(rows):
+        bloom = BloomFilter(max(settings.existence_filter_capacity, 2 * len(rows)), settings.existence_filter_error_rate)
+        for email, phonenumber in rows:
+            bloom.add(email)
+            bloom.add(phonenumber)
+        return bloom
+
+    def save(self, path: str):
+        if self.bloom is None:
+            return
+        # each worker saves on shutdown, write aside and rename so readers never see a partial snapshot
+        partial = "%s.%d" % (path, os.getpid())
+        with open(partial, "wb") as snapshot:
+            snapshot.write(self.bloom.dump())
+        os.replace(partial, path)
+
+    def restore(self, path: str):
+        """[Loads a snapshot saved by an earlier run, serving from it until the first rebuild]
+
+        Args:
+            path (str): [snapshot file]
+
+        Returns:
+            [bool]: [whether a snapshot was loaded]
+        """
+        try:
+            with open(path, "rb") as snapshot:
+                self.bloom = BloomFilter.load(snapshot.read())
+        except (OSError, ValueError, struct.error):
+            return False
+        return True
+
+    async def keep_fresh(self, async_engine, interval: int, stale: bool = False):
+        """[Rebuilds the filter every interval seconds until cancelled, a failed rebuild keeps the current filter]
+
+        Args:
+            async_engine (AsyncEngine): [shard 0 engine to read the user_shards directory with]
+            interval (int): [seconds between rebuilds]
+            stale (bool, optional): [rebuild at once, e.g. after restoring a snapshot]. Defaults to False.
+        """
+        while True:
+            if not stale:
+                await asyncio.sleep(interval)
+            stale = False
+            try:
+                await self.rebuild_async(async_engine)
+            except Exception:
+                logger.exception("Rebuilding the registered users filter failed")
+
+
+registered_users = RegisteredUsers()
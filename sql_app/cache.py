@@ -0,0 +1,255 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+from .config import settings
+
+
+class CachedUser(NamedTuple):
+    """[Snapshot of a users row, enough to authorize a request and answer user lookups without the database]"""
+    id: int
+    name: str
+    email: str
+    phonenumber: str
+    premium: bool
+    token_hash: Optional[str]
+    # where the user's rows live and whether the resharding tool is moving them, see database.shards
+    shard: int = 0
+    moving: bool = False
+    # users.version when loaded, writes to the user's own columns invalidate the entry so it tags them reliably,
+    # contact writes do not and leave it behind
+    version: int = 0
+
+    @classmethod
+    def from_orm(cls, db_user, shard: int = 0, moving: bool = False):
+        return cls(id=db_user.id, name=db_user.name, email=db_user.email, phonenumber=db_user.phonenumber,
+                   premium=bool(db_user.premium), token_hash=db_user.token, shard=shard, moving=bool(moving),
+                   version=db_user.version or 0)
+
+
+class CacheError(Exception):
+    pass
+
+
+class LRUCache:
+    """[In process least recently used cache with a per entry time to live]
+
+    Args:
+        max_entries (int): [entries kept before the least recently used one is evicted]
+        ttl (int): [seconds an entry stays valid]
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+
+class RespClient:
+    """[Connection to a server speaking the redis protocol (RESP), opened on first use and reopened after errors]
+
+    Args:
+        url (str): [redis://host:port/db]
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    async def command(self, *args: str):
+        """[Sends one command and reads its reply]
+
+        Raises:
+            CacheError: [error reply]
+            OSError: [server unreachable]
+
+        Returns:
+            [Any]: [reply]
+        """
+        return (await self.pipeline(args))[0]
+
+    async def pipeline(self, *commands):
+        """[Sends the commands at once and reads their replies, one round trip for all of them]
+
+        Args:
+            commands (Tuple[str]): [each command with its arguments]
+
+        Raises:
+            CacheError: [error reply]
+            OSError: [server unreachable]
+
+        Returns:
+            [list]: [reply per command]
+        """
+        # created lazily so the lock belongs to the serving event loop, not the importing one
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                self._writer.write(b"".join(self._encode(args) for args in commands))
+                await self._writer.drain()
+                replies = [await self._read_reply() for _ in commands]
+            except (OSError, asyncio.IncompleteReadError):
+                self._close()
+                raise
+        for reply in replies:
+            if isinstance(reply, CacheError):
+                raise reply
+        return replies
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            self._writer.write(self._encode(("AUTH", self.password)))
+            await self._read_reply()
+        if self.db:
+            self._writer.write(self._encode(("SELECT", str(self.db))))
+            await self._read_reply()
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    @staticmethod
+    def _encode(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg.encode() if isinstance(arg, str) else arg
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        # error replies are returned rather than raised, the replies of the rest of a pipeline still have to be read
+        line = await self._reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode()
+        if prefix == b"-":
+            return CacheError(payload.decode())
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2].decode()
+        if prefix == b"*":
+            return [await self._read_reply() for _ in range(int(payload))]
+        raise CacheError("Unexpected reply from cache server: %r" % line)
+
+
+# errors of an unavailable or misbehaving server, callers degrade instead of failing the request
+SERVER_ERRORS = (CacheError, OSError, asyncio.IncompleteReadError)
+
+
+class RedisCache:
+    """[Cache kept in any server speaking the redis protocol (RESP), values are stored as JSON with an expiry]
+
+    Errors talking to the server are treated as cache misses so an unavailable cache only costs database reads.
+
+    Args:
+        url (str): [redis://host:port/db]
+        ttl (int): [seconds an entry stays valid]
+    """
+
+    def __init__(self, url: str, ttl: int):
+        self.client = RespClient(url)
+        self.ttl = ttl
+
+    async def get(self, key: str):
+        try:
+            value = await self.client.command("GET", key)
+        except SERVER_ERRORS:
+            return None
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value):
+        try:
+            await self.client.command("SET", key, json.dumps(value), "EX", str(self.ttl))
+        except SERVER_ERRORS:
+            pass
+
+    async def delete(self, *keys: str):
+        try:
+            await self.client.command("DEL", *keys)
+        except SERVER_ERRORS:
+            pass
+
+
+def create_cache(url: str, ttl: Optional[int] = None):
+    """[Builds the cache backend named by url, memory for the in process LRU or redis://host:port/db]
+
+    Args:
+        url (str): [cache url]
+        ttl (Optional[int], optional): [seconds an entry stays valid]. Defaults to settings.cache_ttl.
+
+    Returns:
+        [Union[LRUCache, RedisCache]]: [cache backend]
+    """
+    if ttl is None:
+        ttl = settings.cache_ttl
+    if url.startswith("redis://"):
+        return RedisCache(url, ttl=ttl)
+    return LRUCache(max_entries=settings.cache_max_entries, ttl=ttl)
+
+
+user_cache = create_cache(settings.cache_url)
+
+
+def user_keys(user_id: int, email: str, phonenumber: str):
+    return ["user:id:%d" % user_id, "user:email:%s" % email, "user:phone:%s" % phonenumber]
+
+
+def user_param_key(param: str, is_email: bool):
+    return "user:%s:%s" % ("email" if is_email else "phone", param)
+
+
+async def get_user(key: str):
+    value = await user_cache.get(key)
+    if value is None:
+        return None
+    return CachedUser(*value)
+
+
+async def store_user(user: CachedUser):
+    for key in user_keys(user.id, user.email, user.phonenumber):
+        await user_cache.set(key, list(user))
+
+
+async def invalidate_user(user_id: int, email: str, phonenumber: str):
+    await user_cache.delete(*user_keys(user_id, email, phonenumber))
@@ -0,0 +1,93 @@
+from typing import Dict, List, Tuple
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """[Application settings, each field can be overridden by the upper cased environment variable or a .env file]
+
+    Attributes:
+        database_url (str): [sync database url, the async driver is derived from it]
+        shard_urls (List[str]): [databases of shards 1 and up, database_url is shard 0 and holds the directory of users' shards]
+        replica_urls (List[str]): [read replicas of database_url, read only handlers are spread over the healthy ones]
+        shard_replica_urls (Dict[int, List[str]]): [read replicas of the shard_urls databases, keyed by shard number from 1]
+        replica_max_lag_ms (int): [milliseconds a replica may be behind and still serve reads, also how long a user's own
+                                   reads stay on the primary after they wrote]
+        replica_check_interval (int): [seconds between replica health checks]
+        db_pool_size (int): [connections kept open in the pool]
+        db_max_overflow (int): [connections allowed above db_pool_size under load]
+        db_pool_pre_ping (bool): [test connections before handing them out]
+        db_pool_recycle (int): [seconds after which a pooled connection is replaced, -1 disables]
+        db_statement_timeout (int): [milliseconds a statement may run before the server cancels it, 0 disables]
+        sqlite_busy_timeout (int): [milliseconds sqlite waits on a locked database before failing]
+        slow_statement_ms (int): [statements running at least this many milliseconds are logged, 0 disables]
+        cache_url (str): [user cache backend, memory for an in process LRU or redis://host:port/db for a shared server]
+        cache_ttl (int): [seconds a cached user stays valid, bounds staleness across workers with the memory backend,
+                          e.g. how long other workers accept a rotated or revoked token]
+        cache_max_entries (int): [entries kept by the memory backend]
+        token_secret (str): [key for the keyed hash tokens are stored as, changing it invalidates every token, has no default so a
+                             deployment cannot start with a key anyone reading the source knows]
+        token_cache_ttl (int): [seconds a verified token is trusted without hashing it again]
+        admin_token (str): [token for the admin endpoints, empty disables them]
+        auto_migrate (bool): [apply pending migrations on startup, otherwise refuse to start until `python cli.py migrate` ran]
+        prewarm_users (int): [most recently created users loaded into the user cache on startup]
+        existence_filter (bool): [keep a bloom filter of registered emails and phone numbers so registration skips the duplicate check for new ones]
+        existence_filter_capacity (int): [emails and phone numbers the filter is sized for at least, two per user]
+        existence_filter_error_rate (float): [share of misses the filter cannot rule out at capacity]
+        existence_filter_refresh (int): [seconds between rebuilds from the user_shards directory, bounds staleness across workers]
+        existence_filter_snapshot (str): [file the filter is saved to on shutdown and loaded from on startup, empty disables]
+        group_commit_ms (int): [milliseconds single contact inserts wait to share a transaction with concurrent ones, 0 disables]
+        group_commit_max_batch (int): [writes sharing one transaction at most]
+        idempotency_key_ttl (int): [seconds a response is replayed for a repeated Idempotency-Key]
+        tombstone_retention (int): [seconds deleted contacts are remembered for contact syncs, older cursors have to start over]
+        rate_limit_url (str): [rate limit counters, memory for per process buckets or redis://host:port/db shared by every worker]
+        rate_limit_rate (float): [requests per second each client (token, or address without one) may make, 0 disables]
+        rate_limit_burst (int): [requests a client may make at once above rate_limit_rate]
+        rate_limit_routes (Dict[str, Tuple[float, int]]): [rate and burst per client for single routes, keyed "METHOD /path/template"]
+        max_concurrent_requests (int): [requests handled at once per worker, more wait in a queue, 0 disables]
+        max_queued_requests (int): [requests waiting for a slot at most, more are rejected with 503 at once]
+        queue_timeout_ms (int): [milliseconds a request waits for a slot before it is rejected with 503]
+    """
+    database_url: str = "sqlite:///./sql_app.db"
+    shard_urls: List[str] = []
+    replica_urls: List[str] = []
+    shard_replica_urls: Dict[int, List[str]] = {}
+    replica_max_lag_ms: int = 1000
+    replica_check_interval: int = 5
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_pre_ping: bool = True
+    db_pool_recycle: int = 1800
+    db_statement_timeout: int = 30000
+    sqlite_busy_timeout: int = 5000
+    slow_statement_ms: int = 200
+    cache_url: str = "memory"
+    cache_ttl: int = 30
+    cache_max_entries: int = 100000
+    token_secret: str
+    token_cache_ttl: int = 30
+    admin_token: str = ""
+    auto_migrate: bool = True
+    prewarm_users: int = 1000
+    existence_filter: bool = True
+    existence_filter_capacity: int = 1000000
+    existence_filter_error_rate: float = 0.01
+    existence_filter_refresh: int = 60
+    existence_filter_snapshot: str = ""
+    group_commit_ms: int = 0
+    group_commit_max_batch: int = 64
+    idempotency_key_ttl: int = 86400
+    tombstone_retention: int = 2592000
+    rate_limit_url: str = "memory"
+    rate_limit_rate: float = 0
+    rate_limit_burst: int = 20
+    rate_limit_routes: Dict[str, Tuple[float, int]] = {}
+    max_concurrent_requests: int = 0
+    max_queued_requests: int = 100
+    queue_timeout_ms: int = 1000
+
+    class Config:
+        env_file = ".env"
+
+
+settings = Settings()
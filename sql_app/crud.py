@@ -1,123 +1,618 @@
 import time
-from random import randint
+from typing import Dict, List, Optional, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, delete, insert, literal, or_, select, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import models, schemas
+from . import cache, models, schemas, search, tokens
+from .unit_of_work import after_commit, commit, rollback
+from .bloom import registered_users
+from .database import shard_session, shards
 
+CONTACT_COLUMNS = (models.Contact.id, models.Contact.name, models.Contact.email, models.Contact.phonenumber,
+                   models.Contact.owner_id)
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.User).where(models.User.id == user_id))
+    return result.scalars().first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
 
-def get_user_by_phonenumber(db: Session, phonenumber: str):
-    return db.query(models.User).filter(models.User.phonenumber == phonenumber).first()
-    
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(models.User).offset(skip).limit(limit))
+    return result.scalars().all()
 
-def create_user(db: Session, user:schemas.UserCreate):
-    token = hash(user.email + user.phonenumber + str(time.time()) + str(randint(0,1000000)))
-    db_user = models.User(email=user.email, phonenumber=user.phonenumber, name=user.name, token=token)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+async def get_user_by_phonenumber(db: AsyncSession, phonenumber: str):
+    result = await db.execute(select(models.User).where(models.User.phonenumber == phonenumber))
+    return result.scalars().first()
+
+async def get_user_by_param(db: AsyncSession, param: str, is_email: bool):
+    column = models.User.email if is_email else models.User.phonenumber
+    result = await db.execute(select(models.User).where(column == param))
+    return result.scalars().first()
+
+async def get_users_by_params(db: AsyncSession, emails: List[str], phonenumbers: List[str], chunk_size: int = 500):
+    """[Fetches the users with any of the emails or phonenumbers, one IN query on the indexed column per chunk,
+    with several shards first in the directory and then by id on each shard holding some of them]
+
+    Args:
+        db (AsyncSession): [shard 0 database session, a replica's for reads that may lag]
+        emails (List[str]): [distinct emails]
+        phonenumbers (List[str]): [distinct canonical phone numbers]
+        chunk_size (int, optional): [values per statement, below the bound parameter limit of older SQLite]. Defaults to 500.
+
+    Returns:
+        [List[Row]]: [(name, email, phonenumber) of every user found]
+    """
+    user_columns = select(models.User.name, models.User.email, models.User.phonenumber)
+    if len(shards) == 1:
+        return (await _select_in(db, user_columns, models.User.email, emails, chunk_size)
+                + await _select_in(db, user_columns, models.User.phonenumber, phonenumbers, chunk_size))
+    location_columns = select(models.UserShard.user_id, models.UserShard.shard)
+    locations = (await _select_in(db, location_columns, models.UserShard.email, emails, chunk_size)
+                 + await _select_in(db, location_columns, models.UserShard.phonenumber, phonenumbers, chunk_size))
+    user_ids = {}
+    for location in locations:
+        user_ids.setdefault(location.shard, set()).add(location.user_id)
+    users = []
+    for shard, ids in user_ids.items():
+        # db already is the session shard 0 is read with, replica or not
+        async with shard_session(db, shard, readonly=shard != 0) as shard_db:
+            users.extend(await _select_in(shard_db, user_columns, models.User.id, sorted(ids), chunk_size))
+    return users
+
+async def _select_in(db: AsyncSession, query, column, values: list, chunk_size: int):
+    rows = []
+    for start in range(0, len(values), chunk_size):
+        rows.extend(await db.execute(query.where(column.in_(values[start:start + chunk_size]))))
+    return rows
+
+async def locate_user(db: AsyncSession, param: str, is_email: bool):
+    """[Looks the user up in the directory, which covers every shard]
+
+    Args:
+        db (AsyncSession): [shard 0 database session]
+        param (str): [canonical email or phone number]
+        is_email (bool): [whether param is an email]
+
+    Returns:
+        [Optional[models.UserShard]]: [user id, shard and moving flag, None if nobody registered param]
+    """
+    column = models.UserShard.email if is_email else models.UserShard.phonenumber
+    result = await db.execute(select(models.UserShard).where(column == param))
+    return result.scalars().first()
+
+async def get_cached_user_by_param(db: AsyncSession, param: str, is_email: bool):
+    key = cache.user_param_key(param, is_email)
+    cached_user = await cache.get_user(key)
+    if cached_user is not None:
+        return cached_user
+    if len(shards) == 1:
+        db_user = await get_user_by_param(db, param=param, is_email=is_email)
+        location = None
+    else:
+        location = await locate_user(db, param=param, is_email=is_email)
+        if location is None:
+            return None
+        async with shard_session(db, location.shard) as shard_db:
+            db_user = await get_user(shard_db, location.user_id)
+    if db_user is None:
+        return None
+    cached_user = (cache.CachedUser.from_orm(db_user) if location is None
+                   else cache.CachedUser.from_orm(db_user, shard=location.shard, moving=location.moving))
+    await cache.store_user(cached_user)
+    return cached_user
+
+
+async def prewarm_user_cache(db: AsyncSession, limit: int):
+    if len(shards) == 1:
+        result = await db.execute(select(models.User).order_by(models.User.id.desc()).limit(limit))
+        users = result.scalars().all()
+        for db_user in users:
+            await cache.store_user(cache.CachedUser.from_orm(db_user))
+        return len(users)
+    result = await db.execute(select(models.UserShard).order_by(models.UserShard.user_id.desc()).limit(limit))
+    locations = {location.user_id: location for location in result.scalars()}
+    user_ids = {}
+    for location in locations.values():
+        user_ids.setdefault(location.shard, []).append(location.user_id)
+    stored = 0
+    for shard, ids in user_ids.items():
+        async with shard_session(db, shard) as shard_db:
+            result = await shard_db.execute(select(models.User).where(models.User.id.in_(ids)))
+            for db_user in result.scalars():
+                location = locations[db_user.id]
+                await cache.store_user(cache.CachedUser.from_orm(db_user, shard=location.shard, moving=location.moving))
+                stored += 1
+    return stored
+
+
+async def create_user(db: AsyncSession, user:schemas.UserCreate):
+    """[Creates the user with a fresh token, only its hash is stored, on the shard its id is placed on
+
+    The directory row reserves the email and phone number and allocates the id in db's transaction. A user on shard 0
+    is inserted in the same transaction, one on another shard only once it committed.
+
+    Raises:
+        IntegrityError: [the directory row was refused for another reason than the email or phone number being taken]
+
+    Returns:
+        [Optional[Tuple[models.User, str]]]: [user and token, the only time the token is available,
+                                              None if the email or phone number is already registered]
+    """
+    token = tokens.generate_token()
+    location = models.UserShard(email=user.email, phonenumber=user.phonenumber, shard=0, moving=False)
+    db.add(location)
+    try:
+        await db.flush()
+    except IntegrityError:
+        await rollback(db)
+        # registered concurrently, or by another worker since its existence filter was built, anything else is not
+        if await _registered(db, user.email, user.phonenumber):
+            return None
+        raise
+    # every attribute is set up front so the response never lazy loads outside the event loop
+    db_user = models.User(id=location.user_id, email=user.email, phonenumber=user.phonenumber, name=user.name,
+                          token=tokens.hash_token(token), premium=False, version=0, contacts=[])
+    shard = shards.placement(location.user_id)
+    if shard == 0:
+        db.add(db_user)
+    else:
+        location.shard = shard
+        after_commit(db, _create_on_shard, db_user, shard)
+    after_commit(db, registered_users.add, user.email, user.phonenumber)
+    return db_user, token
+
+async def _registered(db: AsyncSession, email: str, phonenumber: str):
+    result = await db.execute(select(models.UserShard.user_id)
+                              .where(or_(models.UserShard.email == email, models.UserShard.phonenumber == phonenumber))
+                              .limit(1))
+    return result.scalar() is not None
+
+async def _create_on_shard(db_user: models.User, shard: int):
+    try:
+        async with shards.session(shard) as db:
+            db.add(db_user)
+            await commit(db)
+    except Exception:
+        # give the email and phone number back, the directory must not point at a user that does not exist
+        async with shards.session(0) as directory:
+            await directory.execute(delete(models.UserShard).where(models.UserShard.user_id == db_user.id))
+            await commit(directory)
+        raise
+
+async def rotate_user_token(db: AsyncSession, user_id: int):
+    """[Replaces the user's token with a fresh one, the old token stops working once the user's cache entries are
+    dropped, see tokens.verify_token]
+
+    Returns:
+        [Optional[str]]: [new token, None if the user does not exist]
+    """
+    db_user = await get_user(db, user_id)
+    if db_user is None:
+        return None
+    token = tokens.generate_token()
+    db_user.token = tokens.hash_token(token)
+    await _next_version(db, user_id)
+    after_commit(db, cache.invalidate_user, user_id, db_user.email, db_user.phonenumber)
+    return token
+
+async def revoke_user_token(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id)
+    if db_user is None:
+        return False
+    db_user.token = None
+    await _next_version(db, user_id)
+    after_commit(db, cache.invalidate_user, user_id, db_user.email, db_user.phonenumber)
+    return True
+
+async def get_contacts(db: AsyncSession, user_id: int, after: Optional[int] = None, limit: int = 100):
+    """[Fetches one page of the user's contacts as plain dicts, ready to be rendered without ORM objects or pydantic models]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        after (Optional[int], optional): [contact id the page starts after]. Defaults to None.
+        limit (int, optional): [page size]. Defaults to 100.
+
+    Returns:
+        [List[dict]]: [contacts (id, name, email, phonenumber, owner_id) ordered by id]
+    """
+    query = select(*CONTACT_COLUMNS).where(models.Contact.owner_id == user_id)
+    if after is not None:
+        query = query.where(models.Contact.id > after)
+    result = await db.execute(query.order_by(models.Contact.id).limit(limit))
+    return [dict(row._mapping) for row in result]
+
+async def stream_contacts(db: AsyncSession, user_id: int, partition_size: int = 1000):
+    """[Yields the user's contacts as plain (id, name, email, phonenumber) rows from a server side cursor]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        partition_size (int, optional): [rows fetched per round trip]. Defaults to 1000.
+
+    Yields:
+        [List[Row]]: [up to partition_size rows, ordered by contact id]
+    """
+    result = await db.stream(select(models.Contact.id, models.Contact.name, models.Contact.email, models.Contact.phonenumber)
+                             .where(models.Contact.owner_id == user_id)
+                             .order_by(models.Contact.id))
+    async for partition in result.partitions(partition_size):
+        yield partition
+
+async def search_contacts(db: AsyncSession, user_id: int, q: str, limit: int = 20):
+    """[Finds up to limit of the user's contacts whose name, email or phonenumber starts with every word of q, or whose phonenumber contains q]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        q (str): [search text]
+        limit (int, optional): [maximum contacts returned]. Defaults to 20.
+
+    Returns:
+        [List[dict]]: [matching contacts ordered by name]
+    """
+    if not q.split():
+        return []
+    if "contacts_owner_fts" not in search.available_indexes:
+        # no full text index on this backend, pattern matching is answered from the postgres trigram index
+        result = await db.execute(select(*CONTACT_COLUMNS)
+                                  .where(models.Contact.owner_id == user_id)
+                                  .where(or_(models.Contact.name.startswith(q, autoescape=True),
+                                             models.Contact.email.startswith(q, autoescape=True),
+                                             models.Contact.phonenumber.contains(q, autoescape=True)))
+                                  .order_by(models.Contact.name)
+                                  .limit(limit))
+        return [dict(row._mapping) for row in result]
+    rowid_from, rowid_to = search.owner_rowid_range(user_id)
+    params = {"owner_id": user_id, "limit": limit, "prefix_match": search.prefix_match_expression(q),
+              "id_mask": search.CONTACT_ID_MASK, "rowid_from": rowid_from, "rowid_to": rowid_to}
+    # both indexes are keyed by owner, every match is looked up by id and sorted by name before the limit is taken, so the
+    # first page is the first by name even when the matches were inserted out of name order
+    matches = ("SELECT rowid & :id_mask FROM contacts_owner_fts WHERE contacts_owner_fts MATCH :prefix_match "
+               "AND rowid >= :rowid_from AND rowid < :rowid_to")
+    phone_range = search.phone_suffix_range(q)
+    if phone_range is not None and "contact_phone_suffixes" in search.available_indexes:
+        matches += (" UNION SELECT contact_id FROM contact_phone_suffixes "
+                    "WHERE owner_id = :owner_id AND suffix >= :phone_from AND suffix < :phone_to")
+        params["phone_from"], params["phone_to"] = phone_range
+    result = await db.execute(text("SELECT id, name, email, phonenumber, owner_id FROM contacts "
+                                   "WHERE id IN (" + matches + ") ORDER BY name LIMIT :limit"), params)
+    return [dict(row._mapping) for row in result]
+
+
+async def get_contact_changes(db: AsyncSession, user_id: int, since: Tuple[int, int], limit: int = 1000):
+    """[Fetches the user's contacts inserted or changed and the ids of those deleted after since, in the order they were
+    made, so a client keeping a copy of the address book only downloads what changed]
 
-def get_contacts(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Contact).filter(models.Contact.owner_id == user_id).offset(skip).limit(limit).all()
+    Every transaction writing contacts takes the next version of their owner, whose row it then holds locked until it
+    commits, so a user's changes commit in version order and a cursor never skips one committed late.
 
-def create_user_contact(db: Session, contact: schemas.ContactCreate, user_id: int):
-    db_contact = models.Contact(**contact.dict(), owner_id=user_id)
-    db.add(db_contact)
-    db.commit()
-    db.refresh(db_contact)
-    return db_contact
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        since (Tuple[int, int]): [cursor, (version, contact id) of the last change the client has, (0, 0) for everything]
+        limit (int, optional): [changes per page]. Defaults to 1000.
 
-def contact_check(db: Session, user_id: int, contact_mail: str, contact_phonenumber: str):
-    db_contact = db.query(models.Contact).filter(models.Contact.owner_id == user_id).filter(models.Contact.email == contact_mail).filter(models.Contact.phonenumber == contact_phonenumber).first()
+    Returns:
+        [Optional[dict]]: [contacts (id, name, email, phonenumber, owner_id), deleted contact ids, the cursor of the
+                           last change returned and whether more may follow, None when changes from since are no
+                           longer known and the client must start over from (0, 0)]
+    """
+    if since != (0, 0):
+        resync_version = (await db.execute(select(models.User.resync_version).where(models.User.id == user_id))).scalar()
+        if since[0] < (resync_version or 0):
+            return None
+    result = await db.execute(select(*CONTACT_COLUMNS, models.Contact.version)
+                              .where(models.Contact.owner_id == user_id)
+                              .where(tuple_(models.Contact.version, models.Contact.id) > since)
+                              .order_by(models.Contact.version, models.Contact.id)
+                              .limit(limit + 1))
+    changes = [(row.version, row.id, dict(row._mapping)) for row in result]
+    # a client starting over has nothing to delete
+    if since != (0, 0):
+        result = await db.execute(select(models.ContactTombstone.version, models.ContactTombstone.contact_id)
+                                  .where(models.ContactTombstone.owner_id == user_id)
+                                  .where(tuple_(models.ContactTombstone.version, models.ContactTombstone.contact_id) > since)
+                                  .order_by(models.ContactTombstone.version, models.ContactTombstone.contact_id)
+                                  .limit(limit + 1))
+        changes.extend((row.version, row.contact_id, None) for row in result)
+    changes.sort(key=lambda change: change[:2])
+    page = changes[:limit]
+    contacts = []
+    deleted = []
+    for version, contact_id, contact in page:
+        if contact is None:
+            deleted.append(contact_id)
+        else:
+            del contact["version"]
+            contacts.append(contact)
+    return {"contacts": contacts, "deleted": deleted, "cursor": page[-1][:2] if page else since, "more": len(changes) > limit}
+
+async def get_user_version(db: AsyncSession, user_id: int):
+    """[Reads the user's version, which every write to the user or their contacts bumps, with one primary key lookup]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [user id]
+
+    Returns:
+        [Optional[int]]: [version, None if the user does not exist]
+    """
+    return (await db.execute(select(models.User.version).where(models.User.id == user_id))).scalar()
+
+async def _next_version(db: AsyncSession, user_id: int, only_if=None):
+    """[Takes the user's next version for the transaction's changes, the update locks the user's row until it ends.
+    Every write changing the user or their contacts takes one, see get_contact_changes and the ETags in main.py]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [user id]
+        only_if (Optional[ClauseElement], optional): [condition checked in the same statement, e.g. that there are contacts
+                                                      to change, writes that change nothing keep the version]. Defaults to None.
+
+    Returns:
+        [Optional[ScalarSelect]]: [subquery reading the version back, statements stamping rows with it need no round trip of
+                                   their own, None if only_if did not hold]
+    """
+    statement = update(models.User).where(models.User.id == user_id)
+    if only_if is not None:
+        statement = statement.where(only_if)
+    result = await db.execute(statement
+                              .values(version=models.User.version + 1)
+                              .execution_options(synchronize_session=False))
+    if not result.rowcount:
+        return None
+    return select(models.User.version).where(models.User.id == user_id).scalar_subquery()
+
+async def create_user_contact(db: AsyncSession, contact: schemas.ContactCreate, user_id: int):
+    """[Inserts the contact unless the user has one with the same email and phonenumber]
+
+    Returns:
+        [Optional[dict]]: [contact (id, name, email, phonenumber, owner_id) from the inserted values and key,
+                           None if it lost a race with a concurrent insert of the same contact]
+    """
+    values = {**contact.dict(), "owner_id": user_id}
+    version = await _next_version(db, user_id, only_if=~select(models.Contact.id)
+                                  .where(models.Contact.owner_id == user_id)
+                                  .where(models.Contact.email == contact.email)
+                                  .where(models.Contact.phonenumber == contact.phonenumber).exists())
+    if version is None:
+        return None
+    # a conflict leaves the transaction usable, it may be shared with other requests' writes (see group_commit)
+    result = await db.execute(_insert_ignoring_duplicates(db, models.Contact.__table__)
+                              .values({**values, "version": version, "updated_at": time.time()}))
+    if not result.rowcount:
+        return None
+    return {"id": result.inserted_primary_key[0], **values}
+
+def _insert_ignoring_duplicates(db: AsyncSession, table):
+    dialect = db.bind.dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+async def bulk_create_user_contacts(db: AsyncSession, contacts: List[schemas.ContactCreate], user_id: int, chunk_size: int = 400):
+    """[Inserts contacts with one duplicate probe and one executemany per chunk, all in the request's transaction]
+
+    Args:
+        db (AsyncSession): [database session]
+        contacts (List[schemas.ContactCreate]): [validated contacts]
+        user_id (int): [owner id]
+        chunk_size (int, optional): [contacts per statement, two bound parameters each in the duplicate probe
+                                     so the default stays under sqlite's 999 parameter limit]. Defaults to 400.
+
+    Returns:
+        [List[bool]]: [per contact, True if inserted and False if it duplicates an existing or earlier contact]
+    """
+    created = []
+    seen = set()
+    version = None
+    for start in range(0, len(contacts), chunk_size):
+        chunk = contacts[start:start + chunk_size]
+        keys = {(contact.email, contact.phonenumber) for contact in chunk} - seen
+        existing = set()
+        if keys:
+            result = await db.execute(select(models.Contact.email, models.Contact.phonenumber)
+                                      .where(models.Contact.owner_id == user_id)
+                                      .where(tuple_(models.Contact.email, models.Contact.phonenumber).in_(list(keys))))
+            existing = {tuple(row) for row in result}
+        rows = []
+        positions = []
+        for contact in chunk:
+            key = (contact.email, contact.phonenumber)
+            if key in seen or key in existing:
+                created.append(False)
+                continue
+            seen.add(key)
+            rows.append({**contact.dict(), "owner_id": user_id})
+            positions.append(len(created))
+            created.append(True)
+        if rows:
+            if version is None:
+                version = await _next_version(db, user_id)
+                updated_at = time.time()
+            # the unique index still guards against rows inserted concurrently after the duplicate probe
+            result = await db.execute(_insert_ignoring_duplicates(db, models.Contact.__table__)
+                                      .values(version=version, updated_at=updated_at), rows)
+            if result.rowcount != len(rows):
+                # some were skipped (or the driver does not count), only this transaction stamps rows with its version
+                inserted = await db.execute(select(models.Contact.email, models.Contact.phonenumber)
+                                            .where(models.Contact.owner_id == user_id)
+                                            .where(models.Contact.version == version)
+                                            .where(tuple_(models.Contact.email, models.Contact.phonenumber)
+                                                   .in_([(row["email"], row["phonenumber"]) for row in rows])))
+                inserted = {tuple(row) for row in inserted}
+                for position, row in zip(positions, rows):
+                    created[position] = (row["email"], row["phonenumber"]) in inserted
+    return created
+
+async def contact_check(db: AsyncSession, user_id: int, contact_mail: str, contact_phonenumber: str):
+    result = await db.execute(select(models.Contact).where(models.Contact.owner_id == user_id).where(models.Contact.email == contact_mail).where(models.Contact.phonenumber == contact_phonenumber))
+    db_contact = result.scalars().first()
     if db_contact is not None:
         return True
     else:
         return False
-        
 
-def update_user_email(db: Session, user_id: int, mail: str):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+
+async def update_user_email(db: AsyncSession, directory: AsyncSession, user_id: int, mail: str):
+    db_user = await get_user(db, user_id)
     if db_user is None:
         return None
+    old_email = db_user.email
     db_user.email = mail
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await _next_version(db, user_id)
+    await directory.execute(update(models.UserShard).where(models.UserShard.user_id == user_id).values(email=mail))
+    after_commit(db, registered_users.add, mail)
+    after_commit(db, cache.invalidate_user, user_id, old_email, db_user.phonenumber)
     return db_user
 
-def update_user_phonenumber(db: Session, user_id: int, phone_number: str):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+async def update_user_phonenumber(db: AsyncSession, directory: AsyncSession, user_id: int, phone_number: str):
+    db_user = await get_user(db, user_id)
     if db_user is None:
         return None
+    old_phonenumber = db_user.phonenumber
     db_user.phonenumber = phone_number
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await _next_version(db, user_id)
+    await directory.execute(update(models.UserShard).where(models.UserShard.user_id == user_id).values(phonenumber=phone_number))
+    after_commit(db, registered_users.add, phone_number)
+    after_commit(db, cache.invalidate_user, user_id, db_user.email, old_phonenumber)
     return db_user
 
-def delete_user(db: Session, user_id: int):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
-    skip = 0
-    limit = 100
-    try:
-        db_contacts = db.query(models.Contact).filter(models.Contact.owner_id == user_id).offset(skip).limit(limit).all()
-        for db_contact in db_contacts:
-            db.delete(db_contact)
-        db.delete(db_user)
-        db.commit()
-        return True
-    except:
-        return False
-    
-def update_contact_email(db: Session, user_id: int, email: str, mail: str):
-    db_contact = db.query(models.Contact).filter(models.Contact.owner_id == user_id and models.Contact.email == email).first()
-    db_contact.email = mail
-    db.add(db_contact)
-    db.commit()
-    db.refresh(db_contact)
-    return db_contact
-
-def update_contact_phonenumber(db: Session, user_id: int, phonenumber: str, newphonenumber: str):
-    db_contact = db.query(models.Contact).filter(models.Contact.owner_id == user_id and models.Contact.phonenumber == phonenumber).first()
-    db_contact.phonenumber = newphonenumber
-    db.add(db_contact)
-    db.commit()
-    db.refresh(db_contact)
-    return db_contact
-
-def delete_contact(db: Session, user_id: int, contact_param: str):
-    db_contact = db.query(models.Contact).filter(models.Contact.owner_id == user_id 
-                                                 and (models.Contact.phonenumber == contact_param 
-                                                      or models.Contact.email == contact_param)).first()
-    if db_contact is None:
-        return False
-    print(db_contact.email)
+async def delete_user(db: AsyncSession, directory: AsyncSession, user_id: int):
+    """[Deletes the user and all of their contacts with one DELETE each, in the request's transaction]
+
+    Args:
+        db (AsyncSession): [session on the user's shard]
+        directory (AsyncSession): [shard 0 session, the directory row goes too]
+        user_id (int): [user id]
+
+    Raises:
+        SQLAlchemyError: [the delete failed]
+
+    Returns:
+        [Optional[int]]: [contacts deleted, None if the user does not exist]
+    """
+    db_user = await get_user(db, user_id)
+    if db_user is None:
+        return None
+    # explicit rather than relying on ON DELETE CASCADE, sqlite tables created before the cascade lack it
+    result = await db.execute(delete(models.Contact)
+                              .where(models.Contact.owner_id == user_id)
+                              .execution_options(synchronize_session=False))
+    await db.execute(delete(models.User)
+                     .where(models.User.id == user_id)
+                     .execution_options(synchronize_session=False))
+    await directory.execute(delete(models.UserShard)
+                            .where(models.UserShard.user_id == user_id)
+                            .execution_options(synchronize_session=False))
+    after_commit(db, cache.invalidate_user, user_id, db_user.email, db_user.phonenumber)
+    return result.rowcount
+
+async def update_contact_email(db: AsyncSession, user_id: int, email: str, mail: str):
+    return await update_contacts_email(db, user_id=user_id, changes={email: mail})
+
+async def update_contact_phonenumber(db: AsyncSession, user_id: int, phonenumber: str, newphonenumber: str):
+    return await update_contacts_phonenumber(db, user_id=user_id, changes={phonenumber: newphonenumber})
+
+async def update_contacts_email(db: AsyncSession, user_id: int, changes: Dict[str, str]):
+    return await _update_contacts_column(db, user_id, models.Contact.email, changes)
+
+async def update_contacts_phonenumber(db: AsyncSession, user_id: int, changes: Dict[str, str]):
+    return await _update_contacts_column(db, user_id, models.Contact.phonenumber, changes)
+
+async def _update_contacts_column(db: AsyncSession, user_id: int, column, changes: Dict[str, str], chunk_size: int = 300):
+    """[Rewrites column from each old value to its new value for the user's contacts, one UPDATE per chunk]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        column (Column): [models.Contact.email or models.Contact.phonenumber]
+        changes (Dict[str, str]): [old value -> new value]
+        chunk_size (int, optional): [changes per statement, three bound parameters each]. Defaults to 300.
+
+    Raises:
+        IntegrityError: [a new value collides with an existing contact of the user, the transaction is rolled back]
+
+    Returns:
+        [int]: [contacts updated]
+    """
+    items = list(changes.items())
+    updated = 0
+    version = None
+    updated_at = time.time()
     try:
-        db.delete(db_contact)
-        db.commit()
-        return True
-    except:
+        for start in range(0, len(items), chunk_size):
+            chunk = dict(items[start:start + chunk_size])
+            matches = and_(models.Contact.owner_id == user_id, column.in_(list(chunk)))
+            if version is None:
+                # taken along with the first chunk that has contacts to update, a write updating nothing keeps the version
+                version = await _next_version(db, user_id, only_if=select(models.Contact.id).where(matches).exists())
+                if version is None:
+                    continue
+            result = await db.execute(update(models.Contact)
+                                      .where(matches)
+                                      .values({column: case(chunk, value=column), models.Contact.version: version,
+                                               models.Contact.updated_at: updated_at})
+                                      .execution_options(synchronize_session=False))
+            updated += result.rowcount
+    except IntegrityError:
+        await rollback(db)
+        raise
+    return updated
+
+async def delete_contact(db: AsyncSession, user_id: int, contact_param: str):
+    return await delete_contacts(db, user_id=user_id, contact_params=[contact_param])
+
+async def delete_contacts(db: AsyncSession, user_id: int, contact_params: List[str], chunk_size: int = 400):
+    """[Deletes the user's contacts whose email or phonenumber is in contact_params, one DELETE per chunk]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [owner id]
+        contact_params (List[str]): [emails or phone numbers of contacts]
+        chunk_size (int, optional): [params per statement, each bound twice]. Defaults to 400.
+
+    Returns:
+        [int]: [contacts deleted, each leaves a tombstone for get_contact_changes]
+    """
+    deleted = 0
+    version = None
+    deleted_at = time.time()
+    for start in range(0, len(contact_params), chunk_size):
+        chunk = contact_params[start:start + chunk_size]
+        matches = and_(models.Contact.owner_id == user_id,
+                       or_(models.Contact.phonenumber.in_(chunk), models.Contact.email.in_(chunk)))
+        if version is None:
+            # as in _update_contacts_column, deleting nothing keeps the version
+            version = await _next_version(db, user_id, only_if=select(models.Contact.id).where(matches).exists())
+            if version is None:
+                continue
+        await db.execute(insert(models.ContactTombstone).from_select(
+            ["contact_id", "owner_id", "version", "deleted_at"],
+            select(models.Contact.id, models.Contact.owner_id, version, literal(deleted_at)).where(matches)))
+        result = await db.execute(delete(models.Contact)
+                                  .where(matches)
+                                  .execution_options(synchronize_session=False))
+        deleted += result.rowcount
+    return deleted
+
+async def update_user_premium_status(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id)
+    if db_user is None:
         return False
-    
-def update_user_premium_status(db: Session, user_id: int):
-    try:
-        db_user = db.query(models.User).filter(models.User.id == user_id).first()
-        if db_user is None:
-            return False
-        db_user.premium = True
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+    if db_user.premium:
         return True
-    except Exception as e:
-        print(e)
\ No newline at end of file
+    db_user.premium = True
+    await _next_version(db, user_id)
+    after_commit(db, cache.invalidate_user, user_id, db_user.email, db_user.phonenumber)
+    return True
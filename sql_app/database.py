@@ -1,11 +1,357 @@
-from sqlalchemy import create_engine
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from .config import settings
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url: str):
+    """[Maps a sync database url onto the matching async driver, e.g. sqlite -> sqlite+aiosqlite]
+
+    Args:
+        url (str): [sync database url]
+
+    Returns:
+        [str]: [async database url]
+    """
+    scheme, rest = url.split("://", 1)
+    return ASYNC_DRIVERS.get(scheme, scheme) + "://" + rest
+
+
+def is_sqlite(url: str):
+    return url.startswith("sqlite")
+
+
+def engine_options(url: str, is_async: bool):
+    """[Builds create_engine keyword arguments for url from settings]
+
+    Args:
+        url (str): [sync database url]
+        is_async (bool): [whether the options are for the async engine]
+
+    Returns:
+        [dict]: [keyword arguments for create_engine / create_async_engine]
+    """
+    options = {"pool_pre_ping": settings.db_pool_pre_ping, "pool_recycle": settings.db_pool_recycle}
+    if is_sqlite(url):
+        if ":memory:" in url or url.rstrip("/") == "sqlite:":
+            # in-memory databases live and die with their single connection, keep the dialect default pool
+            return {"connect_args": {"check_same_thread": False}}
+        # sqlite defaults to NullPool for files, a real pool keeps the pragmas and page cache warm
+        options["poolclass"] = AsyncAdaptedQueuePool if is_async else QueuePool
+        options["connect_args"] = {"check_same_thread": False, "timeout": settings.sqlite_busy_timeout / 1000}
+    elif settings.db_statement_timeout:
+        if is_async:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(settings.db_statement_timeout)}}
+        else:
+            options["connect_args"] = {"options": "-c statement_timeout=%d" % settings.db_statement_timeout}
+    options["pool_size"] = settings.db_pool_size
+    options["max_overflow"] = settings.db_max_overflow
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """[Switches every new sqlite connection to WAL so readers never block the writer and commits skip the full fsync,
+    and enforces foreign keys so contacts follow their owner on delete]"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % settings.sqlite_busy_timeout)
+    cursor.close()
+
+
+class QueryStats:
+    """[SQL statements executed on behalf of one request, filled in by the cursor events below]"""
+    __slots__ = ("count", "duration", "slowest", "slowest_statement")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        if duration > self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+
+
+# set for the length of a request by metrics.MetricsMiddleware, statements run outside of a request are not recorded.
+# the async engine runs statements in greenlets holding a copy of the request's context, so the QueryStats object
+# is shared with them while a value set inside them would not be
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+slow_statement_logger = logging.getLogger("phonebook.sql")
+
+
+def start_statement_timer(connection, cursor, statement, parameters, context, executemany):
+    # statements on a connection never overlap, one start time per connection is enough
+    connection.info["statement_started_at"] = time.perf_counter()
+
+
+def record_statement(connection, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - connection.info.pop("statement_started_at")
+    stats = query_stats.get()
+    if stats is not None:
+        stats.record(statement, duration)
+    if settings.slow_statement_ms and duration * 1000 >= settings.slow_statement_ms:
+        slow_statement_logger.warning("Slow statement (%.1fms): %s", duration * 1000, statement)
+
+
+def create_engines(url: str):
+    """[Creates the sync and async engine of a database, with the sqlite pragmas and statement instrumentation]
+
+    Args:
+        url (str): [sync database url]
+
+    Returns:
+        [Tuple[Engine, AsyncEngine]]: [sync engine for schema creation and tooling, async engine for requests]
+    """
+    sync_engine = create_engine(url, **engine_options(url, is_async=False))
+    async_engine = create_async_engine(async_database_url(url), **engine_options(url, is_async=True))
+    for instrumented_engine in (sync_engine, async_engine.sync_engine):
+        instrument(instrumented_engine, url)
+    return sync_engine, async_engine
+
+
+def instrument(instrumented_engine, url: str):
+    if is_sqlite(url):
+        event.listen(instrumented_engine, "connect", set_sqlite_pragmas)
+    event.listen(instrumented_engine, "before_cursor_execute", start_statement_timer)
+    event.listen(instrumented_engine, "after_cursor_execute", record_statement)
+
+
+def jump_hash(key: int, buckets: int):
+    """[Jump consistent hash (Lamping and Veach), going from n to n + 1 buckets only moves 1 / (n + 1) of the keys]
+
+    Args:
+        key (int): [non negative key]
+        buckets (int): [number of buckets]
+
+    Returns:
+        [int]: [bucket in range(buckets)]
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+    return bucket
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+replica_logger = logging.getLogger("phonebook.replicas")
 
+# seconds a replica is behind its primary, 0 while it has replayed everything it received. Databases without an entry
+# (e.g. a copied sqlite file) report no lag, the query then only checks the replica is reachable and has the schema
+REPLICATION_LAG_QUERIES = {
+    "postgresql": "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                  "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END",
+}
+SCHEMA_QUERY = "SELECT 0 FROM schema_version LIMIT 1"
+# errors of a read that mean the replica itself is unusable, it is left out until it passes a health check again
+REPLICA_ERRORS = (OperationalError, InterfaceError, OSError)
+
+
+class Replica:
+    """[Read only copy of a shard's database, kept up to date by the database's own replication]
+
+    Reads are only sent to it while its last health check reached it within the timeout and found it at most max_lag
+    seconds behind the primary.
+
+    Args:
+        url (str): [sync database url]
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.async_engine = create_async_engine(async_database_url(url), **engine_options(url, is_async=True))
+        instrument(self.async_engine.sync_engine, url)
+        self.session_factory = sessionmaker(self.async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+        self.healthy = True
+        self.lag = 0.0
+
+    async def check(self, max_lag: float, timeout: float):
+        """[Measures the replica's lag, it is healthy when it answered within timeout seconds and lags at most max_lag]
+
+        Args:
+            max_lag (float): [seconds the replica may be behind]
+            timeout (float): [seconds the check may take]
+        """
+        try:
+            lag = await asyncio.wait_for(self._measure_lag(), timeout)
+        except (asyncio.TimeoutError, SQLAlchemyError, OSError) as e:
+            self.mark_down(e)
+            return
+        self.lag = float(lag or 0)
+        if self.lag > max_lag:
+            self.mark_down("%.1fs behind" % self.lag)
+        elif not self.healthy:
+            replica_logger.warning("Replica %s is back", self.async_engine.url)
+            self.healthy = True
+
+    async def _measure_lag(self):
+        async with self.async_engine.connect() as connection:
+            query = REPLICATION_LAG_QUERIES.get(self.async_engine.dialect.name, SCHEMA_QUERY)
+            return (await connection.execute(text(query))).scalar()
+
+    def mark_down(self, reason):
+        if self.healthy:
+            replica_logger.warning("Replica %s is left out of reads: %s", self.async_engine.url, reason)
+        self.healthy = False
+
+
+class ShardRouter:
+    """[Databases users are spread over, each user and their contacts live together in one of them]
+
+    Shard 0 is the database_url database, it also holds the user_shards directory that maps every user to their shard
+    and keeps emails and phone numbers unique across shards. Every shard has the full schema, and may have read replicas
+    that read only handlers are spread over.
+
+    Args:
+        urls (List[str]): [sync database url per shard]
+        replica_urls (List[List[str]], optional): [sync database urls of the replicas per shard]. Defaults to none.
+    """
+
+    def __init__(self, urls, replica_urls=()):
+        self.urls = urls
+        self.engines = []
+        self.async_engines = []
+        self.session_factories = []
+        for url in urls:
+            sync_engine, async_engine = create_engines(url)
+            self.engines.append(sync_engine)
+            self.async_engines.append(async_engine)
+            self.session_factories.append(sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False))
+        replica_urls = list(replica_urls) + [[]] * (len(urls) - len(replica_urls))
+        self.replicas = [[Replica(url) for url in shard_replica_urls] for shard_replica_urls in replica_urls]
+        self._turns = itertools.count()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def placement(self, user_id: int):
+        # new users go where the resharding tool would move them, so rebalancing only has to move existing ones
+        return jump_hash(user_id, len(self))
+
+    def session(self, shard: int):
+        return self.session_factories[shard]()
+
+    def replica(self, shard: int):
+        """[Next healthy replica of the shard in turn]
+
+        Args:
+            shard (int): [shard to read from]
+
+        Returns:
+            [Optional[Replica]]: [replica, None when the shard has no healthy one and reads go to the shard itself]
+        """
+        replicas = self.replicas[shard]
+        for _ in range(len(replicas)):
+            replica = replicas[next(self._turns) % len(replicas)]
+            if replica.healthy:
+                return replica
+        return None
+
+    def all_replicas(self):
+        return [replica for replicas in self.replicas for replica in replicas]
+
+    async def check_replicas(self, interval: float, max_lag: float):
+        """[Health checks every replica at once]
+
+        Args:
+            interval (float): [seconds the checks may take]
+            max_lag (float): [seconds a replica may be behind its primary and still serve reads]
+        """
+        await asyncio.gather(*(replica.check(max_lag, interval) for replica in self.all_replicas()))
+
+    async def keep_replicas_checked(self, interval: float, max_lag: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_replicas(interval, max_lag)
+            except Exception:
+                replica_logger.exception("Checking the replicas failed")
+
+
+SQLALCHEMY_DATABASE_URL = settings.database_url
+shards = ShardRouter([SQLALCHEMY_DATABASE_URL] + settings.shard_urls,
+                     [settings.replica_urls] + [settings.shard_replica_urls.get(shard, [])
+                                                for shard in range(1, len(settings.shard_urls) + 1)])
+
+# the directory and shard 0, the only database without SHARD_URLS
+engine = shards.engines[0]
+async_engine = shards.async_engines[0]
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = shards.session_factories[0]
+
+
+@asynccontextmanager
+async def shard_session(directory: AsyncSession, shard: int, readonly: bool = False):
+    """[Session on the shard, the directory session itself for shard 0 so a request only opens a second connection for
+    users on other shards]
+
+    Args:
+        directory (AsyncSession): [session on shard 0]
+        shard (int): [shard of the user]
+        readonly (bool, optional): [session on a healthy replica of the shard when it has one, for reads that may lag
+                                    the primary by up to settings.replica_max_lag_ms]. Defaults to False.
+
+    Yields:
+        [AsyncSession]: [session on the shard]
+    """
+    replica = shards.replica(shard) if readonly else None
+    if replica is not None:
+        async with replica.session_factory() as db:
+            try:
+                yield db
+            except REPLICA_ERRORS as e:
+                replica.mark_down(e)
+                raise
+        return
+    if shard == 0:
+        yield directory
+        return
+    async with shards.session(shard) as db:
+        yield db
+
+
+Base = declarative_base()
+
+
+async def prewarm_pool(size: int):
+    """[Opens size connections on the async engine of every shard and healthy replica up front, so the first requests
+    do not pay for connecting]
 
-Base = declarative_base()
\ No newline at end of file
+    Args:
+        size (int): [connections to open per database, at most the pool size stays open]
+    """
+    connections = []
+    try:
+        for shard_engine in shards.async_engines + [replica.async_engine for replica in shards.all_replicas() if replica.healthy]:
+            for _ in range(size):
+                connection = await shard_engine.connect()
+                connections.append(connection)
+                await connection.execute(text("SELECT 1"))
+    finally:
+        for connection in connections:
+            await connection.close()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+
+from .database import query_stats
+from .unit_of_work import commit
+
+logger = logging.getLogger("phonebook.group_commit")
+
+
+class GroupCommitter:
+    """[Runs small writes of concurrent requests in one shared transaction, committed once per batch]
+
+    A batch starts with the first queued write and takes more for up to window seconds or until max_batch writes,
+    so under load many requests share a commit while a lone request waits at most window seconds.
+    Writes must not roll back or commit themselves. If a batch fails each of its writes is retried in a transaction
+    of its own, so one failing write only fails its own request.
+
+    Args:
+        session_factory (Callable[[], AsyncSession]): [opens the session a batch runs in]
+        window (float): [seconds a batch waits for more writes]
+        max_batch (int): [writes per batch]
+    """
+
+    def __init__(self, session_factory, window: float, max_batch: int):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._worker = None
+
+    async def run(self, write):
+        """[Queues write and waits until the batch running it committed]
+
+        Args:
+            write (Callable[[AsyncSession], Awaitable]): [coroutine function doing the write in the session it is given]
+
+        Returns:
+            [Any]: [what write returned]
+        """
+        # created lazily so the queue and the worker belong to the serving event loop, not the importing one
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.ensure_future(self._work())
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((write, future))
+        return await future
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _work(self):
+        # the task copied the context of the request that started it, batches must not count as that request's statements
+        query_stats.set(None)
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            async with self.session_factory() as db:
+                results = [await write(db) for write, future in batch]
+                await commit(db)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            logger.warning("Group commit of %d writes failed, retrying them one by one: %r", len(batch), e)
+            for item in batch:
+                await self._commit([item])
+            return
+        for (write, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import time
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+
+
+def fingerprint(route: str, payload):
+    """[Hash identifying a request, so a retry can be told apart from a different request reusing its key]
+
+    Args:
+        route (str): [route path]
+        payload (Any): [parsed request body, JSON compatible]
+
+    Returns:
+        [str]: [hex SHA-256]
+    """
+    return hashlib.sha256(json.dumps([route, payload], sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+async def find(db: AsyncSession, user_id: int, key: str):
+    """[Fetches the response recorded for the user's Idempotency-Key, expired records are ignored]
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [user the key belongs to]
+        key (str): [Idempotency-Key header]
+
+    Returns:
+        [Optional[models.IdempotencyKey]]: [record, None if the key was not used within settings.idempotency_key_ttl]
+    """
+    result = await db.execute(select(models.IdempotencyKey)
+                              .where(models.IdempotencyKey.user_id == user_id)
+                              .where(models.IdempotencyKey.key == key)
+                              .where(models.IdempotencyKey.created_at >= time.time() - settings.idempotency_key_ttl))
+    return result.scalars().first()
+
+
+async def record(db: AsyncSession, user_id: int, key: str, request_fingerprint: str, status_code: int, content):
+    """[Stores the response for the user's Idempotency-Key in the request's transaction, so it commits with the write
+
+    If a concurrent request with the same key commits first, the unique index fails this transaction's commit with an
+    IntegrityError, the caller then replays the response of the other request.
+
+    Args:
+        db (AsyncSession): [database session]
+        user_id (int): [user the key belongs to]
+        key (str): [Idempotency-Key header]
+        request_fingerprint (str): [fingerprint of the request]
+        status_code (int): [response status]
+        content (Any): [response body, JSON compatible]
+    """
+    # an expired record of the same key would block the unique index, a live one must, so a concurrent request with the
+    # same key that committed first makes this transaction fail instead of being overwritten
+    await db.execute(delete(models.IdempotencyKey)
+                     .where(models.IdempotencyKey.user_id == user_id)
+                     .where(models.IdempotencyKey.key == key)
+                     .where(models.IdempotencyKey.created_at < time.time() - settings.idempotency_key_ttl)
+                     .execution_options(synchronize_session=False))
+    db.add(models.IdempotencyKey(user_id=user_id, key=key, fingerprint=request_fingerprint, status_code=status_code,
+                                 response=json.dumps(content, ensure_ascii=False, separators=(",", ":")),
+                                 created_at=time.time()))
+
+
+def purge(connection, ttl: int):
+    """[Deletes records older than ttl seconds]
+
+    Args:
+        connection (Connection): [sync database connection]
+        ttl (int): [seconds a record is kept]
+
+    Returns:
+        [int]: [records deleted]
+    """
+    result = connection.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < time.time() - ttl))
+    return result.rowcount
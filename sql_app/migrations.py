@@ -0,0 +1,194 @@
+import time
+
+from sqlalchemy import inspect, text
+
+from validation import normalize_phonenumber
+
+from . import models, search, tokens
+
+# lock key for postgres advisory locks, any constant shared by every migrating process
+MIGRATION_LOCK_KEY = 7370616
+VERSION_INDEX = "ix_contacts_owner_id_version"
+
+
+def initial_schema(connection):
+    # creates only missing tables, so it brings a fresh database straight to the current schema
+    # and leaves databases created before migrations existed to the steps below
+    models.Base.metadata.create_all(bind=connection)
+
+
+def contacts_search_index(connection):
+    search.create_search_index(connection)
+
+
+def contacts_owner_indexes(connection):
+    # keep the oldest of any duplicated (owner_id, email, phonenumber) contacts so the unique index can be built
+    connection.execute(text("DELETE FROM contacts WHERE id NOT IN "
+                            "(SELECT MIN(id) FROM contacts GROUP BY owner_id, email, phonenumber)"))
+    for index in models.Contact.__table__.indexes:
+        # the version index comes with its column in contact_versions
+        if index.name != VERSION_INDEX:
+            index.create(bind=connection, checkfirst=True)
+
+
+def contacts_owner_cascade(connection):
+    # earlier versions of delete_user left contacts behind past the first 100
+    connection.execute(text("DELETE FROM contacts WHERE owner_id NOT IN (SELECT id FROM users)"))
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER TABLE contacts DROP CONSTRAINT IF EXISTS contacts_owner_id_fkey"))
+        connection.execute(text("ALTER TABLE contacts ADD CONSTRAINT contacts_owner_id_fkey "
+                                "FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE"))
+    # sqlite cannot alter a foreign key without rebuilding the table, crud.delete_user deletes contacts explicitly instead
+
+
+def users_canonical_phonenumbers(connection):
+    # lookups normalize the requested phone number, so stored ones must be in the same 10 digit form to be found
+    taken = {row.phonenumber for row in connection.execute(text("SELECT phonenumber FROM users"))}
+    for row in connection.execute(text("SELECT id, phonenumber FROM users")).fetchall():
+        phonenumber = normalize_phonenumber(row.phonenumber)
+        # rows that cannot be normalized, or would collide with another user, are left as they are
+        if phonenumber is None or phonenumber == row.phonenumber or phonenumber in taken:
+            continue
+        connection.execute(text("UPDATE users SET phonenumber = :phonenumber WHERE id = :id"),
+                           {"phonenumber": phonenumber, "id": row.id})
+        taken.add(phonenumber)
+
+
+def users_hashed_tokens(connection):
+    # tokens were stored as issued, keep every issued token working by storing its keyed hash instead
+    for row in connection.execute(text("SELECT id, token FROM users WHERE token IS NOT NULL")).fetchall():
+        connection.execute(text("UPDATE users SET token = :token WHERE id = :id"),
+                           {"token": tokens.hash_token(str(row.token)), "id": row.id})
+
+
+def idempotency_keys(connection):
+    models.IdempotencyKey.__table__.create(bind=connection, checkfirst=True)
+
+
+def user_shards(connection):
+    # every existing user lives in the first database, which serves as shard 0
+    models.UserShard.__table__.create(bind=connection, checkfirst=True)
+    connection.execute(text("INSERT INTO user_shards (user_id, email, phonenumber, shard, moving) "
+                            "SELECT id, email, phonenumber, 0, :moving FROM users "
+                            "WHERE id NOT IN (SELECT user_id FROM user_shards)"), {"moving": False})
+    sync_user_id_sequence(connection)
+
+
+def sync_user_id_sequence(connection):
+    # user ids inserted explicitly, e.g. the backfill above, leave a postgres sequence behind to hand them out again
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('user_shards', 'user_id'), "
+                                "COALESCE(MAX(user_id), 0) + 1, false) FROM user_shards"))
+
+
+def contact_versions(connection):
+    # contacts from before get version 0, a first sync with no cursor still returns them
+    columns = {table: {column["name"] for column in inspect(connection).get_columns(table)} for table in ("users", "contacts")}
+    for table, column, definition in (("users", "version", "INTEGER NOT NULL DEFAULT 0"),
+                                      ("users", "resync_version", "INTEGER NOT NULL DEFAULT 0"),
+                                      ("contacts", "version", "INTEGER NOT NULL DEFAULT 0"),
+                                      ("contacts", "updated_at", "FLOAT")):
+        if column not in columns[table]:
+            connection.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, definition)))
+    next(index for index in models.Contact.__table__.indexes if index.name == VERSION_INDEX).create(bind=connection, checkfirst=True)
+    models.ContactTombstone.__table__.create(bind=connection, checkfirst=True)
+
+
+def contacts_search_by_owner(connection):
+    search.drop_legacy_search_index(connection)
+    search.create_search_index(connection)
+
+
+def contacts_canonical_phonenumbers(connection):
+    # contact writes and lookups normalize phone numbers, so stored ones must be in the same 10 digit form to be found,
+    # a canonical phone number is 10 characters long and every other valid spelling longer
+    rows = connection.execute(text("SELECT id, owner_id, email, phonenumber FROM contacts "
+                                   "WHERE length(phonenumber) <> 10 ORDER BY owner_id, id")).fetchall()
+    versions = {}
+    for row in rows:
+        phonenumber = normalize_phonenumber(row.phonenumber)
+        if phonenumber is None:
+            continue
+        if row.owner_id not in versions:
+            # one new version per owner, so contact syncs pick the changes up
+            connection.execute(text("UPDATE users SET version = version + 1 WHERE id = :id"), {"id": row.owner_id})
+            versions[row.owner_id] = connection.execute(text("SELECT version FROM users WHERE id = :id"),
+                                                        {"id": row.owner_id}).scalar()
+        duplicate = connection.execute(text(
+            "SELECT 1 FROM contacts WHERE owner_id = :owner_id AND email = :email AND phonenumber = :phonenumber"),
+            {"owner_id": row.owner_id, "email": row.email, "phonenumber": phonenumber}).first() is not None
+        if duplicate:
+            # the same contact spelled twice, the canonical one is kept as contacts_owner_indexes keeps one of duplicates
+            connection.execute(text("DELETE FROM contacts WHERE id = :id"), {"id": row.id})
+            connection.execute(text("INSERT INTO contact_tombstones (contact_id, owner_id, version, deleted_at) "
+                                    "VALUES (:id, :owner_id, :version, :deleted_at)"),
+                               {"id": row.id, "owner_id": row.owner_id, "version": versions[row.owner_id],
+                                "deleted_at": time.time()})
+            continue
+        connection.execute(text("UPDATE contacts SET phonenumber = :phonenumber, version = :version WHERE id = :id"),
+                           {"phonenumber": phonenumber, "version": versions[row.owner_id], "id": row.id})
+
+
+# (version, description, step), append only, every step must be safe on a database created by initial_schema
+MIGRATIONS = [
+    (1, "initial schema", initial_schema),
+    (2, "contacts full text search", contacts_search_index),
+    (3, "contacts owner indexes and unique (owner_id, email, phonenumber)", contacts_owner_indexes),
+    (4, "contacts cascade with their owner", contacts_owner_cascade),
+    (5, "users phone numbers in canonical form", users_canonical_phonenumbers),
+    (6, "users tokens stored as keyed hashes", users_hashed_tokens),
+    (7, "idempotency keys of contact writes", idempotency_keys),
+    (8, "directory of the shard every user lives in", user_shards),
+    (9, "contact versions and tombstones for incremental sync", contact_versions),
+    (10, "contacts search indexes keyed by owner", contacts_search_by_owner),
+    (11, "user_shards id sequence past the backfilled ids", sync_user_id_sequence),
+    (12, "contacts phone numbers in canonical form", contacts_canonical_phonenumbers),
+]
+
+
+def current_version(connection):
+    connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+
+def migrate(engine):
+    """[Applies pending migrations in one transaction, holding a write lock so concurrent callers apply them once]
+
+    Args:
+        engine (Engine): [sync engine]
+
+    Returns:
+        [List[int]]: [versions applied]
+    """
+    applied = []
+    with engine.connect() as connection:
+        with connection.begin():
+            if engine.dialect.name == "sqlite":
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+            elif engine.dialect.name == "postgresql":
+                connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            version = current_version(connection)
+            for migration_version, description, step in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                step(connection)
+                connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": migration_version})
+                applied.append(migration_version)
+    return applied
+
+
+def pending(engine):
+    """[Lists migrations not applied yet, without writing to the database]
+
+    Args:
+        engine (Engine): [sync engine]
+
+    Returns:
+        [List[int]]: [pending versions]
+    """
+    with engine.connect() as connection:
+        version = 0
+        if inspect(connection).has_table("schema_version"):
+            version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    return [migration_version for migration_version, description, step in MIGRATIONS if migration_version > version]
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -12,9 +12,14 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     phonenumber = Column(String, unique=True, index=True)
     premium = Column(Boolean, default=False)
+    # keyed hash of the user's token (see tokens.hash_token), NULL once revoked
     token = Column(String)
+    # bumped by every transaction changing the user's contacts, which are stamped with it, see crud.get_contact_changes
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # changes from before this version cannot be told anymore, e.g. contacts renumbered by a move to another shard
+    resync_version = Column(Integer, nullable=False, default=0, server_default="0")
     
-    contacts = relationship("Contact", back_populates="owner")
+    contacts = relationship("Contact", back_populates="owner", cascade="all, delete-orphan", passive_deletes=True)
     
 class Contact(Base):
     __tablename__ = "contacts"
@@ -23,6 +28,69 @@ class Contact(Base):
     name = Column(String, unique=False, index=True)
     email = Column(String, unique=False, index=True)
     phonenumber = Column(String, unique=False, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"), unique=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), unique=False)
+    # owner's version when the contact was last inserted or changed
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # unix time of the last insert or change, NULL for contacts from before versions were kept
+    updated_at = Column(Float)
     
-    owner = relationship("User", back_populates="contacts")
\ No newline at end of file
+    owner = relationship("User", back_populates="contacts")
+    
+    __table_args__ = (
+        Index("ix_contacts_owner_id_email", "owner_id", "email"),
+        Index("ix_contacts_owner_id_phonenumber", "owner_id", "phonenumber"),
+        # a unique index rather than a table constraint so existing sqlite tables can gain it without a rebuild
+        Index("uq_contacts_owner_id_email_phonenumber", "owner_id", "email", "phonenumber", unique=True),
+        Index("ix_contacts_owner_id_version", "owner_id", "version"),
+    )
+
+
+class ContactTombstone(Base):
+    __tablename__ = "contact_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    # id of the deleted contact, sqlite may hand it to a later contact again
+    contact_id = Column(Integer, nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # owner's version of the transaction that deleted the contact
+    version = Column(Integer, nullable=False)
+    # unix time of the delete
+    deleted_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_contact_tombstones_owner_id_version", "owner_id", "version"),
+    )
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # Idempotency-Key header as sent by the client, unique per user
+    key = Column(String, nullable=False)
+    # hash of the route and request body, a key reused for a different request is rejected rather than replayed
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    # JSON body of the response to replay
+    response = Column(Text, nullable=False)
+    # unix time, keys older than settings.idempotency_key_ttl are ignored and purged
+    created_at = Column(Float, nullable=False, index=True)
+
+    __table_args__ = (
+        Index("uq_idempotency_keys_user_id_key", "user_id", "key", unique=True),
+    )
+
+
+class UserShard(Base):
+    __tablename__ = "user_shards"
+
+    # allocates user ids, users rows on every shard take their id from here so ids stay unique across shards
+    user_id = Column(Integer, primary_key=True)
+    # unique across shards, the users tables only see the users of their own shard
+    email = Column(String, unique=True)
+    phonenumber = Column(String, unique=True)
+    # index into database.shards of the database holding the user and their contacts
+    shard = Column(Integer, nullable=False, default=0)
+    # set while the resharding tool copies the user to another shard, writes are refused until it is done
+    moving = Column(Boolean, nullable=False, default=False)
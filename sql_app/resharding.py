@@ -0,0 +1,149 @@
+"""[Moves users and their contacts between shards while the api keeps serving them]
+
+A batch of users is moved in four steps:
+    1. their directory rows are marked moving, writes for them are refused with 503 from then on
+    2. after wait seconds every worker has dropped cached users from before the mark and stopped writing, the users,
+       their contacts and idempotency keys are copied to the target shard
+    3. once the target shard's replicas can have replayed the copy, the directory is switched to the target shard and
+       the mark cleared in one transaction
+    4. after wait seconds more no worker reads the source shard for them, their rows there are deleted
+Reads keep being served throughout. Contacts are renumbered on the target shard in their original order, so cursors
+handed out before the move do not carry over, contact changes cursors are answered with 410 and clients sync afresh.
+Rerunning after an interruption finishes or redoes the moves.
+"""
+import logging
+import time
+from typing import List, NamedTuple
+
+from sqlalchemy import delete, insert, select, update
+
+from . import models
+from .config import settings
+from .database import shards
+
+logger = logging.getLogger("phonebook.resharding")
+
+# contacts read and inserted per round trip while copying
+COPY_CHUNK_SIZE = 1000
+
+
+class Move(NamedTuple):
+    user_id: int
+    source: int
+    target: int
+
+
+def misplaced_users(directory):
+    """[Users not on the shard their id is placed on, after a shard was added, and users left marked by a failed run]
+
+    Args:
+        directory (Connection): [shard 0 connection]
+
+    Returns:
+        [List[Move]]: [moves to their placement]
+    """
+    moves = []
+    for user_id, shard, moving in directory.execute(select(models.UserShard.user_id, models.UserShard.shard,
+                                                           models.UserShard.moving)):
+        target = shards.placement(user_id)
+        if target != shard or moving:
+            moves.append(Move(user_id, shard, target))
+    return moves
+
+
+def move_users(moves: List[Move], wait: float, batch_size: int = 500):
+    """[Moves the users batch by batch, see the module docstring]
+
+    Args:
+        moves (List[Move]): [users with their current and new shard]
+        wait (float): [seconds for every worker to see a directory change, at least the user cache ttl]
+        batch_size (int, optional): [users moved together, their writes are refused for about twice wait]. Defaults to 500.
+
+    Returns:
+        [int]: [users moved]
+    """
+    directory_engine = shards.engines[0]
+    moved = 0
+    for start in range(0, len(moves), batch_size):
+        batch = moves[start:start + batch_size]
+        user_ids = [move.user_id for move in batch]
+        with directory_engine.begin() as directory:
+            directory.execute(update(models.UserShard)
+                              .where(models.UserShard.user_id.in_(user_ids))
+                              .values(moving=True))
+        time.sleep(wait)
+        copied = [move for move in batch if move.source == move.target or copy_user(move)]
+        if any(shards.replicas[move.target] for move in copied):
+            # replicas lagging more are not read from
+            time.sleep(settings.replica_max_lag_ms / 1000)
+        with directory_engine.begin() as directory:
+            for move in copied:
+                directory.execute(update(models.UserShard)
+                                  .where(models.UserShard.user_id == move.user_id)
+                                  .values(shard=move.target, moving=False))
+        time.sleep(wait)
+        for move in copied:
+            if move.source != move.target:
+                with shards.engines[move.source].begin() as connection:
+                    delete_user_rows(connection, move.user_id)
+        moved += len(copied)
+        logger.info("Moved %d of %d users", moved, len(moves))
+    return moved
+
+
+def copy_user(move: Move):
+    """[Copies the user's rows from the source to the target shard, replacing any left there by an interrupted move]
+
+    Args:
+        move (Move): [user with their current and new shard]
+
+    Returns:
+        [bool]: [whether the user was copied, False if they no longer exist]
+    """
+    with shards.engines[move.source].connect() as source, shards.engines[move.target].begin() as target:
+        delete_user_rows(target, move.user_id)
+        user = source.execute(select(models.User.__table__).where(models.User.id == move.user_id)).mappings().first()
+        if user is None:
+            return False
+        # tombstones name contact ids of the source shard, they are left behind and older changes cursors invalidated
+        version = user["version"] + 1
+        target.execute(insert(models.User.__table__), dict(user, version=version, resync_version=version))
+        for table, owner_column in ((models.Contact.__table__, models.Contact.owner_id),
+                                    (models.IdempotencyKey.__table__, models.IdempotencyKey.user_id)):
+            # ids are left to the target shard, the source's would collide with rows of other users there
+            columns = [column for column in table.columns if column.name != "id"]
+            rows = source.execution_options(stream_results=True).execute(
+                select(*columns).where(owner_column == move.user_id).order_by(table.c.id))
+            for partition in rows.mappings().partitions(COPY_CHUNK_SIZE):
+                target.execute(insert(table), [dict(row) for row in partition])
+    return True
+
+
+def delete_user_rows(connection, user_id: int):
+    for table, owner_column in ((models.Contact.__table__, models.Contact.owner_id),
+                                (models.ContactTombstone.__table__, models.ContactTombstone.owner_id),
+                                (models.IdempotencyKey.__table__, models.IdempotencyKey.user_id),
+                                (models.User.__table__, models.User.id)):
+        connection.execute(delete(table).where(owner_column == user_id))
+
+
+def remove_strays():
+    """[Deletes users found on a shard the directory does not place them on, copies left by interrupted moves]
+
+    Returns:
+        [int]: [users deleted]
+    """
+    with shards.engines[0].connect() as directory:
+        locations = {user_id: (shard, moving) for user_id, shard, moving in directory.execute(
+            select(models.UserShard.user_id, models.UserShard.shard, models.UserShard.moving))}
+    removed = 0
+    for shard, shard_engine in enumerate(shards.engines):
+        with shard_engine.begin() as connection:
+            for (user_id,) in connection.execute(select(models.User.id)).fetchall():
+                location = locations.get(user_id)
+                # users being moved may rightly be on two shards, users missing from the directory are left alone
+                if location is None or location[1] or location[0] == shard:
+                    continue
+                delete_user_rows(connection, user_id)
+                removed += 1
+    return removed
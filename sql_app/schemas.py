@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -21,6 +21,39 @@ class Contact(ContactBase):
         orm_mode = True
 
 
+class ContactChanges(BaseModel):
+    contacts: List[Contact]
+    deleted: List[int]
+    cursor: str
+    more: bool
+
+
+class ContactValueChange(BaseModel):
+    old: str
+    new: str
+
+
+class ContactValueChanges(BaseModel):
+    changes: List[ContactValueChange]
+
+
+class ContactParams(BaseModel):
+    contact_params: List[str]
+
+
+class BulkContactStatus(BaseModel):
+    index: int
+    status: str
+    detail: Optional[str] = None
+
+
+class BulkContactResult(BaseModel):
+    created: int
+    duplicates: int
+    invalid: int
+    results: List[BulkContactStatus]
+
+
 class UserBase(BaseModel):
     name: str
     email: str
@@ -33,10 +66,45 @@ class UserCreate(UserBase):
 
 class User(UserBase):   
     id: int
-    token: str
     premium: bool
     
-    contacts: List[Contact] = []
-    
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+    @classmethod
+    def from_row(cls, db_user):
+        # rows come from our own database, construct skips the per field validation of from_orm
+        return cls.construct(id=db_user.id, name=db_user.name, email=db_user.email, phonenumber=db_user.phonenumber,
+                             premium=bool(db_user.premium))
+
+
+class UserCreated(User):
+    token: str
+
+    @classmethod
+    def from_row(cls, db_user, token: str):
+        return cls.construct(**User.from_row(db_user).dict(), token=token)
+
+
+class Token(BaseModel):
+    token: str
+
+
+class UserWithContacts(User):
+    contacts: List[Contact] = []
+
+
+class UserLookup(BaseModel):
+    params: List[str]
+
+
+class LookedUpUser(BaseModel):
+    name: str
+    mail: str
+    phonenumber: str
+
+
+class UserLookupResult(BaseModel):
+    found: Dict[str, LookedUpUser]
+    not_found: List[str]
+    invalid: List[str]
@@ -0,0 +1,171 @@
+from sqlalchemy import text
+
+# sqlite search indexes over contacts, kept in sync by triggers so every write path (orm, bulk insert, raw sql) is covered.
+# Both are keyed by owner, a search only reads the rows of the user searching however many contacts other users have.
+
+# contacts_owner_fts answers prefix queries on name, email and phonenumber. Its rowid is the owner id above the contact id,
+# so the owner's contacts are one rowid range every doclist is read within.
+OWNER_ROWID_SHIFT = 32
+CONTACT_ID_MASK = (1 << OWNER_ROWID_SHIFT) - 1
+_OWNER_ROWID = "({row}.owner_id << %d) + {row}.id" % OWNER_ROWID_SHIFT
+CONTACTS_OWNER_FTS_DDL = [
+    # words up to 6 characters are looked up in the prefix indexes, longer ones merge the doclists of every matching term
+    """CREATE VIRTUAL TABLE contacts_owner_fts USING fts5(
+        name, email, phonenumber, content='',
+        tokenize="unicode61 tokenchars '@.+_-'", prefix='1 2 3 4 5 6')""",
+    """CREATE TRIGGER IF NOT EXISTS contacts_owner_fts_ai AFTER INSERT ON contacts BEGIN
+        INSERT INTO contacts_owner_fts(rowid, name, email, phonenumber)
+        VALUES (%s, new.name, new.email, new.phonenumber);
+    END""" % _OWNER_ROWID.format(row="new"),
+    """CREATE TRIGGER IF NOT EXISTS contacts_owner_fts_ad AFTER DELETE ON contacts BEGIN
+        INSERT INTO contacts_owner_fts(contacts_owner_fts, rowid, name, email, phonenumber)
+        VALUES ('delete', %s, old.name, old.email, old.phonenumber);
+    END""" % _OWNER_ROWID.format(row="old"),
+    """CREATE TRIGGER IF NOT EXISTS contacts_owner_fts_au AFTER UPDATE OF name, email, phonenumber, owner_id ON contacts BEGIN
+        INSERT INTO contacts_owner_fts(contacts_owner_fts, rowid, name, email, phonenumber)
+        VALUES ('delete', %s, old.name, old.email, old.phonenumber);
+        INSERT INTO contacts_owner_fts(rowid, name, email, phonenumber)
+        VALUES (%s, new.name, new.email, new.phonenumber);
+    END""" % (_OWNER_ROWID.format(row="old"), _OWNER_ROWID.format(row="new")),
+    "INSERT INTO contacts_owner_fts(rowid, name, email, phonenumber) SELECT %s, name, email, phonenumber FROM contacts"
+    % _OWNER_ROWID.format(row="contacts"),
+]
+
+# contact_phone_suffixes answers partial phone number queries: a phone number contains q exactly when one of its suffixes
+# starts with q, which is a range scan over the owner's suffixes
+# suffixes starting within the first PHONE_SUFFIX_STARTS characters are indexed, far beyond any valid phone number
+PHONE_SUFFIX_STARTS = 32
+PHONE_MIN_QUERY_LENGTH = 3
+_STARTS = "(%s) AS starts" % " UNION ALL ".join("SELECT %d AS start" % start for start in range(1, PHONE_SUFFIX_STARTS + 1))
+_SUFFIXES = ("SELECT {row}.owner_id AS owner_id, substr({row}.phonenumber, start) AS suffix, {row}.id AS contact_id "
+             "FROM {tables} WHERE length({row}.phonenumber) - start + 1 >= %d" % PHONE_MIN_QUERY_LENGTH)
+CONTACT_PHONE_SUFFIXES_DDL = [
+    """CREATE TABLE contact_phone_suffixes (
+        owner_id INTEGER NOT NULL, suffix TEXT NOT NULL, contact_id INTEGER NOT NULL,
+        PRIMARY KEY (owner_id, suffix, contact_id)) WITHOUT ROWID""",
+    """CREATE TRIGGER IF NOT EXISTS contact_phone_suffixes_ai AFTER INSERT ON contacts BEGIN
+        INSERT INTO contact_phone_suffixes (owner_id, suffix, contact_id) %s;
+    END""" % _SUFFIXES.format(row="new", tables=_STARTS),
+    """CREATE TRIGGER IF NOT EXISTS contact_phone_suffixes_ad AFTER DELETE ON contacts BEGIN
+        DELETE FROM contact_phone_suffixes WHERE owner_id = old.owner_id AND contact_id = old.id
+            AND suffix IN (SELECT suffix FROM (%s));
+    END""" % _SUFFIXES.format(row="old", tables=_STARTS),
+    """CREATE TRIGGER IF NOT EXISTS contact_phone_suffixes_au AFTER UPDATE OF phonenumber, owner_id ON contacts BEGIN
+        DELETE FROM contact_phone_suffixes WHERE owner_id = old.owner_id AND contact_id = old.id
+            AND suffix IN (SELECT suffix FROM (%s));
+        INSERT INTO contact_phone_suffixes (owner_id, suffix, contact_id) %s;
+    END""" % (_SUFFIXES.format(row="old", tables=_STARTS), _SUFFIXES.format(row="new", tables=_STARTS)),
+    "INSERT INTO contact_phone_suffixes (owner_id, suffix, contact_id) %s"
+    % _SUFFIXES.format(row="contacts", tables="contacts, " + _STARTS),
+]
+
+# earlier full text indexes, contacts_fts only filtered by owner through a token every owner's doclist had to be read
+# for, contacts_phone_fts not at all
+LEGACY_SEARCH_DDL = [
+    "DROP TRIGGER IF EXISTS contacts_fts_ai",
+    "DROP TRIGGER IF EXISTS contacts_fts_ad",
+    "DROP TRIGGER IF EXISTS contacts_fts_au",
+    "DROP TABLE IF EXISTS contacts_fts",
+    "DROP TRIGGER IF EXISTS contacts_phone_fts_ai",
+    "DROP TRIGGER IF EXISTS contacts_phone_fts_ad",
+    "DROP TRIGGER IF EXISTS contacts_phone_fts_au",
+    "DROP TABLE IF EXISTS contacts_phone_fts",
+]
+
+# postgres has neither, the pattern matching fallback is answered from a trigram index instead of a table scan
+POSTGRES_TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS ix_contacts_search_trgm ON contacts
+        USING gin (name gin_trgm_ops, email gin_trgm_ops, phonenumber gin_trgm_ops)""",
+]
+
+SEARCH_TABLES = {"contacts_owner_fts": CONTACTS_OWNER_FTS_DDL, "contact_phone_suffixes": CONTACT_PHONE_SUFFIXES_DDL}
+
+# which indexes exist in the connected database, filled by detect_search_indexes
+available_indexes = set()
+
+
+def create_search_index(connection):
+    """[Creates the contacts search indexes and their sync triggers and builds them from existing rows]
+
+    Args:
+        connection (Connection): [sync connection inside the migration transaction]
+    """
+    if connection.dialect.name == "postgresql":
+        for statement in POSTGRES_TRIGRAM_DDL:
+            connection.execute(text(statement))
+        return
+    if connection.dialect.name != "sqlite":
+        return
+    tables = _search_tables(connection)
+    for table, ddl in SEARCH_TABLES.items():
+        if table not in tables:
+            for statement in ddl:
+                connection.execute(text(statement))
+
+
+def drop_legacy_search_index(connection):
+    if connection.dialect.name == "sqlite":
+        for statement in LEGACY_SEARCH_DDL:
+            connection.execute(text(statement))
+
+
+def detect_search_indexes(engine):
+    """[Records which search indexes exist so searches know whether they can use them]
+
+    Args:
+        engine (Engine): [sync engine]
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect() as connection:
+        available_indexes.update(_search_tables(connection))
+
+
+def _search_tables(connection):
+    tables = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars()
+    return set(tables) & set(SEARCH_TABLES)
+
+
+def _fts_string(term: str):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def prefix_match_expression(q: str):
+    """[Builds a contacts_owner_fts MATCH expression requiring every word of q as a prefix of name, email or phonenumber]
+
+    Args:
+        q (str): [search text]
+
+    Returns:
+        [str]: [fts5 query]
+    """
+    return " AND ".join("%s*" % _fts_string(term) for term in q.split())
+
+
+def owner_rowid_range(owner_id: int):
+    """[Bounds the contacts_owner_fts rowids of the owner's contacts]
+
+    Args:
+        owner_id (int): [owner whose contacts are searched]
+
+    Returns:
+        [Tuple[int, int]]: [lowest rowid included and lowest rowid past the range]
+    """
+    return owner_id << OWNER_ROWID_SHIFT, (owner_id + 1) << OWNER_ROWID_SHIFT
+
+
+def phone_suffix_range(q: str):
+    """[Bounds the contact_phone_suffixes starting with a phone number fragment, None when too short to be selective]
+
+    Args:
+        q (str): [search text]
+
+    Returns:
+        [Optional[Tuple[str, str]]]: [lowest suffix included and lowest suffix past the range]
+    """
+    q = q.strip()
+    if len(q) < PHONE_MIN_QUERY_LENGTH or " " in q:
+        return None
+    # suffixes compare by code point, those starting with q sort before q with its last character incremented
+    return q, q[:-1] + chr(ord(q[-1]) + 1)
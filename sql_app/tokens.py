@@ -0,0 +1,58 @@
+import hashlib
+import hmac
+import secrets
+from typing import Optional
+
+from .cache import CachedUser, LRUCache
+from .config import settings
+
+TOKEN_BYTES = 32
+
+# presented token -> (user id, token hash) it was verified against, always in process so tokens never leave it
+verified_tokens = LRUCache(max_entries=settings.cache_max_entries, ttl=settings.token_cache_ttl)
+
+
+def generate_token():
+    return secrets.token_urlsafe(TOKEN_BYTES)
+
+
+def hash_token(token: str):
+    """[Keyed hash a token is stored as, so a leaked users table does not leak usable tokens]
+
+    Args:
+        token (str): [token as handed to the user]
+
+    Returns:
+        [str]: [hex HMAC-SHA256 of token under settings.token_secret]
+    """
+    return hmac.new(settings.token_secret.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+def matches(token: str, expected: str):
+    # constant time, so response timing does not reveal how much of a guessed token was right
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+
+async def verify_token(user: CachedUser, token: Optional[str]):
+    """[Checks token against the user's stored hash, skipping the hash when the same token was verified recently]
+
+    A cached verification only counts while the user still has the token hash it was made against, so rotating or
+    revoking a token takes effect as soon as the user is reloaded: at once in the worker that made the change, which
+    invalidates its cached user, and within settings.cache_ttl in every other worker unless the user cache is shared.
+
+    Args:
+        user (CachedUser): [user the token should belong to]
+        token (Optional[str]): [presented token]
+
+    Returns:
+        [bool]: [whether token is the user's current token]
+    """
+    if not token or user.token_hash is None:
+        return False
+    verified = await verified_tokens.get(token)
+    if verified is not None and verified == (user.id, user.token_hash):
+        return True
+    if not matches(hash_token(token), user.token_hash):
+        return False
+    await verified_tokens.set(token, (user.id, user.token_hash))
+    return True
@@ -0,0 +1,39 @@
+import time
+
+from sqlalchemy import bindparam, delete, func, select, update
+
+from . import models
+
+
+def purge(connection, retention: int):
+    """[Deletes contact tombstones older than retention seconds
+
+    The deletes they recorded can no longer be told to a client syncing from before them, so each affected user's
+    resync_version is raised to the newest version purged and such a cursor is answered with 410 instead. The user's
+    older contacts are stamped with that version as well, so the cursors of a download starting over are not older.
+
+    Args:
+        connection (Connection): [sync database connection, in a transaction]
+        retention (int): [seconds a tombstone is kept]
+
+    Returns:
+        [int]: [tombstones deleted]
+    """
+    cutoff = time.time() - retention
+    purged = [{"owner": owner_id, "purged_version": version} for owner_id, version in connection.execute(
+        select(models.ContactTombstone.owner_id, func.max(models.ContactTombstone.version))
+        .where(models.ContactTombstone.deleted_at < cutoff)
+        .group_by(models.ContactTombstone.owner_id))]
+    if not purged:
+        return 0
+    # the users' rows first, as writes to their contacts lock them
+    connection.execute(update(models.User)
+                       .where(models.User.id == bindparam("owner"))
+                       .where(models.User.resync_version < bindparam("purged_version"))
+                       .values(resync_version=bindparam("purged_version")), purged)
+    connection.execute(update(models.Contact)
+                       .where(models.Contact.owner_id == bindparam("owner"))
+                       .where(models.Contact.version < bindparam("purged_version"))
+                       .values(version=bindparam("purged_version")), purged)
+    result = connection.execute(delete(models.ContactTombstone).where(models.ContactTombstone.deleted_at < cutoff))
+    return result.rowcount
@@ -0,0 +1,65 @@
+import inspect
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# session.info key of the callbacks waiting for the session's transaction to commit
+AFTER_COMMIT = "after_commit"
+
+
+def after_commit(db: AsyncSession, callback, *args):
+    """[Defers callback(*args) until db commits, e.g. dropping cached rows the transaction changes
+
+    crud functions only flush, the endpoint commits once per request through commit below. Work done before the commit
+    could be undone by a rollback, or let a concurrent request cache the rows as they were.
+
+    Args:
+        db (AsyncSession): [database session]
+        callback (Callable): [function or coroutine function]
+    """
+    db.info.setdefault(AFTER_COMMIT, []).append((callback, args))
+
+
+async def commit(db: AsyncSession):
+    """[Commits the request's transaction, then runs the callbacks deferred with after_commit]
+
+    Args:
+        db (AsyncSession): [database session]
+
+    Raises:
+        SQLAlchemyError: [the commit failed, the transaction is rolled back and the callbacks dropped]
+    """
+    try:
+        await db.commit()
+    except Exception:
+        await rollback(db)
+        raise
+    for callback, args in db.info.pop(AFTER_COMMIT, []):
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def rollback(db: AsyncSession):
+    db.info.pop(AFTER_COMMIT, None)
+    await db.rollback()
+
+
+async def commit_all(*sessions: AsyncSession):
+    """[Commits each distinct session in order, e.g. the directory before the user's shard where it is another database
+
+    Commits to different databases are not atomic, the first session should be the one whose constraints can fail.
+
+    Raises:
+        SQLAlchemyError: [a commit failed, that session and the ones after it are rolled back]
+    """
+    committed = []
+    try:
+        for db in sessions:
+            if not any(db is other for other in committed):
+                await commit(db)
+                committed.append(db)
+    except Exception:
+        for db in sessions:
+            if not any(db is other for other in committed):
+                await rollback(db)
+        raise
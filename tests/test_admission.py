@@ -0,0 +1,57 @@
+import asyncio
+
+import httpx
+
+import main
+from admission import AdmissionMiddleware, ConcurrencyLimiter, MemoryRateLimiter
+
+USER_ROUTE = "GET /users/{param}/"
+
+
+def admitted_app(rate_limit=(0, 20), route_limits=None, concurrency_limiter=None):
+    return AdmissionMiddleware(main.phonebook, routes=main.phonebook.routes, rate_limiter=MemoryRateLimiter(),
+                               rate_limit=rate_limit, route_limits=route_limits or {}, concurrency_limiter=concurrency_limiter)
+
+
+def send(app, *requests):
+    async def send_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as async_client:
+            return await asyncio.gather(*(async_client.request(method, url, **kwargs) for method, url, kwargs in requests))
+
+    return asyncio.get_event_loop().run_until_complete(send_all())
+
+
+def get_user(user):
+    return ("GET", "/users/%s/" % user["email"], {"headers": user["headers"]})
+
+
+def test_route_limit_answers_429_with_retry_after(client, register):
+    user = register()
+    app = admitted_app(route_limits={USER_ROUTE: [0.01, 2]})
+    responses = send(app, *[get_user(user)] * 3)
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert int(responses[2].headers["Retry-After"]) >= 1
+    # other clients have buckets of their own
+    assert send(app, get_user(register()))[0].status_code == 200
+
+
+def test_client_limit_covers_every_route(client, register):
+    user = register()
+    app = admitted_app(rate_limit=(0.01, 1))
+    first, second = send(app, get_user(user), ("GET", "/users/%s/contacts" % user["email"], {"headers": user["headers"]}))
+    assert (first.status_code, second.status_code) == (200, 429)
+
+
+def test_route_rate_of_zero_is_no_limit(client, register):
+    user = register()
+    app = admitted_app(route_limits={USER_ROUTE: [0, 1]})
+    assert [response.status_code for response in send(app, *[get_user(user)] * 3)] == [200, 200, 200]
+
+
+def test_requests_beyond_the_queue_are_shed_with_503(client, register):
+    user = register()
+    app = admitted_app(concurrency_limiter=ConcurrencyLimiter(limit=1, max_queued=0, timeout=1))
+    responses = send(app, *[get_user(user)] * 3)
+    assert sorted(response.status_code for response in responses) == [200, 503, 503]
+    assert all("Retry-After" in response.headers for response in responses if response.status_code == 503)
@@ -0,0 +1,82 @@
+from click.testing import CliRunner
+from sqlalchemy import update
+
+import cli
+from sql_app import models
+from sql_app.config import settings
+from sql_app.database import shards
+
+from .conftest import contact
+
+
+def changes(client, user, since=None, **params):
+    if since is not None:
+        params["since"] = since
+    return client.get("/users/%s/contacts/changes" % user["email"], params=params, headers=user["headers"])
+
+
+def add_contacts(client, user, numbers):
+    response = client.post("/users/%s/contacts/bulk" % user["email"], json=[contact(number) for number in numbers],
+                           headers=user["headers"])
+    assert response.json()["created"] == len(numbers)
+
+
+def delete_contact(client, user, number):
+    response = client.delete("/users/%s/deleteUserContact" % user["email"],
+                             params={"contact_param": contact(number)["email"]}, headers=user["headers"])
+    assert response.status_code == 200
+
+
+def age_tombstones(user, seconds):
+    with shards.engines[shards.placement(user["id"])].begin() as connection:
+        connection.execute(update(models.ContactTombstone)
+                           .where(models.ContactTombstone.owner_id == user["id"])
+                           .values(deleted_at=models.ContactTombstone.deleted_at - seconds))
+
+
+def purge_tombstones():
+    result = CliRunner().invoke(cli.cli, ["purge-tombstones"])
+    assert result.exit_code == 0, result.output
+
+
+def test_sync_reports_deleted_contacts(client, register):
+    user = register()
+    add_contacts(client, user, range(3))
+    cursor = changes(client, user).json()["cursor"]
+    delete_contact(client, user, 1)
+    body = changes(client, user, cursor).json()
+    assert body["contacts"] == []
+    assert len(body["deleted"]) == 1
+
+
+def test_cursor_older_than_purged_tombstones_has_to_start_over(client, register):
+    user = register()
+    add_contacts(client, user, range(3))
+    cursor = changes(client, user).json()["cursor"]
+    delete_contact(client, user, 1)
+    age_tombstones(user, settings.tombstone_retention + 60)
+    purge_tombstones()
+    assert changes(client, user, cursor).status_code == 410
+    # starting over, a page at a time, ends at a cursor the next sync accepts
+    since, synced = None, []
+    while True:
+        body = changes(client, user, since, limit=1).json()
+        synced += [row["email"] for row in body["contacts"]]
+        since = body["cursor"]
+        if not body["more"]:
+            break
+    assert sorted(synced) == sorted(contact(number)["email"] for number in (0, 2))
+    response = changes(client, user, since)
+    assert response.status_code == 200
+    assert response.json()["contacts"] == response.json()["deleted"] == []
+
+
+def test_recent_tombstones_are_kept(client, register):
+    user = register()
+    add_contacts(client, user, range(2))
+    cursor = changes(client, user).json()["cursor"]
+    delete_contact(client, user, 0)
+    purge_tombstones()
+    response = changes(client, user, cursor)
+    assert response.status_code == 200
+    assert len(response.json()["deleted"]) == 1
@@ -0,0 +1,110 @@
+import asyncio
+
+from sqlalchemy import insert, select
+
+from sql_app import crud, migrations, models, schemas
+from sql_app.database import shards
+
+from .conftest import contact
+
+
+def test_bulk_import_marks_malformed_contacts_invalid(client, register):
+    user = register()
+    contacts = [
+        {"name": "Bad email", "email": "not-an-email", "phonenumber": "9876543210"},
+        {"name": "Bad phone", "email": "bad.phone@tests.example.com", "phonenumber": "1"},
+        {"name": "Spaced", "email": "spaced@tests.example.com", "phonenumber": "+91 98765-43210"},
+    ]
+    response = client.post("/users/%s/contacts/bulk" % user["email"], json=contacts, headers=user["headers"])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == ["invalid", "invalid", "created"]
+    stored = client.get("/users/%s/contacts" % user["email"], headers=user["headers"]).json()
+    assert [(row["name"], row["phonenumber"]) for row in stored] == [("Spaced", "9876543210")]
+
+
+def test_bulk_import_and_add_contact_store_one_phone_number_spelling(client, register):
+    user = register()
+    added = client.post("/users/%s/addContact/" % user["email"],
+                        json=dict(contact(1), phonenumber="+91 80000-00001"), headers=user["headers"])
+    assert added.status_code == 200
+    assert added.json()["phonenumber"] == "8000000001"
+    response = client.post("/users/%s/contacts/bulk" % user["email"], json=[contact(1)], headers=user["headers"])
+    assert response.json()["results"][0]["status"] == "duplicate"
+
+
+def test_add_contact_rejects_an_invalid_phone_number(client, register):
+    user = register()
+    response = client.post("/users/%s/addContact/" % user["email"],
+                           json=dict(contact(1), phonenumber="12"), headers=user["headers"])
+    assert response.status_code == 400
+
+
+def test_contacts_are_found_by_any_spelling_of_their_phone_number(client, register):
+    user = register()
+    url = "/users/%s/%s" % (user["email"], "%s")
+    client.post(url % "addContact/", json=dict(contact(1), phonenumber="+918000000001"), headers=user["headers"])
+    client.post(url % "addContact/", json=dict(contact(2), phonenumber="8000000002"), headers=user["headers"])
+    client.post(url % "addContact/", json=dict(contact(3), phonenumber="8000000003"), headers=user["headers"])
+
+    response = client.put(url % "updateContactPhonenumber", params={"phonenumber": "+91 80000-00001",
+                                                                    "newphonenumber": "+91 88000-00001"},
+                          headers=user["headers"])
+    assert response.status_code == 200
+    response = client.put(url % "updateContactPhonenumbers",
+                          json={"changes": [{"old": "08000000002", "new": "+91 (880) 000-0002"}]}, headers=user["headers"])
+    assert response.json()["updated"] == 1
+    stored = client.get(url % "contacts", headers=user["headers"]).json()
+    assert sorted(row["phonenumber"] for row in stored) == ["8000000003", "8800000001", "8800000002"]
+
+    response = client.delete(url % "deleteUserContact", params={"contact_param": "+918800000001"}, headers=user["headers"])
+    assert response.status_code == 200
+    response = client.request("DELETE", url % "deleteUserContacts",
+                              json={"contact_params": ["918800000002", "+91 80000 00003"]}, headers=user["headers"])
+    assert response.json()["deleted"] == 2
+    assert client.get(url % "contacts", headers=user["headers"]).json() == []
+
+
+def test_migration_stores_contact_phone_numbers_in_canonical_form(client, register):
+    user = register()
+    client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"])
+    rows = [{"email": contact(1)["email"], "phonenumber": "+91 80000-00001"},
+            {"email": contact(2)["email"], "phonenumber": "+918000000002"},
+            {"email": contact(3)["email"], "phonenumber": "12345"}]
+    with shards.engines[shards.placement(user["id"])].begin() as connection:
+        for row in rows:
+            connection.execute(insert(models.Contact.__table__),
+                               dict(row, name="Spelled", owner_id=user["id"], version=0))
+        migrations.contacts_canonical_phonenumbers(connection)
+        stored = connection.execute(select(models.Contact.email, models.Contact.phonenumber)
+                                    .where(models.Contact.owner_id == user["id"])
+                                    .order_by(models.Contact.email)).fetchall()
+    # the second spelling of contact 1 is the same contact, invalid phone numbers are left alone
+    assert [tuple(row) for row in stored] == [(contact(1)["email"], "8000000001"), (contact(2)["email"], "8000000002"),
+                                              (contact(3)["email"], "12345")]
+
+
+def test_bulk_import_reports_contacts_inserted_concurrently_as_duplicates(client, register):
+    user = register()
+    shard = shards.placement(user["id"])
+
+    async def import_racing_another_request():
+        async with shards.session_factories[shard]() as db:
+            execute = db.execute
+
+            async def execute_then_race(*args, **kwargs):
+                result = await execute(*args, **kwargs)
+                if db.execute is execute_then_race:
+                    # right after the duplicate probe, another request inserts contact 1
+                    db.execute = execute
+                    with shards.engines[shard].begin() as connection:
+                        connection.execute(insert(models.Contact.__table__),
+                                           dict(contact(1), owner_id=user["id"], version=0))
+                return result
+
+            db.execute = execute_then_race
+            created = await crud.bulk_create_user_contacts(db, [schemas.ContactCreate(**contact(number))
+                                                                for number in range(3)], user["id"])
+            await db.commit()
+            return created
+
+    assert asyncio.get_event_loop().run_until_complete(import_racing_another_request()) == [True, False, True]
@@ -0,0 +1,64 @@
+from .conftest import contact
+
+
+def contacts_etag(client, user):
+    response = client.get("/users/%s/contacts" % user["email"], headers=user["headers"])
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+
+def test_writes_that_change_nothing_keep_the_etag(client, register):
+    user = register()
+    url = "/users/%s/%s" % (user["email"], "%s")
+    client.post(url % "addContact/", json=contact(1), headers=user["headers"])
+    etag = contacts_etag(client, user)
+
+    assert client.post(url % "contacts/bulk", json=[contact(1)], headers=user["headers"]).json()["created"] == 0
+    assert client.delete(url % "deleteUserContact", params={"contact_param": contact(2)["email"]},
+                         headers=user["headers"]).status_code == 405
+    assert client.request("DELETE", url % "deleteUserContacts", json={"contact_params": [contact(2)["email"]]},
+                          headers=user["headers"]).json()["deleted"] == 0
+    assert client.put(url % "updateContactEmail", params={"email": contact(2)["email"], "newmail": "new@tests.example.com"},
+                      headers=user["headers"]).status_code == 405
+    assert client.put(url % "updateContactPhonenumbers", json={"changes": [{"old": "8000000002", "new": "8000000003"}]},
+                      headers=user["headers"]).json()["updated"] == 0
+    assert contacts_etag(client, user) == etag
+
+    assert client.delete(url % "deleteUserContact", params={"contact_param": contact(1)["email"]},
+                         headers=user["headers"]).status_code == 200
+    assert contacts_etag(client, user) != etag
+
+
+def test_an_unchanged_contacts_page_is_not_modified(client, register):
+    user = register()
+    url = "/users/%s/contacts" % user["email"]
+    client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"])
+    etag = contacts_etag(client, user)
+
+    for tag in (etag, "W/" + etag, '"v0", ' + etag):
+        response = client.get(url, headers=dict(user["headers"], **{"If-None-Match": tag}))
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.content == b""
+
+    client.post("/users/%s/addContact/" % user["email"], json=contact(2), headers=user["headers"])
+    response = client.get(url, headers=dict(user["headers"], **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert sorted(row["email"] for row in response.json()) == [contact(1)["email"], contact(2)["email"]]
+
+
+def test_an_unchanged_user_is_not_modified(client, register):
+    user = register()
+    url = "/users/%s/" % user["phonenumber"]
+    response = client.get(url, headers=user["headers"])
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert client.get(url, headers=dict(user["headers"], **{"If-None-Match": etag})).status_code == 304
+
+    assert client.put(url + "updateUserEmail/", params={"update_param": "renamed@tests.example.com"},
+                      headers=user["headers"]).status_code == 200
+    response = client.get(url, headers=dict(user["headers"], **{"If-None-Match": etag}))
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["mail"] == "renamed@tests.example.com"
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import main
+from sql_app.database import shards
+from sql_app.group_commit import GroupCommitter
+
+from .conftest import contact
+
+
+class RecordingGroupCommitter(GroupCommitter):
+    """GroupCommitter remembering the size of every batch it committed."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.batches = []
+
+    async def _commit(self, batch):
+        self.batches.append(len(batch))
+        await super()._commit(batch)
+
+
+@pytest.fixture
+def group_committers(client, monkeypatch):
+    committers = [RecordingGroupCommitter(session_factory, 0.05, 64) for session_factory in shards.session_factories]
+    monkeypatch.setattr(main, "group_committers", committers)
+    yield committers
+    for committer in committers:
+        asyncio.get_event_loop().run_until_complete(committer.close())
+
+
+def add_contact(user, number, **headers):
+    return ("POST", "/users/%s/addContact/" % user["email"],
+            {"json": contact(number), "headers": dict(user["headers"], **headers)})
+
+
+def test_concurrent_inserts_share_commits(client, register, concurrently, group_committers):
+    users = [register() for _ in range(4)]
+    responses = concurrently(*(add_contact(user, number) for user in users for number in range(5)))
+    assert [response.status_code for response in responses] == [200] * 20
+    assert max(size for committer in group_committers for size in committer.batches) > 1
+    for user in users:
+        listed = client.get("/users/%s/contacts" % user["email"], headers=user["headers"]).json()
+        assert sorted(row["email"] for row in listed) == sorted(contact(number)["email"] for number in range(5))
+
+
+def test_a_duplicate_only_fails_its_own_request(client, register, concurrently, group_committers):
+    user = register()
+    responses = concurrently(add_contact(user, 1), add_contact(user, 2), add_contact(user, 1))
+    assert sorted(response.status_code for response in responses) == [200, 200, 409]
+    assert responses[1].status_code == 200
+
+
+def test_concurrent_requests_with_the_same_key_apply_once(client, register, concurrently, group_committers):
+    user = register()
+    request = add_contact(user, 1, **{"Idempotency-Key": "grouped"})
+    responses = concurrently(request, request)
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].json() == responses[1].json()
+    assert sum(response.headers.get("Idempotent-Replayed") == "true" for response in responses) == 1
+
+
+def test_retry_after_the_batch_committed_is_replayed(client, register, group_committers):
+    user = register()
+    method, url, kwargs = add_contact(user, 1, **{"Idempotency-Key": "grouped-retry"})
+    first = client.post(url, **kwargs)
+    retry = client.post(url, **kwargs)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    mismatched = client.post(url, json=contact(2), headers=kwargs["headers"])
+    assert mismatched.status_code == 422
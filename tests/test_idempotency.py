@@ -0,0 +1,72 @@
+from sqlalchemy import func, select
+
+from sql_app import models
+from sql_app.database import shards
+
+from .conftest import contact
+
+
+def idempotency_records(user):
+    with shards.engines[shards.placement(user["id"])].connect() as connection:
+        return connection.execute(select(func.count()).select_from(models.IdempotencyKey)
+                                  .where(models.IdempotencyKey.user_id == user["id"])).scalar()
+
+
+def contact_count(client, user):
+    return len(client.get("/users/%s/contacts" % user["email"], headers=user["headers"]).json())
+
+
+def test_repeated_key_replays_the_first_response(client, register):
+    user = register()
+    headers = dict(user["headers"], **{"Idempotency-Key": "add-1"})
+    first = client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=headers)
+    retry = client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert contact_count(client, user) == 1
+
+
+def test_repeated_key_replays_a_bulk_import(client, register):
+    user = register()
+    headers = dict(user["headers"], **{"Idempotency-Key": "bulk-1"})
+    contacts = [contact(number) for number in range(3)]
+    first = client.post("/users/%s/contacts/bulk" % user["email"], json=contacts, headers=headers)
+    retry = client.post("/users/%s/contacts/bulk" % user["email"], json=contacts, headers=headers)
+    assert first.json()["created"] == 3
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_key_reused_for_a_different_request_is_rejected(client, register):
+    user = register()
+    headers = dict(user["headers"], **{"Idempotency-Key": "add-1"})
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=headers).status_code == 200
+    response = client.post("/users/%s/addContact/" % user["email"], json=contact(2), headers=headers)
+    assert response.status_code == 422
+    assert contact_count(client, user) == 1
+
+
+def test_keys_are_per_user(client, register):
+    first_user, second_user = register(), register()
+    for user in (first_user, second_user):
+        headers = dict(user["headers"], **{"Idempotency-Key": "shared"})
+        response = client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=headers)
+        assert response.status_code == 200
+        assert "Idempotent-Replayed" not in response.headers
+
+
+def test_concurrent_requests_with_the_same_key_apply_once(client, register, concurrently):
+    user = register()
+    headers = dict(user["headers"], **{"Idempotency-Key": "bulk-concurrent"})
+    contacts = [contact(number) for number in range(5)]
+    request = ("POST", "/users/%s/contacts/bulk" % user["email"], {"json": contacts, "headers": headers})
+    responses = concurrently(request, request)
+    assert [response.status_code for response in responses] == [200, 200]
+    # the request committing second sees its record fail the unique index and replays the first one's response
+    assert responses[0].json() == responses[1].json()
+    assert responses[0].json()["created"] == 5
+    assert sum(response.headers.get("Idempotent-Replayed") == "true" for response in responses) == 1
+    assert idempotency_records(user) == 1
+    assert contact_count(client, user) == 5
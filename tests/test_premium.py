@@ -0,0 +1,46 @@
+from sqlalchemy import delete
+
+from sql_app import models
+from sql_app.bloom import registered_users
+from sql_app.database import shards
+
+from .conftest import ADMIN_HEADERS
+
+
+def test_admin_activates_premium(client, register):
+    user = register()
+    response = client.post("/admin/%s/premiumUser" % user["email"], headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    lookup = client.get("/premiumUser/getUser/%s" % user["phonenumber"],
+                        params={"premium_user_param": user["email"]}, headers=user["headers"])
+    assert lookup.status_code == 200
+    assert lookup.json()["mail"] == user["email"]
+
+
+def test_premium_for_a_user_missing_from_their_shard_is_not_found(client, register):
+    user = register()
+    # the directory still routes to the user, as it does while a delete or a move is half applied
+    with shards.engines[shards.placement(user["id"])].begin() as connection:
+        connection.execute(delete(models.User).where(models.User.id == user["id"]))
+    response = client.post("/admin/%s/premiumUser" % user["email"], headers=ADMIN_HEADERS)
+    assert response.status_code == 404
+
+
+def test_premium_needs_the_admin_token(client, register):
+    user = register()
+    response = client.post("/admin/%s/premiumUser" % user["email"], headers=user["headers"])
+    assert response.status_code == 401
+
+
+def test_lookups_find_users_the_worker_filter_has_not_seen(client, register, monkeypatch):
+    premium, user = register(), register()
+    client.post("/admin/%s/premiumUser" % premium["email"], headers=ADMIN_HEADERS)
+    # as in a worker that has not rebuilt its filter since another worker registered the user
+    monkeypatch.setattr(registered_users, "might_exist", lambda value: False)
+    response = client.get("/premiumUser/getUser/%s" % user["phonenumber"],
+                          params={"premium_user_param": premium["email"]}, headers=premium["headers"])
+    assert response.status_code == 200
+    response = client.post("/premiumUser/lookup", params={"premium_user_param": premium["email"]},
+                           json={"params": [user["email"], "nobody@tests.example.com"]}, headers=premium["headers"])
+    assert response.json()["found"][user["email"]]["phonenumber"] == user["phonenumber"]
+    assert response.json()["not_found"] == ["nobody@tests.example.com"]
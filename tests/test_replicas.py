@@ -0,0 +1,74 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import dependencies
+from sql_app.cache import LRUCache
+from sql_app.database import Replica, shards
+
+from .conftest import DATABASE_DIR, contact
+
+
+@pytest.fixture
+def replicated(monkeypatch):
+    """Gives every shard a replica, a snapshot of it taken by the returned function, which does not replicate later writes."""
+    monkeypatch.setattr(dependencies, "recent_writers", LRUCache(max_entries=1000, ttl=3600))
+    replicas = [Replica("sqlite:///%s/shard%d-replica.db" % (DATABASE_DIR, shard)) for shard in range(len(shards))]
+    monkeypatch.setattr(shards, "replicas", [[replica] for replica in replicas])
+
+    def snapshot():
+        for shard, replica in enumerate(replicas):
+            with sqlite3.connect("%s/shard%d.db" % (DATABASE_DIR, shard)) as primary, \
+                    sqlite3.connect("%s/shard%d-replica.db" % (DATABASE_DIR, shard)) as copy:
+                primary.backup(copy)
+
+    snapshot()
+    yield snapshot
+    for replica in replicas:
+        asyncio.get_event_loop().run_until_complete(replica.async_engine.dispose())
+
+
+def contact_emails(client, user):
+    response = client.get("/users/%s/contacts" % user["email"], headers=user["headers"])
+    assert response.status_code == 200
+    return sorted(row["email"] for row in response.json())
+
+
+def forget_writes():
+    # what happens once REPLICA_MAX_LAG_MS has passed since the user's last write
+    dependencies.recent_writers = LRUCache(max_entries=1000, ttl=3600)
+
+
+def test_reads_go_to_the_replica_and_writes_to_the_primary(client, register, replicated):
+    user = register()
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"]).status_code == 200
+    replicated()
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(2), headers=user["headers"]).status_code == 200
+    forget_writes()
+    # the replica was copied before the second contact was written
+    assert contact_emails(client, user) == [contact(1)["email"]]
+
+
+def test_a_user_reads_their_own_writes_from_the_primary(client, register, replicated):
+    user = register()
+    replicated()
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"]).status_code == 200
+    assert contact_emails(client, user) == [contact(1)["email"]]
+    # other users' reads still go to the replica
+    other = register()
+    replicated()
+    client.post("/users/%s/addContact/" % other["email"], json=contact(2), headers=other["headers"])
+    forget_writes()
+    assert contact_emails(client, other) == []
+
+
+def test_unhealthy_replicas_are_left_out(client, register, replicated):
+    user = register()
+    replicated()
+    client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"])
+    forget_writes()
+    assert contact_emails(client, user) == []
+    for replica in shards.all_replicas():
+        replica.mark_down("test")
+    assert contact_emails(client, user) == [contact(1)["email"]]
@@ -0,0 +1,38 @@
+from .conftest import contact
+
+
+def search(client, user, q, **params):
+    response = client.get("/users/%s/contacts/search" % user["email"], params=dict(params, q=q), headers=user["headers"])
+    assert response.status_code == 200
+    return [row["name"] for row in response.json()]
+
+
+def add_in_reverse(client, user, numbers):
+    # inserted from the last name to the first, so contact ids run against name order
+    response = client.post("/users/%s/contacts/bulk" % user["email"],
+                           json=[contact(number) for number in reversed(numbers)], headers=user["headers"])
+    assert response.json()["created"] == len(numbers)
+
+
+def test_name_matches_are_the_first_by_name(client, register):
+    user = register()
+    add_in_reverse(client, user, range(10))
+    assert search(client, user, "cont", limit=3) == ["Contact 0", "Contact 1", "Contact 2"]
+    assert search(client, user, "contact 7") == ["Contact 7"]
+
+
+def test_phone_matches_are_the_first_by_name(client, register):
+    user = register()
+    # names run against phone numbers
+    contacts = [dict(contact(number), name="Contact %d" % (9 - number)) for number in range(10)]
+    response = client.post("/users/%s/contacts/bulk" % user["email"], json=contacts, headers=user["headers"])
+    assert response.json()["created"] == 10
+    # contained in every phone number, not only at its start
+    assert search(client, user, "0000000", limit=4) == ["Contact 0", "Contact 1", "Contact 2", "Contact 3"]
+    assert search(client, user, "80000", limit=10) == ["Contact %d" % number for number in range(10)]
+
+
+def test_other_users_contacts_are_not_found(client, register):
+    user, other = register(), register()
+    add_in_reverse(client, other, range(3))
+    assert search(client, user, "cont") == []
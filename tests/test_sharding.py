@@ -0,0 +1,124 @@
+import asyncio
+
+from click.testing import CliRunner
+from sqlalchemy import func, select, update
+
+import cli
+from sql_app import cache, models
+from sql_app.database import shards
+
+from .conftest import contact
+
+
+def directory_row(user):
+    with shards.engines[0].connect() as directory:
+        return directory.execute(select(models.UserShard).where(models.UserShard.user_id == user["id"])).first()
+
+
+def rows_per_shard(table, owner_column, user):
+    counts = []
+    for shard_engine in shards.engines:
+        with shard_engine.connect() as connection:
+            counts.append(connection.execute(select(func.count()).select_from(table).where(owner_column == user["id"])).scalar())
+    return counts
+
+
+def set_moving(user, moving):
+    with shards.engines[0].begin() as directory:
+        directory.execute(update(models.UserShard).where(models.UserShard.user_id == user["id"]).values(moving=moving))
+    drop_cached(user)
+
+
+def drop_cached(user):
+    # what every worker does once CACHE_TTL has passed
+    asyncio.get_event_loop().run_until_complete(cache.invalidate_user(user["id"], user["email"], user["phonenumber"]))
+
+
+def reshard(*args):
+    result = CliRunner().invoke(cli.cli, ["reshard", "--wait", "0"] + list(args))
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def contact_emails(client, user):
+    response = client.get("/users/%s/contacts" % user["email"], headers=user["headers"])
+    assert response.status_code == 200
+    return sorted(row["email"] for row in response.json())
+
+
+def test_there_are_two_shards():
+    assert len(shards) == 2
+
+
+def test_users_are_placed_by_their_id_and_listed_in_the_directory(client, register):
+    users = [register() for _ in range(8)]
+    assert {shards.placement(user["id"]) for user in users} == {0, 1}
+    for user in users:
+        shard = shards.placement(user["id"])
+        row = directory_row(user)
+        assert (row.shard, row.moving, row.email, row.phonenumber) == (shard, False, user["email"], user["phonenumber"])
+        assert rows_per_shard(models.User.__table__, models.User.id, user)[shard] == 1
+        assert sum(rows_per_shard(models.User.__table__, models.User.id, user)) == 1
+
+
+def test_contacts_are_written_to_their_owner_shard(client, register):
+    user = register()
+    for number in range(3):
+        assert client.post("/users/%s/addContact/" % user["email"], json=contact(number), headers=user["headers"]).status_code == 200
+    counts = rows_per_shard(models.Contact.__table__, models.Contact.owner_id, user)
+    assert counts[shards.placement(user["id"])] == 3
+    assert sum(counts) == 3
+
+
+def test_writes_are_refused_while_the_user_is_moving(client, register):
+    user = register()
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(1), headers=user["headers"]).status_code == 200
+    set_moving(user, True)
+    try:
+        response = client.post("/users/%s/addContact/" % user["email"], json=contact(2), headers=user["headers"])
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+        # reads are served throughout a move
+        assert contact_emails(client, user) == [contact(1)["email"]]
+    finally:
+        set_moving(user, False)
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(2), headers=user["headers"]).status_code == 200
+
+
+def test_reshard_moves_a_user_and_back(client, register):
+    user = register()
+    numbers = range(4)
+    client.post("/users/%s/contacts/bulk" % user["email"], json=[contact(number) for number in numbers], headers=user["headers"])
+    cursor = client.get("/users/%s/contacts/changes" % user["email"], headers=user["headers"]).json()["cursor"]
+    placement = shards.placement(user["id"])
+    other = 1 - placement
+
+    output = reshard("--user", user["email"], "--to", str(other))
+    assert "user %d: shard %d -> %d" % (user["id"], placement, other) in output
+    drop_cached(user)
+    row = directory_row(user)
+    assert (row.shard, row.moving) == (other, False)
+    assert rows_per_shard(models.User.__table__, models.User.id, user)[placement] == 0
+    assert rows_per_shard(models.Contact.__table__, models.Contact.owner_id, user)[other] == 4
+    assert contact_emails(client, user) == sorted(contact(number)["email"] for number in numbers)
+    # contacts were renumbered on the new shard, cursors from before the move cannot be resumed
+    assert client.get("/users/%s/contacts/changes" % user["email"], params={"since": cursor},
+                      headers=user["headers"]).status_code == 410
+    assert client.post("/users/%s/addContact/" % user["email"], json=contact(9), headers=user["headers"]).status_code == 200
+
+    # without --user every user off their placement is moved back
+    output = reshard()
+    assert "user %d: shard %d -> %d" % (user["id"], other, placement) in output
+    drop_cached(user)
+    assert directory_row(user).shard == placement
+    counts = rows_per_shard(models.Contact.__table__, models.Contact.owner_id, user)
+    assert (counts[placement], counts[other]) == (5, 0)
+    assert contact_emails(client, user) == sorted(contact(number)["email"] for number in (*numbers, 9))
+
+
+def test_reshard_dry_run_moves_nothing(client, register):
+    user = register()
+    placement = shards.placement(user["id"])
+    output = reshard("--user", user["phonenumber"], "--to", str(1 - placement), "--dry-run")
+    assert "user %d: shard %d -> %d" % (user["id"], placement, 1 - placement) in output
+    assert directory_row(user).shard == placement
@@ -0,0 +1,35 @@
+from .conftest import ADMIN_HEADERS
+
+
+def contacts_status(client, user, headers):
+    return client.get("/users/%s/contacts" % user["email"], headers=headers).status_code
+
+
+def bearer(token):
+    return {"Authorization": "Bearer " + token}
+
+
+def test_rotated_token_replaces_the_old_one(client, register):
+    user = register()
+    assert contacts_status(client, user, user["headers"]) == 200
+    response = client.post("/users/%s/rotateToken" % user["email"], headers=user["headers"])
+    assert response.status_code == 200
+    assert contacts_status(client, user, user["headers"]) == 401
+    assert contacts_status(client, user, bearer(response.json()["token"])) == 200
+
+
+def test_revoked_token_is_refused_until_an_admin_issues_one(client, register):
+    user = register()
+    assert contacts_status(client, user, user["headers"]) == 200
+    assert client.delete("/users/%s/revokeToken" % user["email"], headers=user["headers"]).status_code == 200
+    assert contacts_status(client, user, user["headers"]) == 401
+    response = client.post("/admin/%s/rotateToken" % user["phonenumber"], headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    assert contacts_status(client, user, user["headers"]) == 401
+    assert contacts_status(client, user, bearer(response.json()["token"])) == 200
+
+
+def test_token_of_another_user_is_refused(client, register):
+    user, other = register(), register()
+    assert contacts_status(client, user, other["headers"]) == 401
+    assert contacts_status(client, user, {}) == 401
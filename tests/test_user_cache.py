@@ -0,0 +1,52 @@
+import asyncio
+import re
+
+from sql_app import cache
+
+
+def queries(response):
+    return int(re.search(r'desc="(\d+) queries"', response.headers["Server-Timing"]).group(1))
+
+
+def cached(key):
+    return asyncio.get_event_loop().run_until_complete(cache.get_user(key))
+
+
+def test_a_user_is_cached_under_id_email_and_phone_number(client, register):
+    user = register()
+    first = client.get("/users/%s/" % user["email"], headers=user["headers"])
+    assert first.status_code == 200
+    assert queries(first) > 0
+    for key in cache.user_keys(user["id"], user["email"], user["phonenumber"]):
+        assert cached(key).id == user["id"]
+    # any spelling of the phone number finds the same entry
+    for param in (user["phonenumber"], "0" + user["phonenumber"]):
+        response = client.get("/users/%s/" % param, headers=user["headers"])
+        assert response.status_code == 200
+        assert queries(response) == 0
+
+
+def test_writes_to_the_user_replace_the_cached_copy(client, register):
+    user = register()
+    assert client.get("/users/%s/" % user["email"], headers=user["headers"]).status_code == 200
+    response = client.put("/users/%s/updateUserEmail/" % user["phonenumber"],
+                          params={"update_param": "cache-renamed%d@tests.example.com" % user["id"]}, headers=user["headers"])
+    assert response.status_code == 200
+    assert cached(cache.user_param_key(user["email"], is_email=True)) is None
+    assert client.get("/users/%s/" % user["email"], headers=user["headers"]).status_code == 404
+    response = client.get("/users/%s/" % user["phonenumber"], headers=user["headers"])
+    assert response.json()["mail"] == "cache-renamed%d@tests.example.com" % user["id"]
+
+
+def test_lru_cache_evicts_the_least_recently_used_and_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lru = cache.LRUCache(max_entries=2, ttl=30)
+    run = asyncio.get_event_loop().run_until_complete
+    run(lru.set("a", 1))
+    run(lru.set("b", 2))
+    assert run(lru.get("a")) == 1
+    run(lru.set("c", 3))
+    assert (run(lru.get("a")), run(lru.get("b")), run(lru.get("c"))) == (1, None, 3)
+    now[0] += 31
+    assert run(lru.get("a")) is None
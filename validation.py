@@ -1,4 +1,24 @@
 import re
+from enum import Enum
+from typing import Iterable
+
+# courtesy of GFG https://www.geeksforgeeks.org/check-if-email-address-valid-or-not-in-python/
+# the per character alternations are folded into character classes, which match the same strings with far less backtracking
+EMAIL_PATTERN = re.compile(r"[\w.\-]+@[\w.\-]+\.\w{2,3}")
+
+# courtesy of GFG https://www.geeksforgeeks.org/java-program-check-valid-mobile-number/
+# an optional 0, 91 or +91 prefix followed by the 10 digit number, which is captured as the canonical form
+PHONE_PATTERN = re.compile(r"(?:\+?91|0)?([7-9][0-9]{9})")
+
+# separators people type inside phone numbers, dropped before matching
+PHONE_SEPARATORS = re.compile(r"[\s\-()]")
+
+
+class ParamType(Enum):
+    EMAIL = "email"
+    PHONE = "phone"
+    INVALID = "invalid"
+
 
 def validate_email(email: str):
     """ Validates User email-id using regular expression
@@ -10,8 +30,7 @@ def validate_email(email: str):
         [bool]: [returns if the user mailid is valid or not]
     """
 
-    Pattern = '^(\w|\.|\_|\-)+[@](\w|\_|\-|\.)+[.]\w{2,3}$'
-    return re.search(Pattern, email) # courtesy of GFG https://www.geeksforgeeks.org/check-if-email-address-valid-or-not-in-python/
+    return EMAIL_PATTERN.fullmatch(email) is not None
 
 
 def validate_phonenumber(phonenumber: str):
@@ -21,8 +40,75 @@ def validate_phonenumber(phonenumber: str):
         phonenumber (str): [phone number of the user]
 
     Returns:
-        [type]: [returns if the user phonenumber is valid or not]
+        [bool]: [returns if the user phonenumber is valid or not]
+    """
+
+    return normalize_phonenumber(phonenumber) is not None
+
+
+def normalize_phonenumber(phonenumber: str):
+    """[Reduces a phone number to its canonical 10 digit form, dropping separators and the 0 / 91 / +91 prefix]
+
+    Args:
+        phonenumber (str): [phone number as typed, e.g. +91 98765-43210]
+
+    Returns:
+        [Optional[str]]: [canonical phone number, e.g. 9876543210, None if it is not a valid phone number]
+    """
+
+    match = PHONE_PATTERN.fullmatch(PHONE_SEPARATORS.sub("", phonenumber))
+    return match.group(1) if match is not None else None
+
+
+def classify(param: str):
+    """[Classifies param as an email or a phone number with at most one regular expression match]
+
+    Args:
+        param (str): [email or phone number]
+
+    Returns:
+        [ParamType]: [EMAIL, PHONE or INVALID]
+    """
+
+    if "@" in param:
+        return ParamType.EMAIL if EMAIL_PATTERN.fullmatch(param) is not None else ParamType.INVALID
+    return ParamType.PHONE if normalize_phonenumber(param) is not None else ParamType.INVALID
+
+
+def canonical_param(param: str):
+    """[Classifies param and returns it in the form it is stored in, phone numbers normalized]
+
+    Args:
+        param (str): [email or phone number]
+
+    Returns:
+        [Tuple[ParamType, Optional[str]]]: [classification and canonical value, None when INVALID]
+    """
+
+    if "@" in param:
+        if EMAIL_PATTERN.fullmatch(param) is not None:
+            return ParamType.EMAIL, param
+        return ParamType.INVALID, None
+    phonenumber = normalize_phonenumber(param)
+    if phonenumber is not None:
+        return ParamType.PHONE, phonenumber
+    return ParamType.INVALID, None
+
+
+def validate_many(params: Iterable[str]):
+    """[Classifies many params at once for bulk requests, with the patterns bound once for the whole batch]
+
+    Args:
+        params (Iterable[str]): [emails or phone numbers]
+
+    Returns:
+        [List[ParamType]]: [classification per param, in order]
     """
 
-    Pattern = re.compile("(0/91)?[7-9][0-9]{9}")
-    return Pattern.match(phonenumber) # courtesy of GFG https://www.geeksforgeeks.org/java-program-check-valid-mobile-number/
\ No newline at end of file
+    email_match = EMAIL_PATTERN.fullmatch
+    phone_match = PHONE_PATTERN.fullmatch
+    strip_separators = PHONE_SEPARATORS.sub
+    email, phone, invalid = ParamType.EMAIL, ParamType.PHONE, ParamType.INVALID
+    return [(email if email_match(param) is not None else invalid) if "@" in param
+            else (phone if phone_match(strip_separators("", param)) is not None else invalid)
+            for param in params]